@@ -2,15 +2,16 @@
 from typing import Annotated
 from fastapi import Depends, HTTPException, status
 from decouple import config
-from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer
 from sqlmodel import select
 from datetime import datetime, timedelta, timezone
 import jwt
 from jwt.exceptions import InvalidTokenError
-from .schema import Token, TokenData, UserPrivate
+from .schema import TokenData, UserPrivate
 from .database import SessionDep
 from .models import User
+from .hashing import verify_password
+from data.leaderboard import principals_l1
 
 
 # constants for JWT
@@ -20,35 +21,43 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 # outh2 scheme for token
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token")
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated="auto")
-
-
-# verify password
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
-
-
-# hash password
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
 
 
 # get user from db
-def get_user(session: SessionDep, email: str) -> UserPrivate | None:
-    result = session.exec(select(User).where(User.email == email))
+async def get_user(session: SessionDep, email: str) -> UserPrivate | None:
+    result = await session.exec(select(User).where(User.email == email))
     user = result.first()
     if user:
         return UserPrivate.from_orm(user)
     return None
+
+
+# user behind a token subject, from this worker's principal cache when fresh.
+# routes/1.2.1 drops it from every worker when the user's status or role changes
+async def get_principal(session: SessionDep, email: str) -> UserPrivate | None:
+    user = principals_l1.get(email)
+    if user is None:
+        user = await get_user(session, email)
+        if user is not None:
+            principals_l1.set(email, user)
+    return user
     
 
 # authenticate user
-def authenticate_user(session: SessionDep, email: str, password: str) -> UserPrivate | bool:
-    user = get_user(session, email)
+# bcrypt runs in the hashing pool (api/hashing.py), which raises HashingBusy when full.
+# a hash made with another BCRYPT_ROUNDS is replaced with the one made while checking it
+async def authenticate_user(session: SessionDep, email: str, password: str) -> UserPrivate | bool:
+    user = await get_user(session, email)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    valid, rehashed = await verify_password(password, user.hashed_password)
+    if not valid:
         return False
+    if rehashed is not None:
+        db_user = await session.get(User, user.id)
+        db_user.hashed_password = rehashed
+        session.add(db_user)
+        await session.commit()
     return user
 
 
@@ -64,7 +73,14 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None) -> s
     return encoded_jwt
 
 
-# checks that the token includes the email 
+# claims of an access token for the user: sub (email), uid (user id) and adm (admin flag).
+# uid and adm are for clients, permissions are always checked on the cached principal
+def user_claims(user: UserPrivate) -> dict:
+    return {"sub": user.email, "uid": user.id, "adm": bool(user.is_admin)}
+
+
+# checks that the token includes the email, and that it still belongs to an active user.
+# served from the principal cache, so most requests don't touch postgres
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: SessionDep):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -76,11 +92,14 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Se
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
-        token_data = TokenData(email=email)
+        token_data = TokenData(email=email, user_id=payload.get("uid"))
     except InvalidTokenError:
         raise credentials_exception
-    user = get_user(db, email=token_data.email)
-    if user is None:
+    user = await get_principal(db, email=token_data.email)
+    if user is None or user.is_active is False:
+        raise credentials_exception
+    # a token issued to an earlier holder of the email
+    if token_data.user_id is not None and token_data.user_id != user.id:
         raise credentials_exception
     return user
 
@@ -0,0 +1,115 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from decouple import config
+
+
+# bcrypt runs in its own processes so a burst of logins can't take the threads and
+# event loop time the leaderboard reads need. past the queue limit callers are turned away at once
+
+### 0. settings ###
+
+# bcrypt work factor for new hashes, existing hashes with another one are redone at login
+BCRYPT_ROUNDS = config('BCRYPT_ROUNDS', default=12, cast=int)
+HASH_WORKERS = config('HASH_WORKERS', default=min(os.cpu_count() or 1, 4), cast=int)
+# hashes waiting for a free worker before HashingBusy is raised
+HASH_QUEUE_LIMIT = config('HASH_QUEUE_LIMIT', default=32, cast=int)
+
+
+# also raised for the calls in flight when a worker dies, the routes answer 503 and the retry gets a new pool
+class HashingBusy(Exception):
+    pass
+
+
+### 1. WORK DONE IN THE POOL ###
+
+# both return (result, seconds spent hashing) so the wait in the queue can be told apart
+
+def _hash(password : str, rounds : int):
+    from passlib.hash import bcrypt
+    start = time.perf_counter()
+    hashed = bcrypt.using(rounds=rounds).hash(password)
+    return hashed, time.perf_counter() - start
+
+# (password matches, new hash if the stored one has another work factor else None)
+def _verify(password : str, hashed : str, rounds : int):
+    from passlib.hash import bcrypt
+    start = time.perf_counter()
+    valid = bcrypt.verify(password, hashed)
+    rehashed = None
+    if valid and bcrypt.from_string(hashed).rounds != rounds:
+        rehashed = bcrypt.using(rounds=rounds).hash(password)
+    return (valid, rehashed), time.perf_counter() - start
+
+
+### 2. POOL ###
+
+# started on first use. spawned rather than forked, the app process holds threads and open connections
+pool = None
+in_flight = 0
+stats = {'hashes': 0, 'verifies': 0, 'rejected': 0, 'pools_broken': 0, 'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0,
+         'hash_seconds_total': 0.0, 'hash_seconds_max': 0.0}
+
+def get_pool() -> ProcessPoolExecutor:
+    global pool
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return pool
+
+def shutdown_pool():
+    global pool
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+        pool = None
+
+# a pool whose worker died (e.g. killed for memory) fails every call, so it is dropped for get_pool to
+# start a new one. calls that hit it together only drop it once
+def drop_broken_pool(broken : ProcessPoolExecutor):
+    global pool
+    if pool is broken:
+        stats['pools_broken'] += 1
+        pool = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+async def run_in_pool(kind : str, function, *args):
+    global in_flight
+    if in_flight >= HASH_WORKERS + HASH_QUEUE_LIMIT:
+        stats['rejected'] += 1
+        raise HashingBusy(f'{in_flight} password hashes in progress')
+    in_flight += 1
+    submitted = time.perf_counter()
+    executor = get_pool()
+    try:
+        result, hash_seconds = await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+    except BrokenProcessPool as e:
+        drop_broken_pool(executor)
+        raise HashingBusy(f'password hashing pool broke: {e}')
+    finally:
+        in_flight -= 1
+    wait_seconds = time.perf_counter() - submitted - hash_seconds
+    stats[kind] += 1
+    stats['wait_seconds_total'] += wait_seconds
+    stats['wait_seconds_max'] = max(stats['wait_seconds_max'], wait_seconds)
+    stats['hash_seconds_total'] += hash_seconds
+    stats['hash_seconds_max'] = max(stats['hash_seconds_max'], hash_seconds)
+    return result
+
+
+### 3. API ###
+
+async def hash_password(password : str) -> str:
+    return await run_in_pool('hashes', _hash, password, BCRYPT_ROUNDS)
+
+# (password matches, new hash to store or None)
+async def verify_password(password : str, hashed : str):
+    return await run_in_pool('verifies', _verify, password, hashed, BCRYPT_ROUNDS)
+
+def hashing_stats() -> dict:
+    done = stats['hashes'] + stats['verifies']
+    return {'workers': HASH_WORKERS, 'queue_limit': HASH_QUEUE_LIMIT, 'rounds': BCRYPT_ROUNDS, 'in_flight': in_flight,
+            **stats,
+            'wait_seconds_avg': round(stats['wait_seconds_total'] / done, 4) if done else 0.0,
+            'hash_seconds_avg': round(stats['hash_seconds_total'] / done, 4) if done else 0.0}
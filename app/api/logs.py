@@ -0,0 +1,158 @@
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+import traceback
+import uuid
+from datetime import datetime, timezone
+from decouple import config, Csv
+
+
+# every module logs through the root logger, whose only handler puts records on a queue.
+# a listener thread formats them as json lines and does the writing, so a request never
+# waits on the console or the disk. records are sampled and rate limited before they are queued
+
+### 0. settings ###
+
+LOG_LEVEL = config('LOG_LEVEL', default='INFO')
+# written by the listener as well as stdout, empty for stdout only
+LOG_FILE = config('LOG_FILE', default='app.log')
+
+# records kept per call site (logger, file and line) per window, the rest are dropped and
+# counted on the next record let through, e.g. a cache miss logged for every request
+LOG_RATE_LIMIT = config('LOG_RATE_LIMIT', default=10, cast=int)
+LOG_RATE_WINDOW = config('LOG_RATE_WINDOW', default=1.0, cast=float)
+
+# logger:fraction pairs, e.g. api.routes:0.1 keeps one record in ten from that logger
+LOG_SAMPLE_RATES = {name: float(rate) for name, rate in
+                    (pair.rsplit(':', 1) for pair in config('LOG_SAMPLE_RATES', default='', cast=Csv()))}
+
+
+### 1. REQUEST IDS ###
+
+# id of the request being served, None in background tasks
+request_id = contextvars.ContextVar('request_id', default=None)
+
+
+# takes the caller's X-Request-ID or makes one, and returns it on the response
+class RequestIdMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        incoming = dict(scope['headers']).get(b'x-request-id', b'').decode('latin-1')[:64]
+        current = incoming or uuid.uuid4().hex
+        token = request_id.set(current)
+
+        async def send_with_id(message):
+            if message['type'] == 'http.response.start':
+                message.setdefault('headers', []).append((b'x-request-id', current.encode('latin-1')))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id.reset(token)
+
+
+### 2. BEFORE THE QUEUE ###
+
+# runs in the thread that logs, before the record is queued, so it only does dict lookups
+class SampleAndRateLimit(logging.Filter):
+    def __init__(self):
+        super().__init__()
+        # (logger, path, line) -> [window start, records in window, records dropped]
+        self.sites = {}
+
+    def filter(self, record):
+        rate = LOG_SAMPLE_RATES.get(record.name)
+        if rate is not None and random.random() >= rate:
+            return False
+
+        site = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        window = self.sites.get(site)
+        if window is None or now - window[0] >= LOG_RATE_WINDOW:
+            dropped = window[2] if window is not None else 0
+            window = self.sites[site] = [now, 0, dropped]
+        if window[1] >= LOG_RATE_LIMIT:
+            window[2] += 1
+            return False
+        window[1] += 1
+        record.suppressed, window[2] = window[2], 0
+        return True
+
+
+# the message is rendered here, while its arguments still hold the values they had,
+# and the request id is read while still in the request's context
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        record.request_id = request_id.get()
+        if record.exc_info:
+            record.exc_text = ''.join(traceback.format_exception(*record.exc_info))
+            record.exc_info = None
+        return record
+
+
+### 3. LISTENER ###
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+                 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        if getattr(record, 'request_id', None):
+            entry['request_id'] = record.request_id
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+listener = None
+
+# replaces any handlers on the root logger, safe to call more than once
+def setup_logging():
+    global listener
+    if listener is not None:
+        return
+
+    formatter = JsonFormatter()
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if LOG_FILE:
+        handlers.append(logging.FileHandler(LOG_FILE))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    queue_handler = ContextQueueHandler(records)
+    queue_handler.addFilter(SampleAndRateLimit())
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    # the records still queued are written before the process exits
+    atexit.register(stop_logging)
+
+def stop_logging():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
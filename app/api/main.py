@@ -1,15 +1,64 @@
-from fastapi import FastAPI
-from .routes import router as all_routes
+import asyncio
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from .routes import router as all_routes, unavailable_headers
 from .database import create_db_and_tables
+from .hashing import shutdown_pool
+from .metrics import METRICS_ENABLED, MetricsMiddleware
+from .logs import setup_logging, RequestIdMiddleware
+from data.ingest import WRITE_BEHIND, start_flusher, stop_flusher
+from data.leaderboard import listen_for_invalidations, run_period_rollups
+from data.synchronisation import rebuild_if_empty, run_reconciler
+from data.snapshots import run_snapshot_builder
+from data.breaker import RedisUnavailable
 import uvicorn 
 
+# json lines written by a background thread, before anything else logs
+setup_logging()
+
 app = FastAPI(title='leaderboard_api', description='an api for a leaderboard service using redis')
 
 app.include_router(all_routes)
 
+# per route latency and redis round trips for /metrics
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+# added last so the id is set for everything the request logs
+app.add_middleware(RequestIdMiddleware)
+
+# redis calls left unhandled by a route while its breaker is open
+@app.exception_handler(RedisUnavailable)
+async def redis_unavailable(request : Request, exc : RedisUnavailable):
+    return JSONResponse(status_code=503, content={'detail': 'Service temporarily unavailable, retry later'}, headers=unavailable_headers())
+
+# long running tasks started with the app, cancelled on shutdown
+background_tasks = []
+
 @app.on_event("startup")
-def on_strartup():
-    create_db_and_tables()
+async def on_strartup():
+    await create_db_and_tables()
+    # reloads boards and name caches from postgres if redis came up empty
+    background_tasks.append(asyncio.create_task(rebuild_if_empty()))
+    # repairs boards that drifted from postgres after a failed redis write
+    background_tasks.append(asyncio.create_task(run_reconciler()))
+    # drops locally cached names when another worker changes them
+    background_tasks.append(asyncio.create_task(listen_for_invalidations()))
+    # rolls the daily boards up into the weekly and monthly ones
+    background_tasks.append(asyncio.create_task(run_period_rollups()))
+    # rebuilds the top snapshots of the games whose top changed, once per tick
+    background_tasks.append(asyncio.create_task(run_snapshot_builder()))
+    # drains queued scores into postgres, replaying anything left over from a crash first
+    if WRITE_BEHIND:
+        start_flusher()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    if WRITE_BEHIND:
+        await stop_flusher()
+    shutdown_pool()
 
 if __name__ == '__main__':
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,184 @@
+import bisect
+import contextvars
+import time
+from decouple import config
+from sqlalchemy import event
+
+
+# counters and histograms of this worker, served in the prometheus text format by GET /metrics.
+# recording one is a dict update, so the hot paths can afford it. with METRICS_ENABLED off
+# nothing is wrapped or recorded and the route answers 404
+
+### 0. settings ###
+
+METRICS_ENABLED = config('METRICS_ENABLED', default=True, cast=bool)
+
+# seconds, for request and query latencies
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# redis commands and round trips made by one request
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+### 1. COLLECTORS ###
+
+# (name, ((label, value), ...)) -> value or Histogram
+counters = {}
+histograms = {}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # per bucket, not cumulative, the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def inc(name : str, amount=1, **labels):
+    if METRICS_ENABLED:
+        key = (name, tuple(labels.items()))
+        counters[key] = counters.get(key, 0) + amount
+
+def observe(name : str, value, buckets=LATENCY_BUCKETS, **labels):
+    if METRICS_ENABLED:
+        key = (name, tuple(labels.items()))
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+
+### 2. REDIS ###
+
+# [commands, round trips] of the request being served, None in background tasks
+request_redis = contextvars.ContextVar('request_redis', default=None)
+
+def count_redis(commands : int):
+    inc('redis_commands_total', commands)
+    inc('redis_round_trips_total')
+    counts = request_redis.get()
+    if counts is not None:
+        counts[0] += commands
+        counts[1] += 1
+
+# wraps the client's commands, scripts included, and its pipelines, which count as one round trip.
+# pub/sub connections are not counted
+def instrument_redis(client):
+    if not METRICS_ENABLED:
+        return client
+    execute_command = client.execute_command
+    make_pipeline = client.pipeline
+
+    async def counted_command(*args, **options):
+        count_redis(1)
+        return await execute_command(*args, **options)
+
+    def counted_pipeline(*args, **kwargs):
+        pipeline = make_pipeline(*args, **kwargs)
+        execute = pipeline.execute
+
+        async def counted_execute(*execute_args, **execute_kwargs):
+            if pipeline.command_stack:
+                count_redis(len(pipeline.command_stack))
+            return await execute(*execute_args, **execute_kwargs)
+
+        pipeline.execute = counted_execute
+        return pipeline
+
+    client.execute_command = counted_command
+    client.pipeline = counted_pipeline
+    return client
+
+
+### 3. POSTGRES ###
+
+# time of every statement sent on the engine's connections, labelled with the engine's name
+def instrument_engine(engine, name : str):
+    if not METRICS_ENABLED:
+        return
+
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        conn.info['query_started_at'] = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+    def end_query(conn, cursor, statement, parameters, context, executemany):
+        observe('postgres_query_seconds', time.perf_counter() - conn.info.pop('query_started_at'), engine=name)
+
+    @event.listens_for(engine.sync_engine, 'handle_error')
+    def failed_query(context):
+        inc('postgres_query_errors_total', engine=name)
+
+
+### 4. REQUESTS ###
+
+# plain asgi rather than an http middleware, which would add a task per request.
+# requests are labelled with the route's template so ids don't make new series
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        counts = [0, 0]
+        status = [500]
+        token = request_redis.set(counts)
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            request_redis.reset(token)
+            route = scope.get('route')
+            path = route.path if route is not None else 'unmatched'
+            inc('http_requests_total', route=path, method=scope['method'], status=str(status[0]))
+            observe('http_request_duration_seconds', time.perf_counter() - start, route=path, method=scope['method'])
+            observe('http_request_redis_commands', counts[0], COUNT_BUCKETS, route=path)
+            observe('http_request_redis_round_trips', counts[1], COUNT_BUCKETS, route=path)
+
+
+### 5. EXPOSITION ###
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+# extra_samples are (name, 'counter' or 'gauge', {label: value}, value), read from the
+# stats the other modules keep when the endpoint is scraped
+def render(extra_samples=()) -> str:
+    families = {}
+    for (name, labels), value in counters.items():
+        families.setdefault(name, ('counter', []))[1].append(f'{name}{format_labels(labels)} {value}')
+    for name, kind, labels, value in extra_samples:
+        families.setdefault(name, (kind, []))[1].append(f'{name}{format_labels(tuple(labels.items()))} {value}')
+    for (name, labels), histogram in histograms.items():
+        lines = families.setdefault(name, ('histogram', []))[1]
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+        lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+        lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+
+    output = []
+    for name, (kind, lines) in sorted(families.items()):
+        output.append(f'# TYPE {name} {kind}')
+        output.extend(lines)
+    return '\n'.join(output) + '\n'
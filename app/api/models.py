@@ -1,4 +1,5 @@
 from sqlmodel import SQLModel, Field, Relationship
+from sqlalchemy import Index
 from typing import Optional
 from typing import List
 from datetime import datetime
@@ -20,11 +21,21 @@ class User(SQLModel, table=True):
 class Game(SQLModel, table=True):
     id : Optional[int] = Field(default=None, primary_key=True)
     name : str = Field(nullable=False, unique=True)
+    # how a new score combines with the user's current one, see schema.ScorePolicy
+    score_policy : str = Field(default='latest', nullable=False)
     game_scores : List["Score"] = Relationship(back_populates="game")
     date_added : datetime = Field(default_factory=datetime.utcnow, nullable=False)
 
 
 class Score(SQLModel, table=True):
+    # score history is read newest first with keyset pagination on (date_added, id), see data/postgres.py 0.4.
+    # existing databases get these with python -m data.synchronisation score-indexes
+    __table_args__ = (
+        Index('ix_score_user_date', 'user_id', 'date_added', 'id'),
+        Index('ix_score_user_game_date', 'user_id', 'game_id', 'date_added', 'id'),
+        Index('ix_score_game_date', 'game_id', 'date_added', 'id'),
+    )
+
     id : Optional[int] = Field(default=None, primary_key=True)
     user_id : Optional[int] = Field(default=None, foreign_key="user.id")
     user : Optional["User"] = Relationship(back_populates="score_user")
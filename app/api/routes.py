@@ -1,19 +1,28 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Response, Header
 from typing import List
 from fastapi.security import OAuth2PasswordRequestForm
+from fastapi.responses import StreamingResponse
 from typing import Annotated
-from datetime import timedelta
+from datetime import timedelta, datetime
 import logging
-from .database import SessionDep
-from .auth import authenticate_user, create_access_token, get_password_hash, get_current_user
-from .schema import Token, UserInput, UserPublic, ScorePublic, ScoreInput, SingleRankWithScore, GameLookUp, GameID, GameIDInput, MultipleRanks, TopPlayerList
+from .database import SessionDep, ReadSessionDep, pool_stats
+from .auth import authenticate_user, create_access_token, get_current_user, user_claims
+from .hashing import HashingBusy, hash_password, hashing_stats
+from .metrics import METRICS_ENABLED, inc, render
+from .schema import Token, UserInput, UserPublic, UserStatusInput, ScorePublic, ScoreSubmitted, ScoreInput, SingleRankWithScore, RankNeighbourhood, Neighbour, ApproxRank, ScoreDistribution, ScoreBucket, GameLookUp, GameID, GameIDInput, MultipleRanks, TopPlayerList, ScoreBatchInput, ScoreBatchResult, ScoreBatchResponse, ScoreAccepted, ScoreHeld, ScoreHistory, Period
 from .models import User, Score, Game
-from data.leaderboard import retry_submit_score, retrieve_ranking, retrieve_leaders, retry_set_user_cache, retry_set_game_cache, get_game_cache, get_multiple_usernames, add_multiple_usernames, user_data_all_games
-from data.postgres import get_player_info
+from data.leaderboard import retry_submit_score, retry_submit_scores_batch, retrieve_ranking, retrieve_neighbourhood, approximate_ranking, score_distribution, histogram_enabled, HISTOGRAM_PRECISION, retrieve_leaderboard_page, retrieve_global_page, retrieve_global_ranking, retry_set_user_cache, retry_set_game_cache, retry_set_game_policy, retry_invalidate_principal, get_user_cache, get_game_cache, add_multiple_usernames, user_data_all_games, cache_stats, get_multiple_game_names, get_multiple_usernames, get_user_profiles, retry_add_user_profiles, buffer_submit, replay_info
+from data.postgres import retrieve_player_profiles_pg, existing_ids, bulk_insert_scores, score_history
+from data.ingest import WRITE_BEHIND, IngestQueueFull, enqueue_score, ingest_stats
+from data.snapshots import get_snapshot, stale_snapshot, snapshot_page, snapshots_l1, pages_l1, stale_l1, TOP_SNAPSHOT_SIZE
+from data.breaker import BREAKER_RESET_SECONDS, breaker_stats
+from data.live import subscribe, unsubscribe, live_stats
 from sqlmodel import select
 from sqlalchemy.exc import IntegrityError, OperationalError
 from redis.exceptions import ConnectionError, RedisError
 import copy
+import json
+import asyncio
 
 
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
@@ -28,14 +37,7 @@ router = APIRouter()
 
 ## 0.2 logger ##
 
-# initialize logger 
-logging.basicConfig(level=logging.INFO,
-                    format="%(asctime)s - %(levelname)s - %(message)s",
-                    handlers=[
-        logging.StreamHandler(),  # Logs to console
-        logging.FileHandler("app.log")  # Logs to file
-    ])
-
+# handlers are set up once for the app, see api/logs.py
 logger = logging.getLogger(__name__)
 
 
@@ -46,28 +48,31 @@ def log_and_raise_error(message: str, status_code: int = 500):
 
 
 ## 0.4 read from postgres if operation (redis-based) does not return the value 
-def read_db_value(operation, cache_add, session, id, model, attribute: str):
+# fills from postgres are counted for /metrics, the cache lookups themselves are counted by operation
+async def read_db_value(operation, cache_add, session, id, model, attribute: str):
+    cache = f'{model.__name__.lower()}_names'
     try:
-        value = operation(id)
+        value = await operation(id)
         if not value:
-            print('cache miss')
             raise ValueError('Cache miss')
         
     except ValueError as e:
         logger.error(f'cache miss for {model.__name__}: {id}')
-        data = session.get(model, id)
+        data = await session.get(model, id)
         value = getattr(data, attribute, None) if data else None
         #add to cache
-        cache_add(data, id)
-        print('cache add')
+        if value:
+            await cache_add(value, id)
+            inc('cache_fills_total', cache=cache, source='postgres')
 
     except Exception as e:
         logger.error(f'Failed to read {model.__name__} from redis: {e}')
-        data = session.get(model, id)
+        data = await session.get(model, id)
         value = getattr(data, attribute, None) if data else None
         #add to cache
-        cache_add(data, id)
-        print('cache add')
+        if value:
+            await cache_add(value, id)
+            inc('cache_fills_total', cache=cache, source='postgres')
 
     if not value:
         log_and_raise_error(f"Failed to read game from cache or db for game_id {id}")
@@ -75,10 +80,10 @@ def read_db_value(operation, cache_add, session, id, model, attribute: str):
 
 
 ## 0.5 lookup various users from postgres
-def retrieve_multiple_usernames_pg(list_of_ids : List[str], session):
+async def retrieve_multiple_usernames_pg(list_of_ids : List[str], session):
     # get data from postgres
     try:
-        data = session.exec(select(User).where(User.id.in_(list_of_ids))).all()
+        data = (await session.exec(select(User).where(User.id.in_(list_of_ids)))).all()
     except Exception as e:
         logger.error(f"Failure to read data from db: {e} for users: {list_of_ids}")
         return []
@@ -94,13 +99,13 @@ def retrieve_multiple_usernames_pg(list_of_ids : List[str], session):
         username = getattr(item, 'username', None)
         id_username_data.append((id, username))
         
-    write_multiple_usernames_redis(id_username_data)
+    await write_multiple_usernames_redis(id_username_data)
     return id_username_data
 
 ## 0.6 write multiple users to redis user cache ##
-def write_multiple_usernames_redis(user_data):
+async def write_multiple_usernames_redis(user_data):
     try:
-        redis_response = add_multiple_usernames(user_data)
+        redis_response = await add_multiple_usernames(user_data)
         return redis_response
     except RedisError as e:
         logger.error(f"Failure to write data to redis: {e} for users: {user_data}")
@@ -112,7 +117,52 @@ def check_user(current_user : int , user_id : int):
     if current_user != user_id:
         raise HTTPException(status_code=401, detail=f'you do not have permission to view this resource. {current_user}')
 
-## --------------------##
+
+## 0.8 public profiles of various users ##
+# profiles in the same order as the ids. redis first, the misses are read from postgres in
+# one query and written back. users missing from both come back as None
+async def get_player_profiles(list_of_ids, session):
+    try:
+        profiles = await get_user_profiles(list_of_ids)
+    except RedisError as e:
+        logger.error(f'Failed to read player profiles from redis: {e}')
+        profiles = [None] * len(list_of_ids)
+
+    missing = [int(id) for id, profile in zip(list_of_ids, profiles) if profile is None]
+    if not missing:
+        return profiles
+    rows = await retrieve_player_profiles_pg(missing, session) or []
+    found = {str(id): {'username': username, 'country': country, 'date_joined': date_added}
+             for id, username, country, date_added in rows}
+    try:
+        await retry_add_user_profiles(rows)
+    except RedisError as e:
+        logger.error(f'Failed to write player profiles to redis: {e}')
+    return [profile if profile is not None else found.get(str(id)) for id, profile in zip(list_of_ids, profiles)]
+
+
+## 0.9 check the user and game of a submit exist ##
+# with write-behind the boards are written before postgres sees the row, so an unknown id would only
+# fail in the flusher, once redis already has it. ids are looked up like their names: the in-process
+# cache, then redis, then postgres, which fills the caches. raises 404 for an unknown id
+async def check_submit_ids(user_id : int, game_id : int, session):
+    for lookup, cache_add, model, id, attribute in ((get_user_cache, retry_set_user_cache, User, user_id, 'username'),
+                                                    (get_game_cache, retry_set_game_cache, Game, game_id, 'name')):
+        try:
+            if await lookup(id) is not None:
+                continue
+        except RedisError as e:
+            logger.error(f'Failed to read {model.__name__} from redis: {e}')
+        row = await session.get(model, id)
+        if row is None:
+            raise HTTPException(status_code=404, detail=f'unknown {model.__name__.lower()} {id}')
+        try:
+            await cache_add(getattr(row, attribute), id)
+            inc('cache_fills_total', cache=f'{model.__name__.lower()}_names', source='postgres')
+        except RedisError as e:
+            logger.error(f'Failed to cache {model.__name__} {id}: {e}')
+
+## --------------------##
 ### 1. ENDPOINTS ###
 ## --------------------##
 
@@ -123,22 +173,24 @@ def check_user(current_user : int , user_id : int):
 # POST
 # register endpoint
 @router.post("/users/register/", response_model=UserPublic)
-def create_user(user: UserInput, session: SessionDep):
+async def create_user(user: UserInput, session: SessionDep):
     #get hashed password
     try:
-        hashed_password = get_password_hash(user.plain_password)
+        hashed_password = await hash_password(user.plain_password)
+    except HashingBusy:
+        raise HTTPException(status_code=503, detail="Too many password operations, retry later", headers={"Retry-After": "1"})
     except Exception as e:
         log_and_raise_error(f"Error hashing password: {e}", 400)
     
     #create new User instance
     try: 
-        new_user = User(email = user.email, username=user.username, hashed_password=hashed_password, is_admin=user.is_admin)
+        new_user = User(email = user.email, username=user.username, country=user.country, hashed_password=hashed_password, is_admin=user.is_admin)
         session.add(new_user)
-        session.commit()
-        session.refresh(new_user)
+        await session.commit()
+        await session.refresh(new_user)
         
     except IntegrityError as e:
-        session.rollback()
+        await session.rollback()
         log_and_raise_error(f"User with this username/email already exists: {e}", 400)
     except RedisError as e:
         log_and_raise_error(f"Error adding to cache : {e}", 400)
@@ -146,7 +198,7 @@ def create_user(user: UserInput, session: SessionDep):
         log_and_raise_error(f"Error adding user to db: {e}", 400)
     
     # set id -> username in cache
-    retry_set_user_cache(new_user.username, new_user.id)
+    await retry_set_user_cache(new_user.username, new_user.id)
 
     return new_user
 
@@ -161,8 +213,10 @@ async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
     session: SessionDep
 ) -> Token:
-    print( form_data.username)
-    user = authenticate_user(session, form_data.username, form_data.password)
+    try:
+        user = await authenticate_user(session, form_data.username, form_data.password)
+    except HashingBusy:
+        raise HTTPException(status_code=503, detail="Too many password operations, retry later", headers={"Retry-After": "1"})
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -171,11 +225,44 @@ async def login_for_access_token(
         )
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
+        data=user_claims(user), expires_delta=access_token_expires
     )
     return Token(access_token=access_token, token_type="bearer")
 
 
+## 1.2.1 change a user's status ##
+
+# /users/{user_id}/status
+# PATCH
+# admins (de)activate users and grant or revoke admin. every worker drops its cached principal,
+# so the change applies to the user's next request even with a token issued before it
+@router.patch("/users/{user_id}/status", response_model=UserPublic)
+async def update_user_status(user_id: int, changes: UserStatusInput, session: SessionDep,
+                             current_user: Annotated[User, Depends(get_current_user)]):
+    if current_user.is_admin != True:
+        raise HTTPException(status_code=401, detail='You do not have permission to view this resource.')
+
+    user = await session.get(User, user_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail=f'User {user_id} not found.')
+    for field, value in changes.model_dump(exclude_none=True).items():
+        setattr(user, field, value)
+    try:
+        session.add(user)
+        await session.commit()
+        await session.refresh(user)
+    except Exception as e:
+        await session.rollback()
+        log_and_raise_error(f"Error updating user {user_id}: {e}", 500)
+
+    # the principal cache ttl bounds how long a worker that missed this keeps the old status
+    try:
+        await retry_invalidate_principal(user.email)
+    except RedisError as e:
+        logger.error(f'Failed to invalidate cached principal of user {user_id}: {e}')
+    return user
+
+
 ## 1.3 list of games ##
 
 #games/list
@@ -183,10 +270,10 @@ async def login_for_access_token(
 # ids for games
 # postgres
 @router.get("/games", response_model=GameLookUp)
-def all_game_ids(session : SessionDep):
+async def all_game_ids(session : ReadSessionDep):
     try:
-        games = session.exec(select(Game)).all()
-        return GameLookUp(games = [GameID(id = game.id, name=game.name) for game in games])
+        games = (await session.exec(select(Game))).all()
+        return GameLookUp(games = [GameID(id = game.id, name=game.name, score_policy=game.score_policy) for game in games])
     except Exception as e:
         log_and_raise_error(f"Error when retrieving data: {e}", 500)
 
@@ -200,26 +287,27 @@ def all_game_ids(session : SessionDep):
 # TODO limit to admin staff. 
 
 @router.post("/games", response_model=GameID)
-def add_game(game: GameIDInput, 
+async def add_game(game: GameIDInput, 
              session : SessionDep,
              current_user: Annotated[User, Depends(get_current_user)]):
     
     if current_user.is_admin != True:
         raise HTTPException(status_code=401, detail=f'You do not have permission to view this resource.')
     try:
-        new_game = Game(name = game.name)
+        new_game = Game(name = game.name, score_policy=game.score_policy.value)
         session.add(new_game)
-        session.commit()
-        session.refresh(new_game)
+        await session.commit()
+        await session.refresh(new_game)
         
     except IntegrityError as e:
-        session.rollback()
+        await session.rollback()
         log_and_raise_error(f"Game with this name already exists: {e}", 400)
     except Exception as e:
         log_and_raise_error(f"Error adding user to db: {e}", 500)
     
-    # add id -> name to cache
-    retry_set_game_cache(new_game.name, new_game.id)
+    # add id -> name to cache, and the policy the submit script applies
+    await retry_set_game_cache(new_game.name, new_game.id)
+    await retry_set_game_policy(new_game.score_policy, new_game.id)
 
     return new_game
 
@@ -230,20 +318,112 @@ def add_game(game: GameIDInput,
 # POST
 # score submission 
 # redis & pg
-@router.post("/users/{user_id}/scores", response_model=ScorePublic)
-def submit_scores(user_id : int, score: ScoreInput, session: SessionDep):
+# with WRITE_BEHIND the leaderboard is updated immediately and the row is queued for postgres (202)
+# the game's score policy decides what the board keeps, the response says where that left the user
+@router.post("/users/{user_id}/scores", response_model=ScoreSubmitted | ScoreAccepted | ScoreHeld)
+async def submit_scores(user_id : int, score: ScoreInput, session: SessionDep, response: Response):
+    if WRITE_BEHIND:
+        await check_submit_ids(user_id, score.game_id, session)
+        date_added = datetime.utcnow()
+        try:
+            queue_id, rank_change = await enqueue_score(user_id, score.game_id, score.score, date_added)
+            response.status_code = status.HTTP_202_ACCEPTED
+            return ScoreAccepted(user_id=user_id, game_id=score.game_id, score=score.score, date_added=date_added, queue_id=queue_id,
+                                 **rank_change)
+        except IngestQueueFull as e:
+            logger.warning(str(e))
+            raise HTTPException(status_code=503, detail="Score queue is full, retry later", headers={"Retry-After": "1"})
+        except ConnectionError:
+            # redis can't be reached (RedisUnavailable included) and the queue is in redis too,
+            # so the score is written to postgres directly below
+            pass
+        except RedisError as e:
+            log_and_raise_error(f"Error queueing score: {e}", 500)
+
     try:
         # add to postgres
         new_score = Score(user_id = user_id, game_id=score.game_id, score=score.score)
         session.add(new_score)
-        session.commit()
-        session.refresh(new_score)
+        await session.commit()
+        await session.refresh(new_score)
     except Exception as e:
         log_and_raise_error(f"Error adding score to db: {e}", 500)
-     # add to redis
-    retry_submit_score(score, user_id)
+     # add to redis, or hold the update back until redis is reachable again
+    try:
+        rank_change = await retry_submit_score(score, user_id)
+    except ConnectionError:
+        buffer_submit(user_id, score.game_id, score.score, new_score.date_added)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return ScoreHeld(id=new_score.id, user_id=new_score.user_id, score=new_score.score, game_id=new_score.game_id,
+                         date_added=new_score.date_added)
     
-    return new_score
+    return ScoreSubmitted(id=new_score.id, user_id=new_score.user_id, score=new_score.score, game_id=new_score.game_id,
+                          date_added=new_score.date_added, **rank_change)
+
+
+## 1.5.1 submit a batch of scores ##
+
+# /scores/batch
+# POST
+# many scores in one request: one multi-row insert, then the submit script for each record in one transaction
+# redis & pg
+@router.post("/scores/batch", response_model=ScoreBatchResponse)
+async def submit_scores_batch(batch: ScoreBatchInput, session: SessionDep):
+    records = batch.scores
+    results = [ScoreBatchResult(index=i, user_id=record.user_id, game_id=record.game_id, success=False)
+               for i, record in enumerate(records)]
+
+    # reject records pointing at unknown users or games so they don't fail the whole insert
+    try:
+        known_users = await existing_ids(User, {record.user_id for record in records}, session)
+        known_games = await existing_ids(Game, {record.game_id for record in records}, session)
+    except Exception as e:
+        log_and_raise_error(f"Error validating score batch: {e}", 500)
+
+    valid = []
+    for result, record in zip(results, records):
+        if record.user_id not in known_users:
+            result.detail = f"unknown user {record.user_id}"
+        elif record.game_id not in known_games:
+            result.detail = f"unknown game {record.game_id}"
+        else:
+            valid.append((result, record))
+
+    # add to postgres
+    try:
+        inserted = await bulk_insert_scores([record for _, record in valid], session)
+    except Exception as e:
+        await session.rollback()
+        logger.error(f"Error adding score batch to db: {e}")
+        for result, _ in valid:
+            result.detail = "failed to save score"
+        inserted = []
+        valid = []
+
+    for (result, _), (score_id, _) in zip(valid, inserted):
+        result.id = score_id
+
+    # add to redis
+    try:
+        outcomes = await retry_submit_scores_batch([record for _, record in valid]) if valid else []
+    except RedisError as e:
+        logger.error(f"Error adding score batch to leaderboard: {e}")
+        outcomes = [e] * len(valid)
+
+    for (result, record), outcome, (_, date_added) in zip(valid, outcomes, inserted):
+        if isinstance(outcome, ConnectionError):
+            buffer_submit(record.user_id, record.game_id, record.score, date_added)
+            result.success = True
+            result.detail = "score saved, leaderboard update pending until redis is back"
+        elif isinstance(outcome, Exception):
+            result.detail = "score saved but leaderboard update failed"
+        else:
+            result.success = True
+            result.rank = outcome['rank']
+            result.rank_changed = outcome['rank_changed']
+
+    submitted = sum(result.success for result in results)
+    return ScoreBatchResponse(submitted=submitted, failed=len(results) - submitted, results=results)
 
 
 
@@ -252,66 +432,193 @@ def submit_scores(user_id : int, score: ScoreInput, session: SessionDep):
 # games/leaderboard/{game_id}
 # GET
 # leaderboard for a single game
-# redis
+# all-time pages within the top snapshot are served from it with an ETag, unchanged polls get a 304
+# redis
 
 @router.get("/games/leaderboard/{game_id}")
-def leaderboard_single_game(game_id: int,
-                            session : SessionDep,
+async def leaderboard_single_game(game_id: int,
+                            session : ReadSessionDep,
                         start: int = Query(0, ge=0),
-                        end: int = Query(9, ge=4)):
-    # retrieve from redis
+                        end: int = Query(9, ge=4),
+                        period: Period = Period.all_time,
+                        if_none_match: str | None = Header(None)):
+    if period == Period.all_time and end < TOP_SNAPSHOT_SIZE:
+        try:
+            snapshot = await get_snapshot(game_id)
+        except ConnectionError:
+            return stale_leaderboard_page(game_id, period, start, end)
+        except RedisError as e:
+            log_and_raise_error(f'Failed to fetch leaders for game {game_id} : {e}', 500)
+        # before the first build the page is read live
+        if snapshot is not None:
+            etag, data = snapshot
+            headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+            if etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers=headers)
+            return Response(content=snapshot_page(game_id, etag, data, start, end), media_type='application/json', headers=headers)
+
+    # retrieve page, usernames and game name from redis in one round trip
     try:
-        data = retrieve_leaders(game_id, start, end)
+        game_name, page = await retrieve_leaderboard_page(game_id, start, end, period.value)
+    except ConnectionError:
+        return stale_leaderboard_page(game_id, period, start, end)
     except RedisError as e:
         log_and_raise_error(f'Failed to fetch leaders for game {game_id} : {e}', 500)
 
-    # if no data, return early
-    if not data:
-        HTTPException(status_code=404, detail="No leaderboard data found")
-    
-    ## lookup usernames for the leaders
-    # selects the user ids of the leaders
-    user_ids = [entry[0] for entry in data]
-    # gets the multiple usernames
-    usernames = get_multiple_usernames(user_ids)
-    print(usernames)
-    
-    # add missing usernames to the cache
-    if None in usernames:
-        #look up the missing usernames
-        missing_usernames = [user_ids[i] if usernames[i] is None else None for i in range(len(usernames))]
-        missing_data = retrieve_multiple_usernames_pg(missing_usernames)
-        # prepare data
-        username_or_id = [user_ids[i] if usernames[i] == None else usernames[i] for i in range(len(usernames))]
+    # usernames missing from the cache are read from postgres (and cached again)
+    missing_ids = [user_id for user_id, _, username in page if username is None]
+    found_usernames = {}
+    if missing_ids:
+        missing_data = await retrieve_multiple_usernames_pg(missing_ids, session)
+        found_usernames = {str(user_id): username for user_id, username in missing_data}
+
+    # game name missing from the cache
+    if game_name is None:
+        game_name = await read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
+
+    # construct response, falling back to the user id if no username was found
+    response_data = []
+    for rank, (user_id, score, username) in enumerate(page, start=start + 1):
+        response_data.append({
+            "rank": rank, 
+            "username": username or found_usernames.get(user_id, user_id), 
+            "score": score})
+   
+    return {"game" :game_name, "data": response_data}
 
-        # Step 1: Create a dictionary from the list of tuples
-        new_usernames_dict = {user_id: username for user_id, username in missing_data}
 
-        # Step 2: Update the missing_usernames list
-        usernames = [
-            new_usernames_dict.get(str(user_id), user_id) if isinstance(user_id, int) else user_id
-            for user_id in username_or_id
-        ]
+# while redis can't be reached the top of an all-time board is served from the last snapshot
+# this worker read, with "stale": true. anything else waits for redis
+def stale_leaderboard_page(game_id : int, period : Period, start : int, end : int):
+    stale = stale_snapshot(game_id) if period == Period.all_time and end < TOP_SNAPSHOT_SIZE else None
+    if stale is None:
+        raise HTTPException(status_code=503, detail='Leaderboard temporarily unavailable, retry later', headers=unavailable_headers())
+    age, etag, data = stale
+    return Response(content=snapshot_page(game_id, etag, data, start, end, stale=True), media_type='application/json',
+                    headers={'Cache-Control': 'no-store', 'Age': str(int(age)), 'Warning': '110 - "Response is Stale"'})
 
+def unavailable_headers() -> dict:
+    return {'Retry-After': str(max(1, round(BREAKER_RESET_SECONDS)))}
 
-    # lookup game name using game id
-    game_name = read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
 
-    # construct response
-    response_data = []
-    rank = start
+# If-None-Match holds one or more etags, or *. weak ones (W/"...") match too
+def etag_matches(if_none_match : str | None, etag : str) -> bool:
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags
+
 
-    if len(data) != len(usernames):
-        HTTPException(detail="Error in formatting data", status_code=500)
+## 1.6.1 global leaderboard ##
 
-    for i in range(len(data)):
-        rank += 1
+# leaderboard/global
+# GET
+# leaderboard across all games, see GLOBAL_AGGREGATION
+# redis
+@router.get("/leaderboard/global")
+async def leaderboard_global(session : ReadSessionDep,
+                             start: int = Query(0, ge=0),
+                             end: int = Query(9, ge=4)):
+    try:
+        page = await retrieve_global_page(start, end)
+    except RedisError as e:
+        log_and_raise_error(f'Failed to fetch global leaders : {e}', 500)
+
+    # usernames missing from the cache are read from postgres (and cached again)
+    missing_ids = [user_id for user_id, _, username in page if username is None]
+    found_usernames = {}
+    if missing_ids:
+        missing_data = await retrieve_multiple_usernames_pg(missing_ids, session)
+        found_usernames = {str(user_id): username for user_id, username in missing_data}
+
+    response_data = []
+    for rank, (user_id, score, username) in enumerate(page, start=start + 1):
         response_data.append({
-            "rank": rank, 
-            "username": usernames[i], 
-            "score": data[i][1]})
-   
-    return {"game" :game_name, "data": response_data}
+            "rank": rank,
+            "username": username or found_usernames.get(user_id, user_id),
+            "score": score})
+
+    return {"game": "global", "data": response_data}
+
+
+## 1.6.2 user's global ranking ##
+
+# users/{user_id}/ranking/global
+# GET
+# declared before 1.7 so 'global' isn't taken for a game id
+# redis
+@router.get("/users/{user_id}/ranking/global")
+async def user_score_global(user_id: int,
+                            current_user: Annotated[User, Depends(get_current_user)]) -> SingleRankWithScore:
+    check_user(current_user.id, user_id)
+
+    try:
+        rank, score = await retrieve_global_ranking(user_id)
+    except ConnectionError:
+        raise HTTPException(status_code=503, detail="Redis connection failed.")
+    except Exception as e:
+        log_and_raise_error(f"Unexpected error occurred: {e}", 500)
+    if rank is None:
+        raise HTTPException(status_code=404, detail="No global ranking found for this user")
+
+    return {"game": "global", "rank": rank, "score": score}
+
+
+## 1.6.3 score distribution for one game ##
+
+# games/{game_id}/distribution
+# GET
+# members per score bucket of the all-time board, best scores first
+# redis (local cache)
+@router.get("/games/{game_id}/distribution", response_model=ScoreDistribution)
+async def score_distribution_single_game(game_id: int, session : ReadSessionDep):
+    if not histogram_enabled(game_id):
+        raise HTTPException(status_code=404, detail=f'Game {game_id} has no score histogram.')
+    try:
+        buckets = await score_distribution(game_id)
+    except RedisError as e:
+        log_and_raise_error(f'Failed to fetch score distribution for game {game_id} : {e}', 500)
+
+    game_name = await read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
+    return ScoreDistribution(game=game_name, precision=HISTOGRAM_PRECISION,
+                             total_players=sum(count for _, _, count in buckets),
+                             buckets=[ScoreBucket(min_score=low, max_score=high, count=count) for low, high, count in buckets])
+
+
+## 1.6.4 live changes to a leaderboard ##
+
+# games/leaderboard/{game_id}/stream
+# GET
+# server-sent events for ranks start to end of the all-time board: the whole range first,
+# then at most one 'diff' event per tick with the ranks that changed ({'changed': [{rank, username, score}], 'removed': [rank]})
+# streams stay within the top TOP_SNAPSHOT_SIZE ranks, the feed reads the board from rank 0 to the furthest end
+# redis pub/sub
+LIVE_HEARTBEAT = 15
+
+@router.get("/games/leaderboard/{game_id}/stream")
+async def leaderboard_stream(game_id: int,
+                             start: int = Query(0, ge=0),
+                             end: int = Query(9, ge=0, le=TOP_SNAPSHOT_SIZE - 1)):
+    if end < start or end - start >= 100:
+        raise HTTPException(status_code=400, detail='A stream covers 1 to 100 ranks.')
+
+    async def events():
+        viewer = subscribe(game_id, start, end)
+        try:
+            sequence = 0
+            while True:
+                try:
+                    diff = await asyncio.wait_for(viewer.queue.get(), LIVE_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    # keeps proxies from closing an idle connection
+                    yield ': ping\n\n'
+                    continue
+                sequence += 1
+                yield f'id: {sequence}\nevent: diff\ndata: {json.dumps(diff)}\n\n'
+        finally:
+            unsubscribe(game_id, viewer)
+
+    return StreamingResponse(events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 ## 1.7 user's ranking for a game ##
@@ -319,20 +626,24 @@ def leaderboard_single_game(game_id: int,
 # users/{user_id}/ranking/{game_id}
 # GET
 # user's rankings for a single game
+# approx=true reads the all-time rank and percentile from the game's score histogram
 # redis
 @router.get("/users/{user_id}/ranking/{game_id}")
-def user_score_single_game(user_id: int, game_id,
+async def user_score_single_game(user_id: int, game_id,
                            current_user: Annotated[User, Depends(get_current_user)],
-                           session : SessionDep) -> SingleRankWithScore:
+                           session : ReadSessionDep,
+                           period: Period = Period.all_time,
+                           approx: bool = False) -> ApproxRank | SingleRankWithScore:
     # ensure current user is asking about their own resource
     if current_user.id != user_id:
         raise HTTPException(status_code=401, detail=f'you do not have permission to view this resource. {current_user.id}')
-    
+
+    if approx:
+        return await user_approx_rank(user_id, game_id, period, session)
+
     # retrieve rank and score from redis
     try:
-        rank, score = retrieve_ranking(user_id, game_id)
-        if rank is None or score is None:
-            raise HTTPException(status_code=400, detail="Could not find the rank of the user for this game.")
+        rank, score = await retrieve_ranking(user_id, game_id, period.value)
     except ConnectionError:
         raise HTTPException(status_code=503, detail="Redis connection failed.")
     except Exception as e:
@@ -341,53 +652,283 @@ def user_score_single_game(user_id: int, game_id,
         raise HTTPException(status_code=400, detail=f'Could not find the rank of the user for this game. Please check the provided details.')
     
     # get game name
-    game_name = read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
+    game_name = await read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
 
     return {"game" : game_name, "rank": rank, "score" : score}
 
 
-## 1.8 lists the user's ranks for all games ##
+async def user_approx_rank(user_id : int, game_id, period : Period, session):
+    if period != Period.all_time:
+        raise HTTPException(status_code=400, detail='Approximate ranks are only kept for the all_time board.')
+    if not histogram_enabled(game_id):
+        raise HTTPException(status_code=400, detail=f'Game {game_id} has no score histogram, use approx=false.')
+    try:
+        ranking = await approximate_ranking(user_id, game_id)
+    except ConnectionError:
+        raise HTTPException(status_code=503, detail="Redis connection failed.")
+    except RedisError as e:
+        log_and_raise_error(f'Failed to estimate rank of user {user_id} for game {game_id} : {e}', 500)
+    if ranking is None:
+        raise HTTPException(status_code=400, detail=f'Could not find the rank of the user for this game. Please check the provided details.')
+
+    game_name = await read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
+    return ApproxRank(game=game_name, **ranking)
+
+
+## 1.7.1 players around the user for a game ##
+
+# users/{user_id}/ranking/{game_id}/around
+# GET
+# user's rank, score and percentile with up to radius players either side
+# redis
+@router.get("/users/{user_id}/ranking/{game_id}/around", response_model=RankNeighbourhood)
+async def user_neighbourhood_single_game(user_id: int, game_id: int,
+                                         current_user: Annotated[User, Depends(get_current_user)],
+                                         session : ReadSessionDep,
+                                         radius: int = Query(5, ge=0, le=100),
+                                         period: Period = Period.all_time):
+    check_user(current_user.id, user_id)
+
+    # rank, board size and neighbours in one script call
+    try:
+        neighbourhood = await retrieve_neighbourhood(user_id, game_id, radius, period.value)
+    except ConnectionError:
+        raise HTTPException(status_code=503, detail="Redis connection failed.")
+    except RedisError as e:
+        log_and_raise_error(f'Failed to fetch players around user {user_id} for game {game_id} : {e}', 500)
+    if neighbourhood is None:
+        raise HTTPException(status_code=404, detail='Could not find the rank of the user for this game.')
+
+    # usernames from the name cache in one batch, postgres for any not cached
+    neighbours = neighbourhood['neighbours']
+    usernames = await get_multiple_usernames([member for _, member, _ in neighbours])
+    missing_ids = [member for (_, member, _), username in zip(neighbours, usernames) if username is None]
+    found_usernames = {}
+    if missing_ids:
+        missing_data = await retrieve_multiple_usernames_pg(missing_ids, session)
+        found_usernames = {str(user_id): username for user_id, username in missing_data}
+
+    game_name = await read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
+
+    return RankNeighbourhood(
+        game=game_name, rank=neighbourhood['rank'], score=neighbourhood['score'],
+        percentile=neighbourhood['percentile'], total_players=neighbourhood['total_players'],
+        neighbours=[Neighbour(rank=rank, username=username or found_usernames.get(member, member), score=score)
+                    for (rank, member, score), username in zip(neighbours, usernames)])
+
+
+## 1.8 lists the user's ranks for all games ##
 
 # users/{user_id}/ranking
 # GET
 # user's rankings for all games
 # redis
 @router.get('/users/{user_id}/ranking', response_model = MultipleRanks)
-def users_rankings_all_game(user_id : int, 
+async def users_rankings_all_game(user_id : int, 
                             current_user: Annotated[User, Depends(get_current_user)],
-                            session : SessionDep):
+                            session : ReadSessionDep):
     # ensure current user is asking about their own resource
     check_user(current_user.id, user_id)
 
-    # retrieve data from redis
-    results = user_data_all_games(user_id)
-
-    # raise exception or return the data
-    if results == None:
-        HTTPException(status_code=404, detail = "No ranking information found")
+    # retrieve rank and score for each game the user played, in one round trip
+    try:
+        results = await user_data_all_games(user_id)
+    except RedisError as e:
+        log_and_raise_error(f'Failed to fetch rankings for user {user_id} : {e}', 500)
+
+    # raise exception or return the data
+    if not results:
+        raise HTTPException(status_code=404, detail = "No ranking information found")
+
+    # game names, falling back to postgres for any not cached
+    game_names = await get_multiple_game_names([game_id for game_id, _, _ in results])
+    games = []
+    for (game_id, rank, score), game_name in zip(results, game_names):
+        if game_name is None:
+            game_name = await read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
+        games.append(SingleRankWithScore(game=game_name, rank=rank, score=score))
     
-    return results
+    return MultipleRanks(games=games)
+
+
+## 1.8.1 score history ##
+
+# users/{user_id}/scores and games/{game_id}/scores
+# GET
+# scores newest first, limit at a time. ?game_id (users only), ?since and ?until filter them
+# postgres
+HISTORY_COLUMNS = (Score.id, Score.user_id, Score.score, Score.game_id, Score.date_added)
+
+async def read_score_history(session, conditions, since, until, cursor, limit) -> ScoreHistory:
+    try:
+        rows, next_cursor = await score_history(session, HISTORY_COLUMNS, conditions, since, until, cursor, limit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Invalid cursor.')
+    except OperationalError as e:
+        log_and_raise_error(f'Failed to read score history : {e}', 503)
+    return ScoreHistory(scores=[ScorePublic(**row._mapping) for row in rows], next_cursor=next_cursor)
+
+# own scores, or anyone's for an admin
+@router.get('/users/{user_id}/scores', response_model=ScoreHistory)
+async def user_score_history(user_id: int,
+                             current_user: Annotated[User, Depends(get_current_user)],
+                             session: ReadSessionDep,
+                             game_id: int | None = None,
+                             since: datetime | None = None,
+                             until: datetime | None = None,
+                             cursor: str | None = None,
+                             limit: int = Query(100, ge=1, le=1000)):
+    if not current_user.is_admin:
+        check_user(current_user.id, user_id)
+    conditions = [Score.user_id == user_id]
+    if game_id is not None:
+        conditions.append(Score.game_id == game_id)
+    return await read_score_history(session, conditions, since, until, cursor, limit)
+
+# admins only, every player's scores for the game
+@router.get('/games/{game_id}/scores', response_model=ScoreHistory)
+async def game_score_history(game_id: int,
+                             current_user: Annotated[User, Depends(get_current_user)],
+                             session: ReadSessionDep,
+                             since: datetime | None = None,
+                             until: datetime | None = None,
+                             cursor: str | None = None,
+                             limit: int = Query(100, ge=1, le=1000)):
+    if current_user.is_admin != True:
+        raise HTTPException(status_code=401, detail='You do not have permission to view this resource.')
+    return await read_score_history(session, [Score.game_id == game_id], since, until, cursor, limit)
 
 
-## 1.9 info on the top 10 players for an individual game
+## 1.9 info on the top players for an individual game
 
-# games/{game_id}/leaders
+# games/{game_id}/leaders?limit=10
 # GET
-# top players report for a single game
-# pg
-@router.get('games/{game_id}/leaders', response_model= TopPlayerList)
-def top_players(game_id : int,
+# top players report for a single game, up to the top 1000
+# redis, pg for profiles not in redis
+@router.get('/games/{game_id}/leaders', response_model= TopPlayerList)
+async def top_players(game_id : int,
                 current_user: Annotated[User, Depends(get_current_user)],
-                session : SessionDep):
-    
-    # get top 10 players for the game from redis
-    leaders = retrieve_leaders(game_id, 0, 9)
+                session : ReadSessionDep,
+                limit: int = Query(10, ge=1, le=1000)):
 
-    # retrieve player information from postgres
-    player_data = get_player_info(leaders, session)
+    # the board and the game name in one round trip
+    try:
+        game_name, page = await retrieve_leaderboard_page(game_id, 0, limit - 1)
+    except RedisError as e:
+        log_and_raise_error(f'Failed to fetch leaders for game {game_id} : {e}', 500)
+    if not page:
+        raise HTTPException(status_code=404, detail=f'No scores for game {game_id}')
+
+    profiles = await get_player_profiles([user_id for user_id, _, _ in page], session)
+    if game_name is None:
+        game_name = await read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
+
+    # players whose account is gone are left out of the report
+    return {'game': game_name,
+            'leaders': [{'rank': rank, 'user_id': int(user_id), 'score': score, **profile}
+                        for rank, ((user_id, score, _), profile) in enumerate(zip(page, profiles), start=1) if profile is not None]}
+
+
+## 1.10 write-behind queue stats
+
+# stats/ingest
+# GET
+# depth and lag of the scores waiting for postgres
+# redis
+@router.get('/stats/ingest')
+async def ingest_queue_stats():
+    try:
+        return await ingest_stats()
+    except RedisError as e:
+        log_and_raise_error(f"Failed to read ingest queue stats: {e}", 500)
 
-    if player_data is None:
-        return HTTPException(status_code=404, detail = 'Failed to find top player report data')
-    
-    return player_data
 
+## 1.11 name cache stats
+
+# stats/cache
+# GET
+# hit/miss counters of this worker's in-process caches
+@router.get('/stats/cache')
+async def name_cache_stats():
+    return {**cache_stats(), **{cache.name: cache.stats() for cache in (snapshots_l1, pages_l1, stale_l1)}}
+
+
+## 1.12 live stream stats
+
+# stats/live
+# GET
+# games with a fan-out task and connected viewers on this worker
+@router.get('/stats/live')
+async def live_stream_stats():
+    return live_stats()
+
+
+## 1.13 password hashing pool stats
+
+# stats/hashing
+# GET
+# pool size, queue use, rejections and time spent waiting for and doing bcrypt in this worker
+@router.get('/stats/hashing')
+async def password_hashing_stats():
+    return hashing_stats()
+
+
+## 1.14 postgres connection pool stats
+
+# stats/db
+# GET
+# connections in use and idle, checkouts and time spent waiting for one, per engine of this worker
+@router.get('/stats/db')
+async def database_pool_stats():
+    return pool_stats()
+
+
+## 1.15 prometheus metrics
+
+# metrics
+# GET
+# request latencies, redis commands and round trips per request, cache and postgres counters of this worker,
+# in the prometheus text format. the counters kept for the stats routes above are read at scrape time
+@router.get('/metrics')
+async def prometheus_metrics():
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail='Metrics are disabled')
+
+    samples = []
+    local_caches = {**cache_stats(), **{cache.name: cache.stats() for cache in (snapshots_l1, pages_l1, stale_l1)}}
+    for name, stats in local_caches.items():
+        samples += [('local_cache_lookups_total', 'counter', {'cache': name, 'result': 'hit'}, stats['hits']),
+                    ('local_cache_lookups_total', 'counter', {'cache': name, 'result': 'miss'}, stats['misses']),
+                    ('local_cache_fills_total', 'counter', {'cache': name}, stats['fills']),
+                    ('local_cache_evictions_total', 'counter', {'cache': name}, stats['evictions']),
+                    ('local_cache_invalidations_total', 'counter', {'cache': name}, stats['invalidations']),
+                    ('local_cache_entries', 'gauge', {'cache': name}, stats['size'])]
+    for name, pool in pool_stats().items():
+        samples += [('postgres_pool_connections', 'gauge', {'engine': name, 'state': 'checked_out'}, pool['checked_out']),
+                    ('postgres_pool_connections', 'gauge', {'engine': name, 'state': 'idle'}, pool['idle']),
+                    ('postgres_pool_checkouts_total', 'counter', {'engine': name}, pool['checkouts']),
+                    ('postgres_pool_timeouts_total', 'counter', {'engine': name}, pool['timeouts']),
+                    ('postgres_pool_wait_seconds_total', 'counter', {'engine': name}, pool['wait_seconds_total'])]
+    breaker_states = {'closed': 0, 'half_open': 1, 'open': 2}
+    for name, breaker in breaker_stats().items():
+        samples += [('redis_breaker_state', 'gauge', {'breaker': name}, breaker_states[breaker['state']]),
+                    ('redis_breaker_rejected_total', 'counter', {'breaker': name}, breaker['rejected'])]
+    replay = replay_info()
+    samples += [('redis_replay_pending', 'gauge', {}, replay['pending']),
+                ('redis_replay_buffered_total', 'counter', {}, replay['buffered']),
+                ('redis_replay_replayed_total', 'counter', {}, replay['replayed']),
+                ('redis_replay_dropped_total', 'counter', {}, replay['dropped'])]
+    hashing = hashing_stats()
+    samples += [('password_hashes_in_flight', 'gauge', {}, hashing['in_flight']),
+                ('password_hashes_rejected_total', 'counter', {}, hashing['rejected'])]
+    return Response(render(samples), media_type='text/plain; version=0.0.4')
+
+
+## 1.16 redis circuit breakers
+
+# stats/redis
+# GET
+# state of this worker's breakers (0 closed, 1 half open, 2 open in /metrics) and the submits held back for replay
+@router.get('/stats/redis')
+async def redis_breaker_stats():
+    return {'breakers': breaker_stats(), 'replay': replay_info()}
@@ -1,4 +1,4 @@
-from pydantic import BaseModel 
+from pydantic import BaseModel, Field
 from enum import Enum
 from datetime import datetime
 from typing import List 
@@ -29,6 +29,11 @@ class UserPrivate(UserPublic):
 
     class Config:
         from_attributes = True  # Enables from_orm() to work with SQLModel model
+
+# changes an admin can make to a user, fields left out are kept
+class UserStatusInput(BaseModel):
+    is_active: bool | None = None
+    is_admin: bool | None = None
     
 
 ### 2. JWT Token ###
@@ -42,6 +47,7 @@ class Token(BaseModel):
 # data encoded in JWT
 class TokenData(BaseModel):
     email: str | None = None
+    user_id: int | None = None
 
 
 ### 3. Score ###
@@ -57,8 +63,68 @@ class ScorePublic(BaseModel):
     game_id : int
     date_added : datetime
 
+# where a submit left the user on the game's board. leaderboard_score is the score the board
+# holds after the game's policy, e.g. still the old best when the new score is worse
+class RankChange(BaseModel):
+    previous_rank : int | None
+    rank : int
+    rank_changed : bool
+    leaderboard_score : float
+
+class ScoreSubmitted(ScorePublic, RankChange):
+    pass
+
+# score accepted in write-behind mode, it is on the leaderboard but not yet in postgres
+class ScoreAccepted(RankChange):
+    user_id : int
+    score : float
+    game_id : int
+    date_added : datetime
+    queue_id : str
+
+# score saved in postgres while redis was unavailable, its leaderboard update is applied once redis is back
+class ScoreHeld(ScorePublic):
+    leaderboard_pending : bool = True
+
+# batch submission (one record per score, user_id included)
+MAX_SCORE_BATCH = 5000
+
+class ScoreBatchItem(ScoreInput):
+    user_id : int
+
+class ScoreBatchInput(BaseModel):
+    scores : List[ScoreBatchItem] = Field(min_length=1, max_length=MAX_SCORE_BATCH)
+
+# outcome of a single record in the batch, index is the position in the request
+class ScoreBatchResult(BaseModel):
+    index : int
+    user_id : int
+    game_id : int
+    success : bool
+    id : int | None = None
+    detail : str | None = None
+    rank : int | None = None
+    rank_changed : bool | None = None
+
+class ScoreBatchResponse(BaseModel):
+    submitted : int
+    failed : int
+    results : List[ScoreBatchResult]
+
+# a page of score history, newest first. next_cursor is passed back as cursor for the next page
+class ScoreHistory(BaseModel):
+    scores : List[ScorePublic]
+    next_cursor : str | None
+
 ### 4. Rank ###
 
+# which board to read, weekly and monthly are rolled up from the daily boards
+class Period(str, Enum):
+    all_time = 'all_time'
+    daily = 'daily'
+    weekly = 'weekly'
+    monthly = 'monthly'
+
 class SingleRank(BaseModel):
     game: str
     rank : int
@@ -67,13 +133,52 @@ class SingleRankWithScore(SingleRank):
     score : float 
 
 class MultipleRanks(BaseModel):
-    games : List[SingleRank]
+    games : List[SingleRankWithScore]
+
+# a user's position with the players just above and below them
+class Neighbour(BaseModel):
+    rank : int
+    username : str
+    score : float
+
+class RankNeighbourhood(SingleRankWithScore):
+    percentile : float
+    total_players : int
+    neighbours : List[Neighbour]
+
+# rank read from the game's score histogram, the true rank is within rank_min and rank_max
+class ApproxRank(SingleRankWithScore):
+    percentile : float
+    total_players : int
+    rank_min : int
+    rank_max : int
+    approximate : bool = True
+
+# members with a score between min_score and max_score
+class ScoreBucket(BaseModel):
+    min_score : float
+    max_score : float
+    count : int
+
+class ScoreDistribution(BaseModel):
+    game : str
+    precision : float
+    total_players : int
+    buckets : List[ScoreBucket]
 
 
 ### 5. Game ids 
 
+# how a new score combines with the user's current one on a game's board
+class ScorePolicy(str, Enum):
+    best_high = 'best_high'     # keep the highest
+    best_low = 'best_low'       # keep the lowest, e.g. times
+    latest = 'latest'           # keep the last submitted
+    cumulative = 'cumulative'   # add up every submit
+
 class GameIDInput(BaseModel):
     name : str
+    score_policy : ScorePolicy = ScorePolicy.latest
 
 class GameID(GameIDInput):
     id: int
@@ -85,10 +190,14 @@ class GameLookUp(BaseModel):
 ### 6. Player profile
 
 class TopPlayerInfo(BaseModel):
+    rank : int
+    user_id : int
+    score : float
     username : str
     country : str
     date_joined : datetime
 
 
 class TopPlayerList(BaseModel):
+    game : str
     leaders : List[TopPlayerInfo]
\ No newline at end of file
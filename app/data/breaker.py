@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+import redis
+from decouple import config
+from api.metrics import inc
+
+
+# one circuit breaker per redis client. after BREAKER_FAILURES connection failures in a row the
+# client stops sending anything and raises RedisUnavailable at once, so requests fail in
+# microseconds instead of waiting on a dead node. after BREAKER_RESET_SECONDS one call is let
+# through as a probe, and the breaker closes again when it succeeds
+
+### 0. Initialization ###
+
+
+## 0.1 logger ##
+
+logger = logging.getLogger(__name__)
+
+
+## 0.2 settings ##
+
+BREAKER_FAILURES = config('BREAKER_FAILURES', default=5, cast=int)
+BREAKER_RESET_SECONDS = config('BREAKER_RESET_SECONDS', default=5.0, cast=float)
+
+# errors meaning redis could not be reached. any other error is an answer, so redis is up
+CONNECTION_ERRORS = (redis.ConnectionError, redis.TimeoutError, OSError, asyncio.TimeoutError)
+
+
+# a ConnectionError, so the handlers already catching RedisError treat it like an unreachable redis
+class RedisUnavailable(redis.ConnectionError):
+    pass
+
+
+### 1. BREAKER ###
+
+# name -> CircuitBreaker
+breakers = {}
+
+# called with the breaker each time one closes, e.g. to replay what was held back while it was open
+close_listeners = []
+
+
+class CircuitBreaker:
+    def __init__(self, name : str):
+        self.name = name
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.changed_at = time.time()
+        # a half open breaker lets a single call through at a time
+        self.probing = False
+        self.stats = {'opened': 0, 'closed': 0, 'rejected': 0}
+
+    def transition(self, state : str):
+        logger.warning(f'redis circuit {self.name}: {self.state} -> {state}')
+        inc('redis_breaker_transitions_total', breaker=self.name, state=state)
+        self.state = state
+        self.changed_at = time.time()
+        if state == 'open':
+            self.stats['opened'] += 1
+        elif state == 'closed':
+            self.stats['closed'] += 1
+            for listener in close_listeners:
+                listener(self)
+
+    # raises RedisUnavailable when the call must not be made
+    def allow(self):
+        if self.state == 'closed':
+            return
+        if self.state == 'open' and time.monotonic() - self.opened_at >= BREAKER_RESET_SECONDS:
+            self.transition('half_open')
+        if self.state == 'half_open' and not self.probing:
+            self.probing = True
+            return
+        self.stats['rejected'] += 1
+        raise RedisUnavailable(f'redis {self.name} is unavailable, circuit {self.state}')
+
+    def success(self):
+        self.probing = False
+        self.failures = 0
+        if self.state != 'closed':
+            self.transition('closed')
+
+    def failure(self):
+        self.probing = False
+        self.failures += 1
+        if self.state == 'half_open' or (self.state == 'closed' and self.failures >= BREAKER_FAILURES):
+            self.transition('open')
+        if self.state == 'open':
+            self.opened_at = time.monotonic()
+
+    # the call ended without an answer either way, e.g. it was cancelled
+    def release(self):
+        self.probing = False
+
+    async def call(self, function, *args, **kwargs):
+        self.allow()
+        try:
+            result = await function(*args, **kwargs)
+        except CONNECTION_ERRORS:
+            self.failure()
+            raise
+        except redis.RedisError:
+            self.success()
+            raise
+        except BaseException:
+            self.release()
+            raise
+        self.success()
+        return result
+
+    def info(self) -> dict:
+        return {'state': self.state, 'consecutive_failures': self.failures, 'changed_at': self.changed_at, **self.stats}
+
+
+### 2. CLIENTS ###
+
+# commands, scripts and pipelines of the client go through a breaker of the given name.
+# pub/sub connections are left alone, their loops already reconnect on their own
+def protect(client, name : str):
+    breaker = breakers[name] = CircuitBreaker(name)
+    execute_command = client.execute_command
+    make_pipeline = client.pipeline
+
+    async def guarded_command(*args, **options):
+        return await breaker.call(execute_command, *args, **options)
+
+    def guarded_pipeline(*args, **kwargs):
+        pipeline = make_pipeline(*args, **kwargs)
+        execute = pipeline.execute
+
+        async def guarded_execute(*execute_args, **execute_kwargs):
+            return await breaker.call(execute, *execute_args, **execute_kwargs)
+
+        pipeline.execute = guarded_execute
+        return pipeline
+
+    client.execute_command = guarded_command
+    client.pipeline = guarded_pipeline
+    return client
+
+
+def breaker_stats() -> dict:
+    return {name: breaker.info() for name, breaker in breakers.items()}
@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from datetime import datetime
+from types import SimpleNamespace
+from decouple import config
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.exc import IntegrityError, DataError
+from api.database import engine
+from data.leaderboard import r_leaderboard, SUBMIT_SCORE_LUA, SHARDED_FANOUT_LUA, submit_score_keys, submit_score_args, submit_outcome, submit_score_sharded
+from data.shards import is_sharded
+from data.postgres import bulk_insert_scores
+
+
+### 0. Initialization ###
+
+
+## 0.1 logger ##
+
+logger = logging.getLogger(__name__)
+
+
+## 0.2 settings ##
+
+# write-behind is off unless enabled, submit_scores then writes to postgres before redis as before
+WRITE_BEHIND = config('WRITE_BEHIND', default=False, cast=bool)
+
+# max number of scores waiting for postgres before submits are rejected
+INGEST_MAX_DEPTH = config('INGEST_MAX_DEPTH', default=100000, cast=int)
+
+# a flush happens when this many scores are waiting or the interval passes, whichever is first
+INGEST_BATCH_SIZE = config('INGEST_BATCH_SIZE', default=500, cast=int)
+INGEST_FLUSH_INTERVAL_MS = config('INGEST_FLUSH_INTERVAL_MS', default=1000, cast=int)
+
+# entries left unacknowledged this long by a dead flusher are claimed by a live one
+INGEST_CLAIM_IDLE_MS = config('INGEST_CLAIM_IDLE_MS', default=30000, cast=int)
+
+INGEST_STREAM = 'scores:ingest'
+INGEST_DEAD_STREAM = 'scores:ingest:dead'
+INGEST_GROUP = 'postgres-flusher'
+CONSUMER_NAME = f'{socket.gethostname()}-{os.getpid()}'
+
+
+## 0.3 counters for this process ##
+
+stats = {'flushed': 0, 'dead_lettered': 0, 'flushes': 0, 'last_flush_at': None, 'last_batch_size': 0}
+
+# awaited with the records moved to the dead letter stream once they are acked. their scores went on
+# the boards when they were queued, data/synchronisation.py takes them back out
+dead_letter_listeners = []
+
+
+class IngestQueueFull(Exception):
+    pass
+
+
+### 1. ENQUEUE ###
+
+
+# the leaderboard submit and the queued row happen in one script so the leaderboard never runs ahead of the queue.
+# KEYS and ARGV are the submit script's (data/leaderboard.py 2.1) followed by
+# KEYS: stream. ARGV: max depth, iso date added.
+# returns {entry id, submit reply...}, or 0 without writing anything when the queue is at capacity
+ENQUEUE_SCRIPT = r_leaderboard.register_script("""
+if redis.call('XLEN', KEYS[13]) >= tonumber(ARGV[12]) then
+    return 0
+end
+""" + SUBMIT_SCORE_LUA + """
+local entry_id = redis.call('XADD', KEYS[13], '*', 'user_id', ARGV[1], 'game_id', ARGV[3], 'score', ARGV[2], 'date_added', ARGV[13])
+return {entry_id, old_rank, new_rank, stored, policy}
+""")
+
+
+# the same for sharded games, once the board on the shard has been written.
+# KEYS and ARGV are the sharded fanout's followed by KEYS: stream. ARGV: iso date added
+ENQUEUE_SHARDED_SCRIPT = r_leaderboard.register_script(SHARDED_FANOUT_LUA + """
+return redis.call('XADD', KEYS[13], '*', 'user_id', ARGV[1], 'game_id', ARGV[3], 'score', ARGV[2], 'date_added', ARGV[14])
+""")
+
+
+## 1.1 update the leaderboard now and queue the score for postgres ##
+# returns (queue entry id, submit_outcome dict)
+async def enqueue_score(user_id : int, game_id : int, score : float, date_added : datetime):
+    if is_sharded(game_id):
+        return await enqueue_score_sharded(user_id, game_id, score, date_added)
+    keys = submit_score_keys(user_id, game_id, date_added) + [INGEST_STREAM]
+    args = submit_score_args(user_id, game_id, score) + [INGEST_MAX_DEPTH, date_added.isoformat()]
+    result = await ENQUEUE_SCRIPT(keys=keys, args=args)
+    if result == 0:
+        raise IngestQueueFull(f'ingest queue is at capacity ({INGEST_MAX_DEPTH})')
+    entry_id, *outcome = result
+    return entry_id, submit_outcome(*outcome)
+
+# the shard is written before the queue, so the capacity check is made first and can be
+# overshot by the submits in flight at that moment
+async def enqueue_score_sharded(user_id : int, game_id : int, score : float, date_added : datetime):
+    if await r_leaderboard.xlen(INGEST_STREAM) >= INGEST_MAX_DEPTH:
+        raise IngestQueueFull(f'ingest queue is at capacity ({INGEST_MAX_DEPTH})')
+    return await submit_score_sharded(user_id, game_id, score, date_added, fanout=ENQUEUE_SHARDED_SCRIPT,
+                                      extra_keys=[INGEST_STREAM], extra_args=[date_added.isoformat()])
+
+
+### 2. FLUSHER ###
+
+
+## 2.1 helpers ##
+
+async def ensure_group():
+    try:
+        await r_leaderboard.xgroup_create(INGEST_STREAM, INGEST_GROUP, id='0', mkstream=True)
+    except Exception as e:
+        # BUSYGROUP: the group already exists
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def entry_to_record(fields):
+    return SimpleNamespace(user_id=int(fields['user_id']), game_id=int(fields['game_id']),
+                           score=float(fields['score']),
+                           date_added=datetime.fromisoformat(fields['date_added']))
+
+
+# entries this consumer has read but not acked yet, then stale ones of dead consumers, then new ones
+async def read_batch(replay : bool):
+    if replay:
+        response = await r_leaderboard.xreadgroup(INGEST_GROUP, CONSUMER_NAME, {INGEST_STREAM: '0'}, count=INGEST_BATCH_SIZE)
+        entries = response[0][1] if response else []
+        if entries:
+            return entries
+
+    claimed = await r_leaderboard.xautoclaim(INGEST_STREAM, INGEST_GROUP, CONSUMER_NAME, INGEST_CLAIM_IDLE_MS,
+                                       start_id='0-0', count=INGEST_BATCH_SIZE)
+    if claimed[1]:
+        return claimed[1]
+
+    response = await r_leaderboard.xreadgroup(INGEST_GROUP, CONSUMER_NAME, {INGEST_STREAM: '>'},
+                                        count=INGEST_BATCH_SIZE, block=INGEST_FLUSH_INTERVAL_MS)
+    return response[0][1] if response else []
+
+
+## 2.2 write a batch to postgres ##
+
+# delivery is at-least-once: a crash between the commit and the ack replays the batch
+async def flush_entries(entries):
+    # deleted entries come back from xautoclaim as (id, None)
+    entries = [(entry_id, fields) for entry_id, fields in entries if fields]
+    records = [entry_to_record(fields) for _, fields in entries]
+
+    dead = []
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        try:
+            await bulk_insert_scores(records, session)
+            done = [entry_id for entry_id, _ in entries]
+        except (IntegrityError, DataError) as e:
+            # a bad row fails the whole insert, other errors (postgres down) propagate and the batch is replayed
+            await session.rollback()
+            logger.error(f'Failed to flush {len(records)} queued scores, retrying one by one: {e}')
+            done = await flush_one_by_one(entries, records, session, dead)
+
+    if done:
+        pipeline = r_leaderboard.pipeline()
+        pipeline.xack(INGEST_STREAM, INGEST_GROUP, *done)
+        pipeline.xdel(INGEST_STREAM, *done)
+        await pipeline.execute()
+
+    # the entries are acked by now, so a failure here is only logged rather than replaying the batch
+    if dead:
+        for listener in dead_letter_listeners:
+            try:
+                await listener(dead)
+            except Exception as e:
+                logger.error(f'Failed to take {len(dead)} dead-lettered scores off the boards: {e}')
+
+    stats['flushed'] += len(done)
+    stats['flushes'] += 1
+    stats['last_flush_at'] = time.time()
+    stats['last_batch_size'] = len(done)
+
+
+# rows that still fail on their own (e.g. unknown user) are moved to the dead letter stream
+# and their records added to dead
+async def flush_one_by_one(entries, records, session, dead):
+    done = []
+    for (entry_id, fields), record in zip(entries, records):
+        try:
+            await bulk_insert_scores([record], session)
+        except (IntegrityError, DataError) as e:
+            await session.rollback()
+            logger.error(f'Dead-lettering queued score {entry_id} {fields}: {e}')
+            await r_leaderboard.xadd(INGEST_DEAD_STREAM, {**fields, 'error': str(e)[:200]})
+            stats['dead_lettered'] += 1
+            dead.append(record)
+        done.append(entry_id)
+    return done
+
+
+## 2.3 background loop ##
+
+async def run_flusher():
+    replay = True
+    while True:
+        try:
+            if replay:
+                await ensure_group()
+            entries = await read_batch(replay)
+            replay = False
+            if entries:
+                await flush_entries(entries)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # leave the entries pending, they are replayed on the next pass
+            logger.error(f'Ingest flusher error: {e}')
+            replay = True
+            await asyncio.sleep(INGEST_FLUSH_INTERVAL_MS / 1000)
+
+
+flusher_task = None
+
+def start_flusher():
+    global flusher_task
+    flusher_task = asyncio.create_task(run_flusher())
+
+# cancelling mid-flush is safe, unacked entries are replayed on the next start
+async def stop_flusher():
+    if flusher_task is not None:
+        flusher_task.cancel()
+        try:
+            await flusher_task
+        except asyncio.CancelledError:
+            pass
+
+
+### 3. METRICS ###
+
+# depth is what is still waiting for postgres, lag is the age of the oldest waiting score
+async def ingest_stats():
+    pipeline = r_leaderboard.pipeline(transaction=False)
+    pipeline.xlen(INGEST_STREAM)
+    pipeline.xrange(INGEST_STREAM, count=1)
+    pipeline.xlen(INGEST_DEAD_STREAM)
+    depth, oldest, dead = await pipeline.execute()
+
+    lag = 0.0
+    if oldest:
+        oldest_ms = int(oldest[0][0].split('-')[0])
+        lag = max(0.0, time.time() - oldest_ms / 1000)
+
+    return {'enabled': WRITE_BEHIND, 'depth': depth, 'max_depth': INGEST_MAX_DEPTH,
+            'lag_seconds': round(lag, 3), 'dead_letter_depth': dead, **stats}
@@ -1,7 +1,17 @@
 import redis
+from redis import asyncio as aioredis
+from decouple import config, Choices, Csv
 from api.schema import ScorePublic
+from api.metrics import inc, instrument_redis
+from data.local_cache import LocalCache
+from data.breaker import protect, CONNECTION_ERRORS
+from data.shards import shards, SHARDED_GAMES, is_sharded, shard_for, shard_top, shard_rank, shard_size, shard_window, count_above
+from datetime import datetime, timedelta
+from collections import deque
+import asyncio
 import logging
-import time
+import math
+import uuid
 
 
 ### 0. Initialization ###
@@ -9,44 +19,137 @@ import time
 
 ## 0.1 logger ##
 
-logging.basicConfig(level=logging.INFO,
-                    format="%(asctime)s - %(levelname)s - %(message)s",
-                    handlers=[
-        logging.StreamHandler(),  # Logs to console
-        logging.FileHandler("leaderboard.log")  # Logs to file
-    ])
-
 logger = logging.getLogger(__name__)
 
 
 ## 0.2 redis setup ##
 
-# redis setup for all time leaderboard
-r_leaderboard = redis.StrictRedis(host='redis', port=6379, db=0, decode_responses=True)
+# async clients, every call below is awaited so a request never blocks the event loop
+
+# leaderboards and the id -> name caches share db 0 so one script can read them together
+# commands and round trips are counted for /metrics, and calls fail fast while redis is down (data/breaker.py).
+# a connect timeout keeps an unreachable host from holding a request until the os gives up
+REDIS_CONNECT_TIMEOUT = config('REDIS_CONNECT_TIMEOUT', default=1.0, cast=float)
+r_leaderboard = protect(instrument_redis(aioredis.StrictRedis(host='redis', port=6379, db=0, decode_responses=True,
+                                                              socket_connect_timeout=REDIS_CONNECT_TIMEOUT)), 'main')
+
+
+## 0.3 key layout ##
+
+# sorted set per game, member is the user id
+def leaderboard_key(game_id) -> str:
+    return f'leaderboard:{game_id}'
+
+# hash of user id -> username
+USER_NAMES_KEY = 'users:names'
+
+# hash of game id -> game name
+GAME_NAMES_KEY = 'games:names'
+
+# time-bucketed copies of a board, e.g. leaderboard:3:daily:2026-10-18 or leaderboard:3:weekly:2026-W42
+PERIODS = ('daily', 'weekly', 'monthly')
+
+def period_bucket(period : str, when : datetime) -> str:
+    if period == 'daily':
+        return when.strftime('%Y-%m-%d')
+    if period == 'weekly':
+        year, week, _ = when.isocalendar()
+        return f'{year}-W{week:02d}'
+    return when.strftime('%Y-%m')
+
+# board for a period at a point in time (now by default), 'all_time' is the main board
+def board_key(game_id, period : str = 'all_time', when : datetime | None = None) -> str:
+    if period == 'all_time':
+        return leaderboard_key(game_id)
+    return f'{leaderboard_key(game_id)}:{period}:{period_bucket(period, when or datetime.utcnow())}'
+
+# hash of score bucket -> members of the all-time board in it, see 2.7
+def histogram_key(game_id) -> str:
+    return f'{leaderboard_key(game_id)}:histogram'
+
+# materialised top of a board (hash of version, data) and the counter its versions come from, see data/snapshots.py
+def top_snapshot_key(game_id) -> str:
+    return f'{leaderboard_key(game_id)}:top'
+
+def top_version_key(game_id) -> str:
+    return f'{leaderboard_key(game_id)}:top:version'
+
+# set of the games whose top changed since their snapshot was built
+TOP_DIRTY_KEY = 'leaderboard:top:dirty'
+
+# pub/sub channel a game's kept submits are announced on, the message is the user id. see data/live.py
+def events_channel(game_id) -> str:
+    return f'{leaderboard_key(game_id)}:events'
+
+# set of the games with a submit on a given day, these are the ones rolled up
+def active_games_key(when : datetime) -> str:
+    return f'periods:active:{period_bucket("daily", when)}'
+
+# set of every game id that has a board
+GAMES_REGISTRY_KEY = 'games:registry'
 
-# redis cache for user (id -> username)
-r_user = redis.StrictRedis(host='redis', port=6379, db=1, decode_responses=True)
+# set of the game ids a user has a score in
+def user_games_key(user_id) -> str:
+    return f'user:{user_id}:games'
 
-# redis cache for game (id -> name)
-r_game = redis.StrictRedis(host='redis', port=6379, db=2, decode_responses=True)
+# hash of a user's public profile (username, country, date_joined), see 3.4
+def user_profile_key(user_id) -> str:
+    return f'user:{user_id}:profile'
 
+# sorted set of user id -> score across all games, see 2.5
+GLOBAL_LEADERBOARD_KEY = 'leaderboard:global'
 
-## 0.3 retry base function ##
+# hash of game id -> score policy (best_high, best_low, latest, cumulative), latest when missing
+GAME_POLICIES_KEY = 'games:policies'
+
+# hash of game id -> weight in the global board when GLOBAL_AGGREGATION is weighted (default 1)
+GAME_WEIGHTS_KEY = 'games:weights'
+
+# pub/sub channel announcing changed names, messages are 'user:{id}' or 'game:{id}'
+CACHE_INVALIDATION_CHANNEL = 'cache:invalidate'
+
+# hash of record index -> submit script reply of a score batch, see 2.1.2
+def batch_results_key(batch_id : str) -> str:
+    return f'submit:batch:{batch_id}'
+
+
+## 0.4 retry base function ##
 
 # generic function to retry an operation -> this will retry if there is a redis set failure
-def retry_cache_operation(operation, *args, retries=3, delay=0.5):
+async def retry_cache_operation(operation, *args, retries=3, delay=0.5):
     for attempt in range(retries):
         try:
-            operation(*args)
-            return
+            return await operation(*args)
+        except CONNECTION_ERRORS:
+            # unreachable, or a breaker open or probing (RedisUnavailable). the breaker decides when to
+            # try redis again, waiting here would only hold the request
+            inc('cache_operation_failures_total', operation=operation.__name__)
+            raise
         except redis.RedisError as e:
             logger.error(f"Redis error (attempt {attempt + 1}/{retries}): {str(e)}")
             if attempt < retries - 1:
-                time.sleep(delay * (2 ** attempt))
+                inc('cache_operation_retries_total', operation=operation.__name__)
+                await asyncio.sleep(delay * (2 ** attempt))
             else:
+                inc('cache_operation_failures_total', operation=operation.__name__)
                 raise e
 
 
+## 0.5 in-process name caches ##
+
+# sit in front of the redis hashes. entries expire after the ttl and are dropped early
+# when any worker changes a name (see 3.3)
+user_names_l1 = LocalCache('user_names', maxsize=config('USER_NAME_CACHE_SIZE', default=100000, cast=int),
+                           ttl=config('USER_NAME_CACHE_TTL', default=300, cast=float))
+game_names_l1 = LocalCache('game_names', maxsize=config('GAME_NAME_CACHE_SIZE', default=10000, cast=int),
+                           ttl=config('GAME_NAME_CACHE_TTL', default=3600, cast=float))
+
+# authenticated users by token subject (email), filled by api/auth.py. kept short as it holds the
+# user's status and role, which are also dropped from every worker as soon as they change
+principals_l1 = LocalCache('principals', maxsize=config('PRINCIPAL_CACHE_SIZE', default=100000, cast=int),
+                           ttl=config('PRINCIPAL_CACHE_TTL', default=60, cast=float))
+
+
 ### 2. SORTED SET for leaderboard ###
 
 # base function - not be used directly
@@ -55,37 +158,747 @@ def retry_cache_operation(operation, *args, retries=3, delay=0.5):
 
 ## 2.1 submit a score ##
 
+# how the global board combines a user's game scores:
+# sum of the game scores, the best of them, or sum weighted by games:weights
+GLOBAL_AGGREGATION = config('GLOBAL_AGGREGATION', default='sum', cast=Choices(['sum', 'max', 'weighted']))
+
+# entries kept in a game's top snapshot, a submit moving anyone within them marks the game dirty
+TOP_SNAPSHOT_SIZE = config('TOP_SNAPSHOT_SIZE', default=100, cast=int)
+
+# lua function keeping the global board in step with a game board, used by every script that
+# changes a board: update_global(global board, game weights, game policies, user's games, board key prefix,
+# aggregation, user, game, game policy, previous board score (false if none), new board score (false if removed).
+# best_low games are left out: a better time is a smaller number, so counting it would let an
+# improvement lower the user's global score
+GLOBAL_UPDATE_LUA = """
+local function update_global(global, weights, policies, user_games, prefix, aggregation, user, game, policy, previous, new)
+    if policy == 'best_low' then
+        return
+    end
+    local old = previous and tonumber(previous) or 0
+    if aggregation == 'max' then
+        local best = redis.call('ZSCORE', global, user)
+        if new and (not best or new >= tonumber(best)) then
+            redis.call('ZADD', global, new, user)
+        elseif previous and best and (not new or new < old) and old >= tonumber(best) then
+            -- the game holding the user's best went down or was removed, find the best across their games again
+            best = new
+            for _, other in ipairs(redis.call('SMEMBERS', user_games)) do
+                local other_score = redis.call('ZSCORE', prefix .. other, user)
+                if other_score and redis.call('HGET', policies, other) ~= 'best_low' then
+                    other_score = tonumber(other_score)
+                    if not best or other_score > best then
+                        best = other_score
+                    end
+                end
+            end
+            if best then
+                redis.call('ZADD', global, best, user)
+            else
+                redis.call('ZREM', global, user)
+            end
+        end
+    else
+        -- sum and weighted only need the change in this game's score
+        local weight = 1
+        if aggregation == 'weighted' then
+            weight = tonumber(redis.call('HGET', weights, game) or '1')
+        end
+        local delta = ((new or 0) - old) * weight
+        if delta ~= 0 or not previous then
+            redis.call('ZINCRBY', global, delta, user)
+        end
+        if not new and redis.call('SCARD', user_games) == 0 then
+            redis.call('ZREM', global, user)
+        end
+    end
+end
+"""
+
+# lua functions keeping a game's score histogram in step with its board (see 2.7):
+# update_histogram(histogram, precision ('' when the game has none), previous board score (false if none), new board score (false if removed))
+HISTOGRAM_LUA = """
+local function histogram_bucket(score, precision)
+    if score == 0 then
+        return '0'
+    end
+    local sign = score > 0 and 'p' or 'n'
+    return sign .. math.floor(math.log(math.abs(score)) / math.log(1 + precision))
+end
+
+local function update_histogram(key, precision, previous, new)
+    if precision == '' then
+        return
+    end
+    precision = tonumber(precision)
+    local bucket = new and histogram_bucket(new, precision)
+    if previous then
+        local old_bucket = histogram_bucket(tonumber(previous), precision)
+        if old_bucket == bucket then
+            return
+        end
+        if redis.call('HINCRBY', key, old_bucket, -1) <= 0 then
+            redis.call('HDEL', key, old_bucket)
+        end
+    end
+    if bucket then
+        redis.call('HINCRBY', key, bucket, 1)
+    end
+end
+"""
+
+# the game's policy is applied with ZADD GT / ZINCRBY, so a submit never reads first.
+# best_low boards hold the negated score, so a higher stored score is always the better one
+# and every board is read with ZREVRANGE / ZREVRANK. see display_score.
+# defines apply_policy(board, policy, user, score)
+APPLY_POLICY_LUA = """
+local function apply_policy(key, policy, user, score)
+    if policy == 'cumulative' then
+        redis.call('ZINCRBY', key, score, user)
+    elseif policy == 'best_high' then
+        redis.call('ZADD', key, 'GT', score, user)
+    elseif policy == 'best_low' then
+        redis.call('ZADD', key, 'GT', -score, user)
+    else
+        redis.call('ZADD', key, score, user)
+    end
+end
+"""
+
+# every write of a score goes through this script body, so the game board, its period copies,
+# the indexes and the global board always move together. data/ingest.py extends it.
+# KEYS: board, games registry, user's games, daily board, today's active games, global board, game weights, game policies, histogram,
+#       dirty top snapshots, weekly board, monthly board
+# ARGV: user id, score, game id, daily ttl, active games ttl, global aggregation, board key prefix, histogram precision, top snapshot size,
+#       weekly ttl, monthly ttl
+# leaves old_rank (false if new), new_rank (0-based), stored (board score) and policy for the caller to return
+SUBMIT_HEADER_LUA = GLOBAL_UPDATE_LUA + HISTOGRAM_LUA + APPLY_POLICY_LUA + """
+local user, score, game = ARGV[1], tonumber(ARGV[2]), ARGV[3]
+local policy = redis.call('HGET', KEYS[8], game) or 'latest'
+"""
+
+# everything but the board itself, from previous and stored
+SUBMIT_FANOUT_LUA = """
+local new = tonumber(stored)
+redis.call('SADD', KEYS[2], game)
+redis.call('SADD', KEYS[3], game)
+apply_policy(KEYS[4], policy, user, score)
+redis.call('EXPIRE', KEYS[4], ARGV[4])
+redis.call('SADD', KEYS[5], game)
+redis.call('EXPIRE', KEYS[5], ARGV[5])
+
+-- the latest score of the week and month is this one, other policies are rolled up from the daily boards (see 2.4)
+if policy == 'latest' then
+    redis.call('ZADD', KEYS[11], score, user)
+    redis.call('EXPIRE', KEYS[11], ARGV[10])
+    redis.call('ZADD', KEYS[12], score, user)
+    redis.call('EXPIRE', KEYS[12], ARGV[11])
+end
+
+-- the global board follows the game board's score, so it only moves when the policy kept the submit
+update_global(KEYS[6], KEYS[7], KEYS[8], KEYS[3], ARGV[7], ARGV[6], user, game, policy, previous, new)
+update_histogram(KEYS[9], ARGV[8], previous, new)
+
+-- events_channel(game), for live viewers of the board
+if stored ~= previous then
+    redis.call('PUBLISH', ARGV[7] .. game .. ':events', user)
+end
+"""
+
+SUBMIT_SCORE_LUA = SUBMIT_HEADER_LUA + """
+local previous = redis.call('ZSCORE', KEYS[1], user)
+local old_rank = false
+if previous then
+    old_rank = redis.call('ZREVRANK', KEYS[1], user)
+end
+apply_policy(KEYS[1], policy, user, score)
+local stored = redis.call('ZSCORE', KEYS[1], user)
+local new_rank = redis.call('ZREVRANK', KEYS[1], user)
+
+-- a kept submit at or into the top needs a new snapshot, the builder picks the game up on its next tick
+local top = tonumber(ARGV[9])
+if stored ~= previous and (new_rank < top or (old_rank and old_rank < top)) then
+    redis.call('SADD', KEYS[10], game)
+end
+""" + SUBMIT_FANOUT_LUA
+SUBMIT_SCORE_SCRIPT = r_leaderboard.register_script(SUBMIT_SCORE_LUA + 'return {old_rank, new_rank, stored, policy}')
+
+def submit_score_keys(user_id, game_id, when : datetime):
+    return [leaderboard_key(game_id), GAMES_REGISTRY_KEY, user_games_key(user_id), board_key(game_id, 'daily', when),
+            active_games_key(when), GLOBAL_LEADERBOARD_KEY, GAME_WEIGHTS_KEY, GAME_POLICIES_KEY, histogram_key(game_id),
+            TOP_DIRTY_KEY, board_key(game_id, 'weekly', when), board_key(game_id, 'monthly', when)]
+
+def submit_score_args(user_id, game_id, score : float):
+    return [user_id, score, game_id, PERIOD_TTLS['daily'], ACTIVE_GAMES_TTL, GLOBAL_AGGREGATION, leaderboard_key(''),
+            histogram_precision(game_id), TOP_SNAPSHOT_SIZE, PERIOD_TTLS['weekly'], PERIOD_TTLS['monthly']]
+
+# score as shown to users, best_low boards store it negated
+def display_score(policy, score):
+    return -score if policy == 'best_low' else score
+
+# script reply -> fields of schema.RankChange, ranks 1-based
+def submit_outcome(old_rank, new_rank, stored, policy) -> dict:
+    return {'previous_rank': None if old_rank is None else old_rank + 1,
+            'rank': new_rank + 1,
+            'rank_changed': old_rank != new_rank,
+            'leaderboard_score': display_score(policy, float(stored))}
+
 # do not use directly
-def submit_score(score: ScorePublic, user_id):
-    r_leaderboard.zadd(score.game_id, {user_id: score.score})
+async def submit_score(score: ScorePublic, user_id) -> dict:
+    if is_sharded(score.game_id):
+        _, outcome = await submit_score_sharded(user_id, score.game_id, score.score, datetime.utcnow())
+        return outcome
+    result = await SUBMIT_SCORE_SCRIPT(keys=submit_score_keys(user_id, score.game_id, datetime.utcnow()),
+                                       args=submit_score_args(user_id, score.game_id, score.score))
+    return submit_outcome(*result)
 
 # to be used
-def retry_submit_score(score:ScorePublic, user_id):
-    retry_cache_operation(submit_score, score, user_id)
+async def retry_submit_score(score:ScorePublic, user_id):
+    return await retry_cache_operation(submit_score, score, user_id)
+
+
+## 2.1.1 submit a score to a sharded game ##
+
+# the board lives on the member's shard (data/shards.py), the rest on the main redis.
+# the two steps are separate round trips to separate nodes, so unlike the unsharded submit
+# they are not atomic together.
+
+# KEYS: board. ARGV: user id, score, policy. returns {previous board score or false, stored}
+SHARD_BOARD_SCRIPT = r_leaderboard.register_script(APPLY_POLICY_LUA + """
+local previous = redis.call('ZSCORE', KEYS[1], ARGV[1])
+apply_policy(KEYS[1], ARGV[3], ARGV[1], tonumber(ARGV[2]))
+return {previous, redis.call('ZSCORE', KEYS[1], ARGV[1])}
+""")
+
+# the submit script without the board. KEYS and ARGV as the submit, followed by
+# ARGV: previous board score ('' if none), stored board score. data/ingest.py extends it
+SHARDED_FANOUT_LUA = SUBMIT_HEADER_LUA + """
+local previous, stored = ARGV[12], ARGV[13]
+if previous == '' then
+    previous = false
+end
+""" + SUBMIT_FANOUT_LUA
+SHARDED_FANOUT_SCRIPT = r_leaderboard.register_script(SHARDED_FANOUT_LUA + 'return 1')
+
+# returns (fanout script reply, submit_outcome dict). ranks come from ZCOUNTs across the shards
+async def submit_score_sharded(user_id, game_id, score : float, when : datetime,
+                               fanout=SHARDED_FANOUT_SCRIPT, extra_keys=(), extra_args=()):
+    key = leaderboard_key(game_id)
+    policy = await r_leaderboard.hget(GAME_POLICIES_KEY, game_id) or 'latest'
+    previous, stored = await SHARD_BOARD_SCRIPT(keys=[key], args=[user_id, score, policy], client=shard_for(user_id))
+    reply = await fanout(keys=submit_score_keys(user_id, game_id, when) + list(extra_keys),
+                         args=submit_score_args(user_id, game_id, score) + [previous or '', stored] + list(extra_args))
+
+    stored = float(stored)
+    if previous is None:
+        new_rank, = await count_above(key, [stored])
+        old_rank = None
+    else:
+        previous = float(previous)
+        new_rank, old_rank = await count_above(key, [stored, previous])
+        # the user's new score is now one of those above the old one
+        if stored > previous:
+            old_rank -= 1
+    # the fanout script can't see ranks on the shards, so the snapshot is marked dirty here
+    if stored != previous and (new_rank < TOP_SNAPSHOT_SIZE or (old_rank is not None and old_rank < TOP_SNAPSHOT_SIZE)):
+        await r_leaderboard.sadd(TOP_DIRTY_KEY, game_id)
+    return reply, submit_outcome(old_rank, new_rank, stored, policy)
+
+
+## 2.1.2 submit a batch of scores ##
+
+# a lost EXEC reply leaves the caller not knowing whether the transaction ran, and sending it again
+# would add cumulative scores twice. so each record's reply is kept in the batch's hash, and a record
+# found there returns that reply instead of being applied again.
+# KEYS and ARGV as the submit, followed by KEYS: batch results. ARGV: record index, batch results ttl
+BATCH_RESULTS_TTL = 300
+BATCH_SUBMIT_SCRIPT = r_leaderboard.register_script("""
+local applied = redis.call('HGET', KEYS[13], ARGV[12])
+if applied then
+    return cjson.decode(applied)
+end
+""" + SUBMIT_SCORE_LUA + """
+local reply = {old_rank, new_rank, stored, policy}
+redis.call('HSET', KEYS[13], ARGV[12], cjson.encode(reply))
+redis.call('EXPIRE', KEYS[13], ARGV[13])
+return reply
+""")
+
+# do not use directly
+# one submit script per record, in order, all sent in one transaction.
+# policies and the global board need each record's previous score so records can't be merged per game.
+# the batch id is the same on every attempt, so a retried transaction only applies what the last one didn't.
+# records for sharded games are submitted one by one after the transaction.
+# returns one submit_outcome dict or exception per record, in the same order
+async def submit_scores_batch(records, batch_id : str):
+    now = datetime.utcnow()
+    pipeline = r_leaderboard.pipeline()
+    unsharded = [i for i, record in enumerate(records) if not is_sharded(record.game_id)]
+    for i in unsharded:
+        record = records[i]
+        await BATCH_SUBMIT_SCRIPT(keys=submit_score_keys(record.user_id, record.game_id, now) + [batch_results_key(batch_id)],
+                                  args=submit_score_args(record.user_id, record.game_id, record.score) + [i, BATCH_RESULTS_TTL],
+                                  client=pipeline)
+
+    outcomes = [None] * len(records)
+    results = await pipeline.execute(raise_on_error=False) if unsharded else []
+    for i, result in zip(unsharded, results):
+        outcomes[i] = result if isinstance(result, Exception) else submit_outcome(*result)
+
+    for i, record in enumerate(records):
+        if outcomes[i] is None:
+            try:
+                _, outcomes[i] = await submit_score_sharded(record.user_id, record.game_id, record.score, now)
+            except redis.RedisError as e:
+                outcomes[i] = e
+    return outcomes
+
+# to be used
+async def retry_submit_scores_batch(records):
+    return await retry_cache_operation(submit_scores_batch, records, uuid.uuid4().hex)
 
 
 ## 2.2 retrieve user's ranking for a game ##
 
-# retrieves the user's rank and score for a single game
-def retrieve_ranking(user_id: int, game_id:int):
-    rank = r_leaderboard.zrevrank(game_id, user_id) 
-    print('raw rank', rank)
-    score = r_leaderboard.zscore(game_id, user_id)
+# retrieves the user's rank and score for a single game, (None, None) if the user has no score
+# rank, score and policy are read in one pipelined round trip
+async def retrieve_ranking(user_id: int, game_id:int, period : str = 'all_time'):
+    key = board_key(game_id, period)
+    if period == 'all_time' and is_sharded(game_id):
+        rank, score = await shard_rank(key, user_id)
+        policy = await r_leaderboard.hget(GAME_POLICIES_KEY, game_id)
+        return (rank, None if score is None else display_score(policy, score))
+    async def read():
+        pipeline = r_leaderboard.pipeline(transaction=False)
+        pipeline.zrevrank(key, user_id)
+        pipeline.zscore(key, user_id)
+        pipeline.hget(GAME_POLICIES_KEY, game_id)
+        return await pipeline.execute()
+
+    rank, score, policy = await read()
+    if rank is None and await ensure_rollup(game_id, period):
+        rank, score, policy = await read()
+    if rank is None:
+        return (None, None)
     rank_int = int(rank) + 1
-    return (rank_int, score)
+    return (rank_int, display_score(policy, score))
+
+
+## 2.2.1 players around a user ##
+
+# KEYS: board, game policies. ARGV: user id, radius, game id
+# returns {rank (0-based), board size, rank of the first entry, {member, score, ...}, policy}, or nil if the user has no score
+AROUND_SCRIPT = r_leaderboard.register_script("""
+local rank = redis.call('ZREVRANK', KEYS[1], ARGV[1])
+if not rank then
+    return false
+end
+local radius = tonumber(ARGV[2])
+local first = math.max(rank - radius, 0)
+return {rank, redis.call('ZCARD', KEYS[1]), first,
+        redis.call('ZREVRANGE', KEYS[1], first, rank + radius, 'WITHSCORES'),
+        redis.call('HGET', KEYS[2], ARGV[3])}
+""")
 
+# the user and up to radius players either side of them, None if the user has no score.
+# returns {'rank', 'score', 'percentile', 'total_players', 'neighbours': [(rank, user_id, score)]}
+# percentile is the share of players ranked at or below the user, so the leader is at 100
+async def retrieve_neighbourhood(user_id : int, game_id : int, radius : int, period : str = 'all_time'):
+    if period == 'all_time' and is_sharded(game_id):
+        return await retrieve_neighbourhood_sharded(user_id, game_id, radius)
+    keys = [board_key(game_id, period), GAME_POLICIES_KEY]
+    result = await AROUND_SCRIPT(keys=keys, args=[user_id, radius, game_id])
+    if result is None and await ensure_rollup(game_id, period):
+        result = await AROUND_SCRIPT(keys=keys, args=[user_id, radius, game_id])
+    if result is None:
+        return None
 
-## 2.3 retrieve leaders for a game ##
+    rank, total, first, entries, policy = result
+    neighbours = [(first + i // 2 + 1, entries[i], display_score(policy, float(entries[i + 1])))
+                  for i in range(0, len(entries), 2)]
+    score = next(score for _, member, score in neighbours if member == str(user_id))
+    return {'rank': rank + 1, 'score': score, 'percentile': round((total - rank) / total * 100, 2),
+            'total_players': total, 'neighbours': neighbours}
 
-# retrieves the leaderboard for a single game
-def retrieve_leaders(game_id: int, start : int, end : int):
-    return r_leaderboard.zrevrange(game_id, start, end, withscores=True)
+# same result from the shards, players tied with the user are left out of the neighbours
+async def retrieve_neighbourhood_sharded(user_id : int, game_id : int, radius : int):
+    key = leaderboard_key(game_id)
+    rank, score = await shard_rank(key, user_id)
+    if rank is None:
+        return None
+    (above, below), total, policy = await asyncio.gather(shard_window(key, score, radius), shard_size(key),
+                                                         r_leaderboard.hget(GAME_POLICIES_KEY, game_id))
+    neighbours = [(rank - len(above) + i, member, display_score(policy, entry_score))
+                  for i, (member, entry_score) in enumerate(above)]
+    neighbours.append((rank, str(user_id), display_score(policy, score)))
+    neighbours += [(rank + 1 + i, member, display_score(policy, entry_score)) for i, (member, entry_score) in enumerate(below)]
+    return {'rank': rank, 'score': display_score(policy, score), 'percentile': round((total - rank + 1) / total * 100, 2),
+            'total_players': total, 'neighbours': neighbours}
 
 
-# retrieves the leaderboard for a single game
-def retrieve_leaders_no_score(game_id: int, start : int, end : int):
-    return r_leaderboard.zrevrange(game_id, start, end)
+## 2.3 leaderboard page in one round trip ##
 
+# KEYS: board, user names, game names, game policies. ARGV: start, end, game id
+# returns {game name, {{member, score, username}, ...}, policy}, missing names come back as nil
+LEADERBOARD_PAGE_SCRIPT = r_leaderboard.register_script("""
+local entries = redis.call('ZREVRANGE', KEYS[1], ARGV[1], ARGV[2], 'WITHSCORES')
+local members = {}
+for i = 1, #entries, 2 do
+    members[#members + 1] = entries[i]
+end
+local page = {}
+-- hmget in chunks to stay under lua's unpack limit on long pages
+for first = 1, #members, 1000 do
+    local last = math.min(first + 999, #members)
+    local names = redis.call('HMGET', KEYS[2], unpack(members, first, last))
+    for i = first, last do
+        page[#page + 1] = {members[i], entries[2 * i], names[i - first + 1]}
+    end
+end
+return {redis.call('HGET', KEYS[3], ARGV[3]), page, redis.call('HGET', KEYS[4], ARGV[3])}
+""")
+
+# returns (game_name, [(user_id, score, username)]), game_name and usernames are None when not cached
+async def retrieve_leaderboard_page(game_id: int, start : int, end : int, period : str = 'all_time'):
+    if period == 'all_time' and is_sharded(game_id):
+        return await retrieve_leaderboard_page_sharded(game_id, start, end)
+    keys = [board_key(game_id, period), USER_NAMES_KEY, GAME_NAMES_KEY, GAME_POLICIES_KEY]
+    game_name, page, policy = await LEADERBOARD_PAGE_SCRIPT(keys=keys, args=[start, end, game_id])
+    if not page and await ensure_rollup(game_id, period):
+        game_name, page, policy = await LEADERBOARD_PAGE_SCRIPT(keys=keys, args=[start, end, game_id])
+    # names came along with the page, keep them for the single lookups
+    if game_name is not None:
+        game_names_l1.set(str(game_id), game_name)
+    for member, _, username in page:
+        if username is not None:
+            user_names_l1.set(member, username)
+    return game_name, [(member, display_score(policy, float(score)), username) for member, score, username in page]
+
+
+# a sharded page is merged from the shards, the names come from the name caches
+async def retrieve_leaderboard_page_sharded(game_id: int, start : int, end : int):
+    entries = await shard_top(leaderboard_key(game_id), start, end)
+    usernames = await get_multiple_usernames([member for member, _ in entries])
+    game_name = await get_game_cache(game_id)
+    policy = await r_leaderboard.hget(GAME_POLICIES_KEY, game_id)
+    return game_name, [(member, display_score(policy, score), username) for (member, score), username in zip(entries, usernames)]
+
+
+## 2.4 periodic leaderboards ##
+
+# submits fan out to a daily board (see 2.1). a member's weekly and monthly score is the best across the
+# days (zunionstore max, best_low is stored negated) or their sum for cumulative games, rolled up from
+# the daily boards every PERIOD_ROLLUP_INTERVAL seconds. for latest games it is their last submit, which
+# the submit writes to the weekly and monthly boards itself. reading any period is a plain read of one sorted set.
+PERIOD_TTLS = {'daily': config('DAILY_BOARD_TTL', default=32 * 86400, cast=int),
+               'weekly': config('WEEKLY_BOARD_TTL', default=8 * 86400, cast=int),
+               'monthly': config('MONTHLY_BOARD_TTL', default=32 * 86400, cast=int)}
+PERIOD_ROLLUP_INTERVAL = config('PERIOD_ROLLUP_INTERVAL', default=60, cast=float)
+ACTIVE_GAMES_TTL = 2 * 86400
+ROLLUP_LOCK_KEY = 'periods:rollup:lock'
+
+
+# every day of the week or month that contains when
+def period_days(period : str, when : datetime):
+    if period == 'weekly':
+        first = when - timedelta(days=when.weekday())
+        return [first + timedelta(days=i) for i in range(7)]
+    first = when.replace(day=1)
+    days = []
+    while first.month == when.month:
+        days.append(first)
+        first += timedelta(days=1)
+    return days
+
+
+# rebuilds the weekly and monthly boards containing when, for all the games but latest ones, in one pipeline.
+# returns the number of boards rebuilt
+async def rollup_periods(game_ids, when : datetime, periods=('weekly', 'monthly')) -> int:
+    game_ids = list(game_ids)
+    policies = await r_leaderboard.hmget(GAME_POLICIES_KEY, game_ids)
+    pipeline = r_leaderboard.pipeline(transaction=False)
+    rebuilt = 0
+    for game_id, policy in zip(game_ids, policies):
+        if (policy or 'latest') == 'latest':
+            continue
+        for period in periods:
+            daily_keys = [board_key(game_id, 'daily', day) for day in period_days(period, when)]
+            destination = board_key(game_id, period, when)
+            pipeline.zunionstore(destination, daily_keys, aggregate='SUM' if policy == 'cumulative' else 'MAX')
+            pipeline.expire(destination, PERIOD_TTLS[period])
+            rebuilt += 1
+    if rebuilt:
+        await pipeline.execute()
+    return rebuilt
+
+
+# builds a weekly or monthly board that hasn't been rolled up yet. returns True if it did
+async def ensure_rollup(game_id, period : str) -> bool:
+    if period not in ('weekly', 'monthly') or await r_leaderboard.exists(board_key(game_id, period)):
+        return False
+    return await rollup_periods([game_id], datetime.utcnow(), [period]) > 0
+
+
+# runs for the life of the app. the lock lets one worker do each pass.
+# yesterday's games are included so late submits land in the board they belong to.
+async def run_period_rollups():
+    while True:
+        await asyncio.sleep(PERIOD_ROLLUP_INTERVAL)
+        try:
+            # held for most of an interval so the next pass can take it
+            if not await r_leaderboard.set(ROLLUP_LOCK_KEY, 1, nx=True, px=int(PERIOD_ROLLUP_INTERVAL * 900)):
+                continue
+            now = datetime.utcnow()
+            for day in (now - timedelta(days=1), now):
+                game_ids = await r_leaderboard.smembers(active_games_key(day))
+                if game_ids:
+                    await rollup_periods(game_ids, day)
+        except redis.RedisError as e:
+            logger.error(f'Period rollup failed: {e}')
+
+
+## 2.5 global leaderboard ##
+
+# kept up to date by the submit script, so reads are a single sorted set lookup.
+# changing GLOBAL_AGGREGATION or the weights needs python -m data.synchronisation global
+
+# returns [(user_id, score, username)], usernames are None when not cached
+async def retrieve_global_page(start : int, end : int):
+    # the page script with no game, the game name and policy come back as nil
+    _, page, _ = await LEADERBOARD_PAGE_SCRIPT(keys=[GLOBAL_LEADERBOARD_KEY, USER_NAMES_KEY, GAME_NAMES_KEY, GAME_POLICIES_KEY],
+                                               args=[start, end, ''])
+    for member, _, username in page:
+        if username is not None:
+            user_names_l1.set(member, username)
+    return [(member, float(score), username) for member, score, username in page]
+
+# user's global rank and score, (None, None) if the user has no score
+async def retrieve_global_ranking(user_id : int):
+    pipeline = r_leaderboard.pipeline(transaction=False)
+    pipeline.zrevrank(GLOBAL_LEADERBOARD_KEY, user_id)
+    pipeline.zscore(GLOBAL_LEADERBOARD_KEY, user_id)
+    rank, score = await pipeline.execute()
+    if rank is None:
+        return (None, None)
+    return (rank + 1, score)
+
+
+## 2.6 repairs ##
+
+# compare-and-set of board scores found to be wrong by the reconciler (data/synchronisation.py).
+# a member is only set if it still holds the score the reconciler read, so a submit landing in
+# between wins. the global board and indexes are updated as for a submit, period boards are not.
+# a member with no correct score (no postgres row) is removed from the board and its indexes.
+# KEYS: board, global board, game weights, games registry, histogram, game policies, then each member's games set
+# ARGV: game id, aggregation, board key prefix, histogram precision,
+#       then (member, score read or '' if absent, correct score or '' to remove) triples
+REPAIR_SCORES_SCRIPT = r_leaderboard.register_script(GLOBAL_UPDATE_LUA + HISTOGRAM_LUA + """
+local repaired = 0
+local policy = redis.call('HGET', KEYS[6], ARGV[1]) or 'latest'
+for i = 5, #ARGV, 3 do
+    local user, expected, score = ARGV[i], ARGV[i + 1], tonumber(ARGV[i + 2])
+    local user_games = KEYS[6 + (i - 2) / 3]
+    local previous = redis.call('ZSCORE', KEYS[1], user)
+    local unchanged = (not previous and expected == '') or (previous and tonumber(previous) == tonumber(expected))
+    if unchanged and (score or previous) then
+        if score then
+            redis.call('ZADD', KEYS[1], score, user)
+            redis.call('SADD', KEYS[4], ARGV[1])
+            redis.call('SADD', user_games, ARGV[1])
+        else
+            redis.call('ZREM', KEYS[1], user)
+            redis.call('SREM', user_games, ARGV[1])
+        end
+        update_global(KEYS[2], KEYS[3], KEYS[6], user_games, ARGV[3], ARGV[2], user, ARGV[1], policy, previous, score)
+        update_histogram(KEYS[5], ARGV[4], previous, score)
+        repaired = repaired + 1
+    end
+end
+return repaired
+""")
+
+# repair triple -> script arguments, None is sent as ''
+def repair_args(user_id, current, correct):
+    return [user_id, '' if current is None else repr(current), '' if correct is None else repr(correct)]
+
+# repairs is [(user_id, score read from the board or None, correct board score or None to remove)],
+# returns how many were set or removed
+async def repair_scores(game_id : int, repairs) -> int:
+    keys = [leaderboard_key(game_id), GLOBAL_LEADERBOARD_KEY, GAME_WEIGHTS_KEY, GAMES_REGISTRY_KEY, histogram_key(game_id), GAME_POLICIES_KEY]
+    args = [game_id, GLOBAL_AGGREGATION, leaderboard_key(''), histogram_precision(game_id)]
+    for user_id, current, correct in repairs:
+        keys.append(user_games_key(user_id))
+        args += repair_args(user_id, current, correct)
+    repaired = await REPAIR_SCORES_SCRIPT(keys=keys, args=args)
+    if repaired:
+        await r_leaderboard.sadd(TOP_DIRTY_KEY, game_id)
+    return repaired
+
+# the same compare-and-set on a daily board. other policies roll their weekly and monthly boards up from it,
+# but the submit writes latest games' period boards itself, so their repaired members are set there again
+# from the newest daily board of the period they are on.
+# KEYS: daily board, the day's active games, game policies, weekly board, monthly board, then the daily boards
+#       of the week and of the month, newest first
+# ARGV: game id, daily ttl, active games ttl, weekly ttl, monthly ttl, days in the week, then triples as above
+REPAIR_DAILY_SCRIPT = r_leaderboard.register_script("""
+local repaired = {}
+for i = 7, #ARGV, 3 do
+    local user, expected, score = ARGV[i], ARGV[i + 1], ARGV[i + 2]
+    local previous = redis.call('ZSCORE', KEYS[1], user)
+    if (not previous and expected == '') or (previous and tonumber(previous) == tonumber(expected)) then
+        if score ~= '' then
+            redis.call('ZADD', KEYS[1], score, user)
+            repaired[#repaired + 1] = user
+        elseif previous then
+            redis.call('ZREM', KEYS[1], user)
+            repaired[#repaired + 1] = user
+        end
+    end
+end
+if #repaired == 0 then
+    return 0
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+
+local function set_latest(period, ttl, first, last)
+    for _, user in ipairs(repaired) do
+        local latest = false
+        for k = first, last do
+            latest = redis.call('ZSCORE', KEYS[k], user)
+            if latest then
+                break
+            end
+        end
+        if latest then
+            redis.call('ZADD', period, latest, user)
+        else
+            redis.call('ZREM', period, user)
+        end
+    end
+    redis.call('EXPIRE', period, ttl)
+end
+
+if (redis.call('HGET', KEYS[3], ARGV[1]) or 'latest') == 'latest' then
+    local week_days = tonumber(ARGV[6])
+    set_latest(KEYS[4], ARGV[4], 6, 5 + week_days)
+    set_latest(KEYS[5], ARGV[5], 6 + week_days, #KEYS)
+end
+return #repaired
+""")
+
+async def repair_daily_scores(game_id : int, day : datetime, repairs) -> int:
+    week, month = ([board_key(game_id, 'daily', other) for other in period_days(period, day)[::-1]] for period in ('weekly', 'monthly'))
+    keys = [board_key(game_id, 'daily', day), active_games_key(day), GAME_POLICIES_KEY,
+            board_key(game_id, 'weekly', day), board_key(game_id, 'monthly', day)] + week + month
+    args = [game_id, PERIOD_TTLS['daily'], ACTIVE_GAMES_TTL, PERIOD_TTLS['weekly'], PERIOD_TTLS['monthly'], len(week)]
+    for user_id, current, correct in repairs:
+        args += repair_args(user_id, current, correct)
+    return await REPAIR_DAILY_SCRIPT(keys=keys, args=args)
+
+
+## 2.6.1 submits held back while redis is unavailable ##
+
+# scores saved in postgres while the main redis or a shard was unreachable, as
+# (user_id, game_id, score, date_added), oldest first. once a breaker closes their boards are set
+# from postgres, see data/synchronisation.py 5.4. a submit dropped from a full buffer or lost with
+# the worker is not replayed, only a reconciler pass or a rebuild puts its board right
+REPLAY_BUFFER_SIZE = config('REPLAY_BUFFER_SIZE', default=10000, cast=int)
+replay_buffer = deque(maxlen=REPLAY_BUFFER_SIZE)
+replay_stats = {'buffered': 0, 'replayed': 0, 'dropped': 0}
+
+def buffer_submit(user_id : int, game_id : int, score : float, date_added : datetime):
+    if len(replay_buffer) == replay_buffer.maxlen:
+        replay_stats['dropped'] += 1
+    replay_buffer.append((user_id, game_id, score, date_added))
+    replay_stats['buffered'] += 1
+
+def replay_info() -> dict:
+    return {'pending': len(replay_buffer), 'max_size': REPLAY_BUFFER_SIZE, **replay_stats}
+
+
+## 2.7 approximate rank from a score histogram ##
+
+# for games in HISTOGRAM_GAMES ('*' for all) the submit script also counts the all-time board's members
+# per score bucket. buckets grow geometrically by 1 + HISTOGRAM_PRECISION, so a few hundred cover any range
+# and a rank read from them is off by at most the players in the user's bucket, whose scores are all
+# within HISTOGRAM_PRECISION of the user's. games added to the list need python -m data.synchronisation histograms
+HISTOGRAM_GAMES = config('HISTOGRAM_GAMES', default='', cast=Csv())
+HISTOGRAM_PRECISION = config('HISTOGRAM_PRECISION', default=0.05, cast=float)
+
+# the histogram of a game is read once per worker per ttl, however many players ask
+histograms_l1 = LocalCache('histograms', maxsize=config('HISTOGRAM_CACHE_SIZE', default=1000, cast=int),
+                           ttl=config('HISTOGRAM_CACHE_TTL', default=5, cast=float))
+
+
+def histogram_enabled(game_id) -> bool:
+    return '*' in HISTOGRAM_GAMES or str(game_id) in HISTOGRAM_GAMES
+
+# the precision passed to the lua scripts, '' turns the histogram off for the game
+def histogram_precision(game_id) -> str:
+    return repr(HISTOGRAM_PRECISION) if histogram_enabled(game_id) else ''
+
+# same bucket as histogram_bucket in HISTOGRAM_LUA
+def bucket_of(score : float) -> str:
+    if score == 0:
+        return '0'
+    sign = 'p' if score > 0 else 'n'
+    return f'{sign}{math.floor(math.log(abs(score)) / math.log(1 + HISTOGRAM_PRECISION))}'
+
+# (lowest, highest) board score of a bucket
+def bucket_bounds(bucket : str):
+    if bucket == '0':
+        return (0.0, 0.0)
+    base, exponent = 1 + HISTOGRAM_PRECISION, int(bucket[1:])
+    if bucket[0] == 'p':
+        return (base ** exponent, base ** (exponent + 1))
+    return (-base ** (exponent + 1), -base ** exponent)
+
+# ({bucket: members}, policy) of a game, from the local cache when fresh
+async def get_histogram(game_id):
+    cached = histograms_l1.get(str(game_id))
+    if cached is not None:
+        return cached
+    pipeline = r_leaderboard.pipeline(transaction=False)
+    pipeline.hgetall(histogram_key(game_id))
+    pipeline.hget(GAME_POLICIES_KEY, game_id)
+    counts, policy = await pipeline.execute()
+    cached = ({bucket: int(count) for bucket, count in counts.items()}, policy)
+    histograms_l1.set(str(game_id), cached)
+    return cached
+
+# approximate all-time rank of a user, None if the user has no score.
+# the only board read is the user's ZSCORE, everything else comes from the cached histogram.
+# rank assumes the players in the user's bucket are spread evenly over it, the true rank is
+# between rank_min and rank_max as of the cached histogram
+async def approximate_ranking(user_id : int, game_id : int):
+    key = leaderboard_key(game_id)
+    client = shard_for(user_id) if is_sharded(game_id) else r_leaderboard
+    score, (counts, policy) = await asyncio.gather(client.zscore(key, user_id), get_histogram(game_id))
+    if score is None:
+        return None
+
+    bucket = bucket_of(score)
+    low, high = bucket_bounds(bucket)
+    above = sum(count for other, count in counts.items() if bucket_bounds(other)[0] > low)
+    # the cached histogram can be older than the score
+    in_bucket = max(counts.get(bucket, 0), 1)
+    total = max(sum(counts.values()), above + in_bucket)
+    share_above = min(max((high - score) / (high - low), 0.0), 1.0) if high > low else 0.0
+
+    rank = above + 1 + round(share_above * (in_bucket - 1))
+    return {'rank': rank, 'rank_min': above + 1, 'rank_max': above + in_bucket,
+            'score': display_score(policy, score), 'percentile': round((total - rank + 1) / total * 100, 2),
+            'total_players': total}
+
+# [(lowest score, highest score, members)] best first, in the game's displayed scores
+async def score_distribution(game_id : int):
+    counts, policy = await get_histogram(game_id)
+    buckets = sorted(((bucket_bounds(bucket), count) for bucket, count in counts.items()), reverse=True)
+    if policy == 'best_low':
+        return [(-high, -low, count) for (low, high), count in buckets]
+    return [(low, high, count) for (low, high), count in buckets]
 
 
 ### 3. CACHE for id to name lookup - game and user_id ###
@@ -93,81 +906,190 @@ def retrieve_leaders_no_score(game_id: int, start : int, end : int):
 
 ## 3.1 helper functions ##
 
-# base functions for setting cache
-def set_user_cache(username : str, id : str):
-    return r_user.set(id, username)
+# base functions for setting cache, other workers are told to drop their copy
+async def set_user_cache(username : str, id : str):
+    user_names_l1.invalidate(str(id))
+    pipeline = r_leaderboard.pipeline()
+    pipeline.hset(USER_NAMES_KEY, id, username)
+    pipeline.publish(CACHE_INVALIDATION_CHANNEL, f'user:{id}')
+    return (await pipeline.execute())[0]
 
-def set_game_cache(game_name : str, id : str):
-    return r_game.set(id, game_name)
+async def set_game_cache(game_name : str, id : str):
+    game_names_l1.invalidate(str(id))
+    pipeline = r_leaderboard.pipeline()
+    pipeline.hset(GAME_NAMES_KEY, id, game_name)
+    pipeline.sadd(GAMES_REGISTRY_KEY, id)
+    pipeline.publish(CACHE_INVALIDATION_CHANNEL, f'game:{id}')
+    return (await pipeline.execute())[0]
+
+# after a user's status or role changed, nothing is written to redis
+async def invalidate_principal(email : str):
+    principals_l1.invalidate(email)
+    return await r_leaderboard.publish(CACHE_INVALIDATION_CHANNEL, f'principal:{email}')
+
+# policies are read by the submit script, so they live in redis next to the names
+async def set_game_policy(policy : str, id : str):
+    return await r_leaderboard.hset(GAME_POLICIES_KEY, id, policy)
 
 
 
 ## 3.2 set and get functions for cache ##
 
-def retry_set_user_cache(username : str, id : str):
-    retry_cache_operation(set_user_cache, username, id)
+async def retry_set_user_cache(username : str, id : str):
+    await retry_cache_operation(set_user_cache, username, id)
+
+async def retry_set_game_cache(game_name : str, id : str):
+    await retry_cache_operation(set_game_cache, game_name, id)
 
-def retry_set_game_cache(game_name : str, id : str):
-    retry_cache_operation(set_game_cache, game_name, id)
+async def retry_set_game_policy(policy : str, id : str):
+    await retry_cache_operation(set_game_policy, policy, id)
 
-def get_user_cache(id : str):
-    return r_user.get(id)
+async def retry_invalidate_principal(email : str):
+    await retry_cache_operation(invalidate_principal, email)
 
-def get_game_cache(id : str):
-    return r_game.get(id)
+# the get functions check the in-process cache first and fill it from redis
+async def get_user_cache(id : str):
+    username = user_names_l1.get(str(id))
+    if username is None:
+        username = await r_leaderboard.hget(USER_NAMES_KEY, id)
+        inc('redis_cache_lookups_total', cache=user_names_l1.name, result='miss' if username is None else 'hit')
+        if username is not None:
+            user_names_l1.set(str(id), username)
+    return username
 
-def get_multiple_usernames(list_user_ids):
-    pipeline = r_user.pipeline()
+async def get_game_cache(id : str):
+    game_name = game_names_l1.get(str(id))
+    if game_name is None:
+        game_name = await r_leaderboard.hget(GAME_NAMES_KEY, id)
+        inc('redis_cache_lookups_total', cache=game_names_l1.name, result='miss' if game_name is None else 'hit')
+        if game_name is not None:
+            game_names_l1.set(str(id), game_name)
+    return game_name
 
-    for key in list_user_ids:
-        pipeline.get(key)
+# names in the same order as the ids, None where the id is not cached.
+# only the ids missing locally go to redis, in a single hmget
+async def get_multiple_names(local_cache : LocalCache, hash_key : str, list_ids):
+    names = [local_cache.get(str(id)) for id in list_ids]
+    missing = [str(id) for id, name in zip(list_ids, names) if name is None]
+    if not missing:
+        return names
 
-    results = pipeline.execute()
-    return results
+    found = dict(zip(missing, await r_leaderboard.hmget(hash_key, missing)))
+    for id, name in found.items():
+        if name is not None:
+            local_cache.set(id, name)
+    hits = sum(1 for name in found.values() if name is not None)
+    inc('redis_cache_lookups_total', hits, cache=local_cache.name, result='hit')
+    inc('redis_cache_lookups_total', len(found) - hits, cache=local_cache.name, result='miss')
+    return [name if name is not None else found.get(str(id)) for id, name in zip(list_ids, names)]
 
+async def get_multiple_usernames(list_user_ids):
+    return await get_multiple_names(user_names_l1, USER_NAMES_KEY, list_user_ids)
 
-def add_multiple_usernames(list_user_data):
-    pipeline = r_user.pipeline()
+async def get_multiple_game_names(list_game_ids):
+    return await get_multiple_names(game_names_l1, GAME_NAMES_KEY, list_game_ids)
 
-    for item in list_user_data:
-        pipeline.set(item[0], item[1])
-        
-    results = pipeline.execute()
-    return results
 
+# list_user_data is [(id, username)], used to fill the cache from postgres
+async def add_multiple_usernames(list_user_data):
+    if not list_user_data:
+        return 0
+    for id, username in list_user_data:
+        user_names_l1.set(str(id), username)
+    return await r_leaderboard.hset(USER_NAMES_KEY, mapping=dict(list_user_data))
 
-# 4.0 get users ranking for all games
-def user_data_all_games(user_id : int):
-    pass
-    # get all game ids from redis
-    cursor = 0
-    game_keys = []
 
+## 3.3 invalidation across workers ##
+
+# runs for the life of the app. if the subscription drops, messages may have been missed
+# so the local caches are cleared before subscribing again
+async def listen_for_invalidations():
+    local_caches = {'user': user_names_l1, 'game': game_names_l1, 'principal': principals_l1}
     while True:
-        cursor, keys = r_leaderboard.scan(cursor, match='*', count=1000, _type='zset')
-        game_keys.extend(keys)
-        if cursor == 0:
-            break
-    
-    # return None if no game keys found in redis
-    if game_keys == []:
-        logger.warning(f"No game id keys found in redis. User concerned is {user_id}")
-        return None 
-    
-    # create a pipeline to retrieve the user's rankings
-    pipeline = r_leaderboard.pipeline()
+        pubsub = r_leaderboard.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+            async for message in pubsub.listen():
+                kind, _, id = message['data'].partition(':')
+                if kind in local_caches:
+                    local_caches[kind].invalidate(id)
+        except asyncio.CancelledError:
+            raise
+        except redis.RedisError as e:
+            logger.error(f'Cache invalidation subscription lost: {e}')
+            for local_cache in local_caches.values():
+                local_cache.clear()
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
 
-    for key in game_keys:
-        pipeline.zrevrank(key, user_id)
 
-    results = pipeline.execute()
+## 3.4 public player profiles ##
+
+# read by the top players report. profiles only change when a user registers,
+# so they are written once and expire when the player stops showing up in reports
+PROFILE_FIELDS = ('username', 'country', 'date_joined')
+PROFILE_TTL = config('PROFILE_TTL', default=7 * 86400, cast=int)
+
+# profiles is [(id, username, country, date_joined)], e.g. rows read from postgres
+async def add_user_profiles(profiles):
+    if not profiles:
+        return 0
+    pipeline = r_leaderboard.pipeline(transaction=False)
+    for id, username, country, date_joined in profiles:
+        pipeline.hset(user_profile_key(id), mapping={'username': username, 'country': country,
+                                                     'date_joined': date_joined.isoformat()})
+        pipeline.expire(user_profile_key(id), PROFILE_TTL)
+    await pipeline.execute()
+    return len(profiles)
+
+async def retry_add_user_profiles(profiles):
+    await retry_cache_operation(add_user_profiles, profiles)
+
+# profile dicts in the same order as the ids, None where the profile is not cached.
+# one hmget per id, all sent in a single round trip
+async def get_user_profiles(list_user_ids):
+    if not list_user_ids:
+        return []
+    pipeline = r_leaderboard.pipeline(transaction=False)
+    for id in list_user_ids:
+        pipeline.hmget(user_profile_key(id), PROFILE_FIELDS)
+    return [dict(zip(PROFILE_FIELDS, values)) if values[0] is not None else None for values in await pipeline.execute()]
+
+
+def cache_stats():
+    return {cache.name: cache.stats() for cache in (user_names_l1, game_names_l1, principals_l1, histograms_l1)}
+
 
-    # need to add 1 to get in ordinal complaint format 
-    results_adjusted = [result + 1 for result in results if result is not None]
+# 4.0 get users ranking for all games
 
-    user_rankings = {key : result for (key, result) in zip(game_keys, results_adjusted)}
+# KEYS: the user's games set, game policies. ARGV: user id, board key prefix.
+# only the games the user has played are visited. board keys are built from the prefix,
+# which is fine on a single redis but would need hash tags on a cluster.
+# returns {{game id, rank (1-based), score, policy}, ...}
+USER_RANKINGS_SCRIPT = r_leaderboard.register_script("""
+local result = {}
+for _, game_id in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    local board = ARGV[2] .. game_id
+    local rank = redis.call('ZREVRANK', board, ARGV[1])
+    if rank then
+        result[#result + 1] = {game_id, rank + 1, redis.call('ZSCORE', board, ARGV[1]), redis.call('HGET', KEYS[2], game_id)}
+    end
+end
+return result
+""")
 
-    return user_rankings
+# returns [(game_id, rank, score)] for every game the user has a score in, in one round trip.
+# sharded games aren't on the main redis, the script skips them and they are ranked across the shards
+async def user_data_all_games(user_id : int):
+    results = await USER_RANKINGS_SCRIPT(keys=[user_games_key(user_id), GAME_POLICIES_KEY], args=[user_id, leaderboard_key('')])
+    rankings = [(int(game_id), rank, display_score(policy, float(score))) for game_id, rank, score, policy in results]
+    for game_id in SHARDED_GAMES if shards else ():
+        if await r_leaderboard.sismember(user_games_key(user_id), game_id):
+            rank, score = await retrieve_ranking(user_id, game_id)
+            if rank is not None:
+                rankings.append((game_id, rank, score))
+    return rankings
 
 
 # 5.0 get leaders for a game
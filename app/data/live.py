@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from decouple import config
+from redis import asyncio as aioredis
+from data.leaderboard import r_leaderboard, retrieve_leaderboard_page, events_channel
+
+
+### 0. Initialization ###
+
+
+## 0.1 logger ##
+
+logger = logging.getLogger(__name__)
+
+
+## 0.2 settings ##
+
+# viewers get at most one message per tick, holding every change to their range since the last one
+LIVE_TICK = config('LIVE_TICK', default=1.0, cast=float)
+
+# messages waiting for a slow viewer. once full, its changes build up until it has room again
+LIVE_QUEUE_SIZE = config('LIVE_QUEUE_SIZE', default=4, cast=int)
+
+
+## 0.3 state of this worker ##
+
+# game id -> set of Viewer
+viewers = {}
+
+# game id -> fan-out task, one per game with viewers on this worker
+feeds = {}
+
+
+class Viewer:
+    def __init__(self, start : int, end : int):
+        self.start = start
+        self.end = end
+        self.queue = asyncio.Queue(maxsize=LIVE_QUEUE_SIZE)
+        # rank -> [username, score] as last sent to this viewer, None until the first message
+        self.sent = None
+        # skipped on a full queue, so what it was last sent may be out of date
+        self.behind = False
+
+
+### 1. SUBSCRIPTIONS ###
+
+
+# the viewer's first message is its whole range, then only the ranks that changed
+def subscribe(game_id : int, start : int, end : int) -> Viewer:
+    viewer = Viewer(start, end)
+    viewers.setdefault(game_id, set()).add(viewer)
+    if game_id not in feeds:
+        feeds[game_id] = asyncio.create_task(run_feed(game_id))
+    return viewer
+
+# the game's feed stops with its last viewer
+def unsubscribe(game_id : int, viewer : Viewer):
+    game_viewers = viewers.get(game_id, set())
+    game_viewers.discard(viewer)
+    if not game_viewers:
+        viewers.pop(game_id, None)
+        feed = feeds.pop(game_id, None)
+        if feed is not None:
+            feed.cancel()
+
+
+### 2. FAN-OUT ###
+
+
+## 2.1 changes to one viewer's range ##
+
+# {'changed': [{rank, username, score}], 'removed': [rank]} against what the viewer was last sent, None if nothing changed
+def viewer_diff(viewer : Viewer, board : dict):
+    current = {rank: entry for rank, entry in board.items() if viewer.start < rank <= viewer.end + 1}
+    sent = viewer.sent or {}
+    changed = [{'rank': rank, 'username': username, 'score': score}
+               for rank, (username, score) in current.items() if sent.get(rank) != [username, score]]
+    removed = [rank for rank in sent if rank not in current]
+    if viewer.sent is not None and not changed and not removed:
+        return None
+    viewer.sent = current
+    return {'changed': changed, 'removed': removed}
+
+# a viewer with a full queue is skipped and marked behind, its next diff covers this tick too
+def push(viewer : Viewer, board : dict):
+    if viewer.queue.full():
+        viewer.behind = True
+        return
+    viewer.behind = False
+    diff = viewer_diff(viewer, board)
+    if diff is not None:
+        viewer.queue.put_nowait(diff)
+
+
+## 2.2 one task per game ##
+
+# every tick with submits announced on the game's channel, the widest range any viewer watches
+# is read once and diffed for each viewer. ticks with new viewers, or after a lost subscription, read too.
+# on quiet ticks, viewers left behind with room in their queue again are sent the last board read
+async def run_feed(game_id : int):
+    dirty = True
+    board = None
+    while True:
+        pubsub = r_leaderboard.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(events_channel(game_id))
+            while True:
+                while await pubsub.get_message(timeout=0) is not None:
+                    dirty = True
+                game_viewers = list(viewers.get(game_id, ()))
+                if game_viewers and (dirty or any(viewer.sent is None for viewer in game_viewers)):
+                    dirty = False
+                    _, page = await retrieve_leaderboard_page(game_id, 0, max(viewer.end for viewer in game_viewers))
+                    board = {rank: [username or user_id, score] for rank, (user_id, score, username) in enumerate(page, start=1)}
+                    for viewer in game_viewers:
+                        push(viewer, board)
+                elif board is not None:
+                    for viewer in game_viewers:
+                        if viewer.behind and not viewer.queue.full():
+                            push(viewer, board)
+                await asyncio.sleep(LIVE_TICK)
+        except asyncio.CancelledError:
+            raise
+        except aioredis.RedisError as e:
+            logger.error(f'Live feed of game {game_id} lost: {e}')
+            dirty = True
+            await asyncio.sleep(LIVE_TICK)
+        finally:
+            await pubsub.aclose()
+
+
+def live_stats():
+    return {'games': len(feeds), 'viewers': sum(len(game_viewers) for game_viewers in viewers.values())}
@@ -2,26 +2,22 @@ from api.database import SessionDep
 import logging
 from typing import List 
 from sqlmodel import select
-from api.models import User
+from sqlalchemy import insert, tuple_
+import base64
+from datetime import datetime
+from api.models import User, Score
 
 
 ## 0.1 logger ##
 
-logging.basicConfig(level=logging.INFO,
-                    format="%(asctime)s - %(levelname)s - %(message)s",
-                    handlers=[
-        logging.StreamHandler(),  # Logs to console
-        logging.FileHandler("postgres.log")  # Logs to file
-    ])
-
 logger = logging.getLogger(__name__)
 
 
 ## 0.1 lookup various users from postgres
-def retrieve_multiple_usernames_pg(list_of_ids : List[str], session):
+async def retrieve_multiple_usernames_pg(list_of_ids : List[str], session):
     # get data from postgres
     try:
-        data = session.exec(select(User).where(User.id.in_(list_of_ids))).all()
+        data = (await session.exec(select(User).where(User.id.in_(list_of_ids)))).all()
     except Exception as e:
         logger.error(f"Failure to read data from db: {e} for users: {list_of_ids}")
         return None
@@ -41,29 +37,72 @@ def retrieve_multiple_usernames_pg(list_of_ids : List[str], session):
     return data
 
 
-# take list of leaders [ids] and return dict with {rank : {username: (username), country: (country), date joined : (date)} 
-def get_player_info(leaders : List[str], session : SessionDep):
-    
-    # get the postgres data
-    leaders_data = retrieve_multiple_usernames_pg(leaders, session)
-
-    # return if no data
-    if leaders_data == None:
+## 0.1.1 public profiles of various users
+# only the columns the top players report shows, the password hash and email stay in postgres.
+# returns [(id, username, country, date_added)], None on failure
+async def retrieve_player_profiles_pg(list_of_ids : List[int], session):
+    try:
+        return (await session.exec(select(User.id, User.username, User.country, User.date_added)
+                                   .where(User.id.in_(list_of_ids)))).all()
+    except Exception as e:
+        logger.error(f"Failure to read profiles from db: {e} for users: {list_of_ids}")
         return None
-    
-    # prepare leaders_data
-    data_to_include= {'username', 'country', 'date_added'}
 
-    cleaned_leaders_data = {str(leader.id) : {key: getattr(leader, key) for key in data_to_include} for leader in leaders_data}
-    print(leaders)
-    print('clean data', cleaned_leaders_data)
 
-    # add ranks and map data to the correct position as in the ordered redis list
-    ordered_leaders_data =  [
-    {"rank": f"Player #{i + 1}", **cleaned_leaders_data[str(user_id)]}
-    for i, user_id in enumerate(leaders)
-    ]
+## 0.2 ids from a list that exist in the table for model
+async def existing_ids(model, list_of_ids, session : SessionDep) -> set:
+    if not list_of_ids:
+        return set()
+    return set((await session.exec(select(model.id).where(model.id.in_(list_of_ids)))).all())
+
+
+## 0.3 insert many scores with a multi-row insert
+# records need user_id, game_id and score, date_added is kept if the records carry one.
+# returns [(id, date_added)] in the same order as records
+async def bulk_insert_scores(records, session : SessionDep):
+    if not records:
+        return []
+    rows = []
+    for record in records:
+        row = {'user_id': record.user_id, 'game_id': record.game_id, 'score': record.score}
+        if getattr(record, 'date_added', None) is not None:
+            row['date_added'] = record.date_added
+        rows.append(row)
+    statement = insert(Score).returning(Score.id, Score.date_added, sort_by_parameter_order=True)
+    result = await session.execute(statement, rows)
+    inserted = [(row.id, row.date_added) for row in result]
+    await session.commit()
+    return inserted
+
+
+## 0.4 score history, newest first, a page at a time
+# the cursor is the (date_added, id) of the last row of the previous page, so a page deep into
+# the history costs the same as the first one given an index ending in (date_added, id)
+
+def encode_cursor(date_added : datetime, id : int) -> str:
+    return base64.urlsafe_b64encode(f'{date_added.isoformat()}|{id}'.encode()).decode()
 
-    return ordered_leaders_data
+# raises ValueError for a cursor that wasn't made by encode_cursor
+def decode_cursor(cursor : str):
+    date_added, id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(date_added), int(id)
 
+# conditions on Score, e.g. Score.user_id == 1. since is inclusive and until exclusive.
+# returns (rows of columns, cursor of the next page or None)
+async def score_history(session : SessionDep, columns, conditions, since : datetime | None, until : datetime | None,
+                        cursor : str | None, limit : int):
+    statement = select(*columns).where(*conditions)
+    if since is not None:
+        statement = statement.where(Score.date_added >= since)
+    if until is not None:
+        statement = statement.where(Score.date_added < until)
+    if cursor is not None:
+        statement = statement.where(tuple_(Score.date_added, Score.id) < tuple_(*decode_cursor(cursor)))
+    statement = statement.order_by(Score.date_added.desc(), Score.id.desc()).limit(limit + 1)
 
+    rows = (await session.exec(statement)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].date_added, rows[-1].id)
+    return rows, next_cursor
@@ -0,0 +1,78 @@
+import asyncio
+import heapq
+import zlib
+from redis import asyncio as aioredis
+from decouple import config, Csv
+from api.metrics import instrument_redis
+from data.breaker import protect
+
+
+### 0. Initialization ###
+
+# optional sharded mode for games too big for one redis. the board of a game in SHARDED_GAMES is
+# split by member across the REDIS_SHARD_URLS nodes, under the same key on each one.
+# everything else (names, indexes, period and global boards) stays on the main redis.
+REDIS_SHARD_URLS = config('REDIS_SHARD_URLS', default='', cast=Csv())
+SHARDED_GAMES = set(config('SHARDED_GAMES', default='', cast=Csv(int)))
+
+shards = [protect(instrument_redis(aioredis.from_url(url, decode_responses=True)), f'shard-{i}') for i, url in enumerate(REDIS_SHARD_URLS)]
+
+
+def is_sharded(game_id) -> bool:
+    return bool(shards) and int(game_id) in SHARDED_GAMES
+
+# a member always lives on the same shard, so the shard list must not be reordered once in use
+def shard_for(user_id):
+    return shards[zlib.crc32(str(user_id).encode()) % len(shards)]
+
+
+### 1. SCATTER-GATHER READS ###
+
+# every shard is asked in parallel, each answer is then merged here
+
+
+## 1.1 top of the board ##
+
+# k-way merge of each shard's top end + 1, so a page costs (end + 1) entries per shard.
+# returns [(member, score)] best first, like zrevrange withscores
+async def shard_top(key : str, start : int, end : int):
+    pages = await asyncio.gather(*[shard.zrevrange(key, 0, end, withscores=True) for shard in shards])
+    merged = heapq.merge(*pages, key=lambda entry: entry[1], reverse=True)
+    return [entry for _, entry in zip(range(end + 1), merged)][start:]
+
+
+## 1.2 rank ##
+
+# members above each score across all shards, one pipeline per shard
+async def count_above(key : str, scores):
+    async def counts(shard):
+        pipeline = shard.pipeline(transaction=False)
+        for score in scores:
+            pipeline.zcount(key, f'({score!r}', '+inf')
+        return await pipeline.execute()
+    return [sum(column) for column in zip(*await asyncio.gather(*[counts(shard) for shard in shards]))]
+
+# (rank (1-based), score) or (None, None). players tied with the user share their rank
+async def shard_rank(key : str, user_id):
+    score = await shard_for(user_id).zscore(key, user_id)
+    if score is None:
+        return (None, None)
+    above, = await count_above(key, [score])
+    return (above + 1, score)
+
+async def shard_size(key : str) -> int:
+    return sum(await asyncio.gather(*[shard.zcard(key) for shard in shards]))
+
+
+## 1.3 players around a score ##
+
+# up to radius members just above and just below score, best first.
+# other players tied on exactly that score are left out
+async def shard_window(key : str, score : float, radius : int):
+    above = await asyncio.gather(*[shard.zrangebyscore(key, f'({score!r}', '+inf', start=0, num=radius, withscores=True)
+                                   for shard in shards])
+    below = await asyncio.gather(*[shard.zrevrangebyscore(key, f'({score!r}', '-inf', start=0, num=radius, withscores=True)
+                                   for shard in shards])
+    nearest_above = list(heapq.merge(*above, key=lambda entry: entry[1]))[:radius]
+    nearest_below = list(heapq.merge(*below, key=lambda entry: entry[1], reverse=True))[:radius]
+    return nearest_above[::-1], nearest_below
@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from decouple import config
+from redis import asyncio as aioredis
+from sqlmodel.ext.asyncio.session import AsyncSession
+from api.database import read_engine
+from api.models import Game
+from data.local_cache import LocalCache
+from data.postgres import retrieve_multiple_usernames_pg
+from data.leaderboard import r_leaderboard, retrieve_leaderboard_page, top_snapshot_key, top_version_key, TOP_DIRTY_KEY, TOP_SNAPSHOT_SIZE, GAMES_REGISTRY_KEY
+
+
+### 0. Initialization ###
+
+
+## 0.1 logger ##
+
+logger = logging.getLogger(__name__)
+
+
+## 0.2 settings ##
+
+# the top TOP_SNAPSHOT_SIZE entries of each board are kept ready to serve in leaderboard:{game_id}:top.
+# submits only mark a game dirty, its snapshot is rebuilt once per tick however many submits came in
+SNAPSHOT_INTERVAL = config('SNAPSHOT_INTERVAL', default=1.0, cast=float)
+
+# most dirty games rebuilt by one worker in a tick, the rest wait for the next one
+SNAPSHOT_BATCH = config('SNAPSHOT_BATCH', default=100, cast=int)
+
+# each worker holds the snapshots for a tick, and the pages rendered from them until the version changes
+snapshots_l1 = LocalCache('snapshots', maxsize=config('SNAPSHOT_CACHE_SIZE', default=1000, cast=int), ttl=SNAPSHOT_INTERVAL)
+pages_l1 = LocalCache('snapshot_pages', maxsize=config('SNAPSHOT_PAGE_CACHE_SIZE', default=10000, cast=int), ttl=3600)
+
+# the last snapshot each worker read of a game, served marked stale while redis is unavailable
+stale_l1 = LocalCache('stale_snapshots', maxsize=config('SNAPSHOT_CACHE_SIZE', default=1000, cast=int),
+                      ttl=config('STALE_SNAPSHOT_TTL', default=3600, cast=float))
+
+
+### 1. BUILD ###
+
+
+# KEYS: snapshot. ARGV: version, data. a build that started earlier than the stored one is dropped
+STORE_SNAPSHOT_SCRIPT = r_leaderboard.register_script("""
+if tonumber(redis.call('HGET', KEYS[1], 'version') or '0') >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'version', ARGV[1], 'data', ARGV[2])
+return 1
+""")
+
+
+## 1.1 one game ##
+
+# the version is taken before the board is read, so a higher version always holds a later read.
+# ids not in the games registry are skipped, returns None for them
+async def build_snapshot(game_id, session : AsyncSession) -> int | None:
+    if not await r_leaderboard.sismember(GAMES_REGISTRY_KEY, game_id):
+        return None
+    version = await r_leaderboard.incr(top_version_key(game_id))
+    game_name, page = await retrieve_leaderboard_page(game_id, 0, TOP_SNAPSHOT_SIZE - 1)
+
+    # names missing from the cache are read from postgres, as for a live page
+    missing_ids = [user_id for user_id, _, username in page if username is None]
+    found_usernames = {}
+    if missing_ids:
+        users = await retrieve_multiple_usernames_pg(missing_ids, session) or []
+        found_usernames = {str(user.id): user.username for user in users}
+    if game_name is None:
+        game = await session.get(Game, int(game_id))
+        game_name = game.name if game else str(game_id)
+
+    data = json.dumps({'game': game_name,
+                       'entries': [[username or found_usernames.get(user_id, user_id), score] for user_id, score, username in page]})
+    await STORE_SNAPSHOT_SCRIPT(keys=[top_snapshot_key(game_id)], args=[version, data])
+    return version
+
+
+## 1.2 every dirty game, once per tick ##
+
+# SPOP hands each dirty game to one worker. a game that fails goes back in the set for the next tick
+async def build_dirty_snapshots() -> int:
+    game_ids = await r_leaderboard.spop(TOP_DIRTY_KEY, SNAPSHOT_BATCH)
+    if not game_ids:
+        return 0
+    async with AsyncSession(read_engine) as session:
+        for game_id in game_ids:
+            try:
+                await build_snapshot(game_id, session)
+            except Exception as e:
+                logger.error(f'Failed to build top snapshot of game {game_id}: {e}')
+                await r_leaderboard.sadd(TOP_DIRTY_KEY, game_id)
+    return len(game_ids)
+
+async def run_snapshot_builder():
+    while True:
+        try:
+            await build_dirty_snapshots()
+        except aioredis.RedisError as e:
+            logger.error(f'Top snapshot builder failed: {e}')
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+
+
+### 2. READ ###
+
+
+## 2.1 current snapshot of a game ##
+
+# KEYS: games registry, dirty top snapshots. ARGV: game id. only a game that exists is marked
+MARK_DIRTY_SCRIPT = r_leaderboard.register_script("""
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 1 then
+    return redis.call('SADD', KEYS[2], ARGV[1])
+end
+return 0
+""")
+
+# (etag, {'game', 'entries': [[username, score]]}), or None until the first build, which this requests
+# for a game in the registry. the caller reads the page live then, unknown games included.
+# the etag carries a digest of the data as well as the version, so a version counter lost with
+# a flushed redis can't make an old etag match new data
+async def get_snapshot(game_id):
+    snapshot = snapshots_l1.get(str(game_id))
+    if snapshot is not None:
+        return snapshot
+    version, data = await r_leaderboard.hmget(top_snapshot_key(game_id), 'version', 'data')
+    if version is None:
+        await MARK_DIRTY_SCRIPT(keys=[GAMES_REGISTRY_KEY, TOP_DIRTY_KEY], args=[game_id])
+        return None
+    snapshot = (f'"{version}-{hashlib.md5(data.encode()).hexdigest()[:12]}"', json.loads(data))
+    snapshots_l1.set(str(game_id), snapshot)
+    stale_l1.set(str(game_id), (time.time(), snapshot))
+    return snapshot
+
+# (seconds since it was read, etag, data) of the last snapshot this worker read, or None
+def stale_snapshot(game_id):
+    stale = stale_l1.get(str(game_id))
+    if stale is None:
+        return None
+    read_at, (etag, data) = stale
+    return time.time() - read_at, etag, data
+
+
+## 2.2 a page of it, serialised once per version ##
+
+# same body as the live leaderboard page, ranks 1-based from start. a stale page also has
+# "stale": true and isn't kept, it is only served while redis is unavailable
+def snapshot_page(game_id, etag : str, snapshot : dict, start : int, end : int, stale : bool = False) -> bytes:
+    key = f'{game_id}:{start}:{end}'
+    cached = pages_l1.get(key)
+    if not stale and cached is not None and cached[0] == etag:
+        return cached[1]
+    page = {'game': snapshot['game'],
+            'data': [{'rank': rank, 'username': username, 'score': score}
+                     for rank, (username, score) in enumerate(snapshot['entries'][start:end + 1], start=start + 1)]}
+    if stale:
+        page['stale'] = True
+    body = json.dumps(page, ensure_ascii=False, separators=(',', ':')).encode()
+    if not stale:
+        pages_l1.set(key, (etag, body))
+    return body
@@ -1,2 +1,700 @@
+import asyncio
+import hashlib
+import logging
+import sys
+import time
+import redis
+from collections import Counter
+from datetime import datetime, timedelta
+from decouple import config
+from redis import asyncio as aioredis
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import func, text
+from api.database import engine
+from api.models import Game, Score, User
+from data.ingest import INGEST_STREAM, dead_letter_listeners
+from data.shards import shards, is_sharded, shard_for
+from data.breaker import close_listeners, CONNECTION_ERRORS
+from data.leaderboard import r_leaderboard, repair_scores, repair_daily_scores, submit_score_sharded, replay_buffer, replay_stats, board_key, leaderboard_key, user_games_key, USER_NAMES_KEY, GAME_NAMES_KEY, GAMES_REGISTRY_KEY, GAME_POLICIES_KEY, GLOBAL_LEADERBOARD_KEY, GAME_WEIGHTS_KEY, GLOBAL_AGGREGATION, TOP_DIRTY_KEY, top_snapshot_key, top_version_key, histogram_key, histogram_enabled, bucket_of
 
 
+### 0. Initialization ###
+
+
+## 0.1 logger ##
+
+logger = logging.getLogger(__name__)
+
+
+## 0.2 settings ##
+
+# rebuild redis from postgres when the app starts against an empty redis (see 6.)
+REBUILD_ON_STARTUP = config('REBUILD_ON_STARTUP', default=True, cast=bool)
+
+# rows fetched from the server-side cursor at a time, bounds the memory of a rebuild
+REBUILD_CHUNK_SIZE = config('REBUILD_CHUNK_SIZE', default=5000, cast=int)
+
+# members per ZADD/HSET, keeps each redis command short
+REDIS_WRITE_CHUNK = 1000
+
+REBUILD_LOCK_KEY = 'sync:rebuild:lock'
+
+# seconds between reconciliation passes (see 5.), 0 turns them off
+RECONCILE_INTERVAL = config('RECONCILE_INTERVAL', default=60, cast=float)
+
+# rows younger than this are left for the next pass, their redis write may still be in flight
+RECONCILE_SETTLE_SECONDS = config('RECONCILE_SETTLE_SECONDS', default=5, cast=float)
+
+# last Score.id checked by the reconciler
+RECONCILE_HWM_KEY = 'sync:reconcile:hwm'
+
+# ids up to this far below the mark are checked again on every pass. an id is taken at insert but
+# only seen at commit, so a long transaction or a slow batch can commit rows below the mark
+RECONCILE_ID_OVERLAP = config('RECONCILE_ID_OVERLAP', default=10000, cast=int)
+
+# significant digits board scores are compared to. a sum postgres makes and the one ZINCRBY
+# adds up can differ in the last bits without either being wrong
+RECONCILE_DIGITS = config('RECONCILE_DIGITS', default=12, cast=int)
+RECONCILE_LOCK_KEY = 'sync:reconcile:lock'
+
+# board members each pass checks for a row in postgres, one game after the other (see 5.2.1).
+# the hash holds the game and rank the next pass starts at
+RECONCILE_SWEEP_SIZE = config('RECONCILE_SWEEP_SIZE', default=1000, cast=int)
+RECONCILE_SWEEP_KEY = 'sync:reconcile:sweep'
+
+
+### 1. KEY LAYOUT MIGRATION ###
+
+# leaderboards used to be keyed by the bare game id in db 0, with the user cache in db 1 and
+# the game cache in db 2. this moves them into the layout in data/leaderboard.py.
+# safe to run more than once.
+
+
+## 1.1 copy a legacy string cache (id -> name) into a hash ##
+async def migrate_cache_db(db : int, hash_key : str, batch : int = 1000) -> int:
+    legacy = aioredis.StrictRedis(host='redis', port=6379, db=db, decode_responses=True)
+    moved = 0
+    try:
+        cursor = 0
+        while True:
+            cursor, keys = await legacy.scan(cursor, count=batch, _type='string')
+            if keys:
+                values = await legacy.mget(keys)
+                mapping = {key: value for key, value in zip(keys, values) if value is not None}
+                if mapping:
+                    await r_leaderboard.hset(hash_key, mapping=mapping)
+                    moved += len(mapping)
+            if cursor == 0:
+                break
+    finally:
+        await legacy.aclose()
+    return moved
+
+
+## 1.2 rename sorted sets keyed by the bare game id ##
+async def migrate_leaderboard_keys(batch : int = 1000) -> int:
+    moved = 0
+    cursor = 0
+    while True:
+        cursor, keys = await r_leaderboard.scan(cursor, count=batch, _type='zset')
+        for key in keys:
+            if not key.isdigit():
+                continue
+            # renamenx leaves the old key alone if the new one already exists
+            if await r_leaderboard.renamenx(key, leaderboard_key(key)):
+                moved += 1
+            else:
+                logger.warning(f'{leaderboard_key(key)} already exists, legacy key {key} left in place')
+        if cursor == 0:
+            break
+    return moved
+
+
+async def migrate_legacy_layout():
+    users = await migrate_cache_db(1, USER_NAMES_KEY)
+    games = await migrate_cache_db(2, GAME_NAMES_KEY)
+    boards = await migrate_leaderboard_keys()
+    logger.info(f'migrated {boards} leaderboards, {users} usernames, {games} game names')
+
+
+## 1.3 score table indexes on an existing postgres ##
+
+# create_all only makes the indexes declared on Score for a new table. on a large one they are built
+# concurrently, outside a transaction, so score inserts carry on meanwhile. safe to run more than once,
+# but an index left invalid by a failed build has to be dropped before running it again
+async def create_score_indexes():
+    async with engine.connect() as connection:
+        connection = await connection.execution_options(isolation_level='AUTOCOMMIT')
+        for index in Score.__table__.indexes:
+            start = time.perf_counter()
+            columns = ', '.join(column.name for column in index.columns)
+            await connection.execute(text(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} ON {Score.__tablename__} ({columns})'))
+            logger.info(f'index {index.name} on ({columns}) ready in {time.perf_counter() - start:.1f}s')
+
+
+### 2. GAME INDEXES ###
+
+# games:registry and user:{id}:games are kept up to date at submit time, games:policies at game creation.
+# this regenerates both from postgres, e.g. after a flush or for data written before they existed.
+
+
+## 2.1 registry of all games and their score policies, swapped in with a rename ##
+async def rebuild_games_registry(session : AsyncSession) -> int:
+    games = (await session.exec(select(Game.id, Game.score_policy))).all()
+    pipeline = r_leaderboard.pipeline()
+    for key in (GAMES_REGISTRY_KEY, GAME_POLICIES_KEY):
+        pipeline.delete(f'{key}:staging')
+    if games:
+        pipeline.sadd(f'{GAMES_REGISTRY_KEY}:staging', *[game_id for game_id, _ in games])
+        pipeline.hset(f'{GAME_POLICIES_KEY}:staging', mapping=dict(games))
+        for key in (GAMES_REGISTRY_KEY, GAME_POLICIES_KEY):
+            pipeline.rename(f'{key}:staging', key)
+    else:
+        pipeline.delete(GAMES_REGISTRY_KEY, GAME_POLICIES_KEY)
+    await pipeline.execute()
+    return len(games)
+
+
+## 2.2 games played per user, streamed from the score table ##
+async def rebuild_user_games(session : AsyncSession, chunk_size : int) -> int:
+    statement = (select(Score.user_id, Score.game_id).distinct()
+                 .order_by(Score.user_id)
+                 .execution_options(yield_per=chunk_size))
+    users = 0
+    current_user, current_games = None, []
+    pipeline = r_leaderboard.pipeline()
+
+    # each user's set is replaced in the same transaction it is rebuilt in
+    def queue_user(user_id, game_ids):
+        pipeline.delete(user_games_key(user_id))
+        pipeline.sadd(user_games_key(user_id), *game_ids)
+
+    result = await session.stream(statement)
+    async for rows in result.partitions():
+        for user_id, game_id in rows:
+            if user_id != current_user and current_games:
+                queue_user(current_user, current_games)
+                users += 1
+                current_games = []
+            current_user = user_id
+            current_games.append(game_id)
+        await pipeline.execute()
+
+    if current_games:
+        queue_user(current_user, current_games)
+        users += 1
+        await pipeline.execute()
+    return users
+
+
+async def rebuild_game_indexes(chunk_size : int = 5000):
+    start = time.perf_counter()
+    async with AsyncSession(engine) as session:
+        games = await rebuild_games_registry(session)
+        users = await rebuild_user_games(session, chunk_size)
+    logger.info(f'rebuilt registry of {games} games and game sets of {users} users in {time.perf_counter() - start:.1f}s')
+
+
+### 3. GLOBAL LEADERBOARD ###
+
+# the submit script keeps leaderboard:global up to date. this recomputes it from the game boards,
+# for data written before it existed or after changing GLOBAL_AGGREGATION or games:weights.
+# submits landing during the rebuild can be lost from it, run it when traffic is low.
+# best_low games are left out, as by the submit script
+async def rebuild_global_board():
+    start = time.perf_counter()
+    policies = await r_leaderboard.hgetall(GAME_POLICIES_KEY)
+    game_ids = [game_id for game_id in await r_leaderboard.smembers(GAMES_REGISTRY_KEY) if policies.get(game_id) != 'best_low']
+    weights = await r_leaderboard.hgetall(GAME_WEIGHTS_KEY) if GLOBAL_AGGREGATION == 'weighted' else {}
+    def weight_of(game_id):
+        return float(weights.get(game_id, 1))
+    boards = {leaderboard_key(game_id): weight_of(game_id) for game_id in game_ids if not is_sharded(game_id)}
+
+    staging = f'{GLOBAL_LEADERBOARD_KEY}:staging'
+    await r_leaderboard.delete(staging)
+    if boards:
+        await r_leaderboard.zunionstore(staging, boards, aggregate='MAX' if GLOBAL_AGGREGATION == 'max' else 'SUM')
+
+    # sharded boards aren't on this redis, they are scanned from the shards and merged in
+    for game_id in [game_id for game_id in game_ids if is_sharded(game_id)]:
+        weight = weight_of(game_id)
+        for shard in shards:
+            cursor = 0
+            while True:
+                cursor, entries = await shard.zscan(leaderboard_key(game_id), cursor, count=REDIS_WRITE_CHUNK)
+                pipeline = r_leaderboard.pipeline(transaction=False)
+                for member, score in entries:
+                    if GLOBAL_AGGREGATION == 'max':
+                        pipeline.zadd(staging, {member: score * weight}, gt=True)
+                    else:
+                        pipeline.zincrby(staging, score * weight, member)
+                await pipeline.execute()
+                if cursor == 0:
+                    break
+
+    if await r_leaderboard.exists(staging):
+        await r_leaderboard.rename(staging, GLOBAL_LEADERBOARD_KEY)
+    else:
+        await r_leaderboard.delete(GLOBAL_LEADERBOARD_KEY)
+    users = await r_leaderboard.zcard(GLOBAL_LEADERBOARD_KEY)
+    logger.info(f'rebuilt global board ({GLOBAL_AGGREGATION}) of {users} users from {len(game_ids)} games in {time.perf_counter() - start:.1f}s')
+
+
+## 3.1 score histograms of the games in HISTOGRAM_GAMES ##
+
+# buckets are counted here while scanning each board, then the hash is swapped in with a rename.
+# needed after adding a game to HISTOGRAM_GAMES or changing HISTOGRAM_PRECISION
+async def rebuild_histograms() -> int:
+    start = time.perf_counter()
+    game_ids = [game_id for game_id in await r_leaderboard.smembers(GAMES_REGISTRY_KEY) if histogram_enabled(game_id)]
+    for game_id in game_ids:
+        counts = Counter()
+        for client in shards if is_sharded(game_id) else [r_leaderboard]:
+            cursor = 0
+            while True:
+                cursor, entries = await client.zscan(leaderboard_key(game_id), cursor, count=REDIS_WRITE_CHUNK)
+                counts.update(bucket_of(score) for _, score in entries)
+                if cursor == 0:
+                    break
+
+        staging = f'{histogram_key(game_id)}:staging'
+        pipeline = r_leaderboard.pipeline()
+        pipeline.delete(staging)
+        if counts:
+            pipeline.hset(staging, mapping=counts)
+            pipeline.rename(staging, histogram_key(game_id))
+        else:
+            pipeline.delete(histogram_key(game_id))
+        await pipeline.execute()
+    logger.info(f'rebuilt score histograms of {len(game_ids)} games in {time.perf_counter() - start:.1f}s')
+    return len(game_ids)
+
+
+### 4. FULL REBUILD FROM POSTGRES ###
+
+# regenerates the boards and the name caches after redis is restarted or flushed.
+# rows are streamed from a server-side cursor REBUILD_CHUNK_SIZE at a time and written to a
+# staging key, which is renamed over the live one when it is complete, so memory stays bounded
+# and readers see either the old key or the whole new one.
+# submits to a game while its board is loading are lost from it, as are write-behind scores not yet
+# flushed to postgres. period boards are not rebuilt, they refill from new submits.
+
+
+## 4.1 stream (member, value) rows into a staging key and swap it in ##
+async def load_staged(session : AsyncSession, statement, key : str, write, chunk_size : int) -> int:
+    staging = f'{key}:staging'
+    await r_leaderboard.delete(staging)
+    loaded = 0
+    result = await session.stream(statement.execution_options(yield_per=chunk_size))
+    async for rows in result.partitions():
+        pipeline = r_leaderboard.pipeline(transaction=False)
+        for first in range(0, len(rows), REDIS_WRITE_CHUNK):
+            write(pipeline, staging, {member: value for member, value in rows[first:first + REDIS_WRITE_CHUNK]})
+        await pipeline.execute()
+        loaded += len(rows)
+    if loaded:
+        await r_leaderboard.rename(staging, key)
+    else:
+        await r_leaderboard.delete(key)
+    return loaded
+
+def write_sorted_set(pipeline, key, mapping):
+    pipeline.zadd(key, mapping)
+
+def write_hash(pipeline, key, mapping):
+    pipeline.hset(key, mapping=mapping)
+
+# the same for a sharded board: each member goes to its shard's staging key, and each shard
+# swaps in its own part, so the board is replaced shard by shard rather than all at once
+async def load_staged_sharded(session : AsyncSession, statement, key : str, chunk_size : int) -> int:
+    staging = f'{key}:staging'
+    await asyncio.gather(*[shard.delete(staging) for shard in shards])
+    loaded = 0
+    result = await session.stream(statement.execution_options(yield_per=chunk_size))
+    async for rows in result.partitions():
+        by_shard = {}
+        for member, value in rows:
+            by_shard.setdefault(shard_for(member), {})[member] = value
+        await asyncio.gather(*[shard.zadd(staging, mapping) for shard, mapping in by_shard.items()])
+        loaded += len(rows)
+    for shard in shards:
+        if await shard.exists(staging):
+            await shard.rename(staging, key)
+        else:
+            await shard.delete(key)
+    return loaded
+
+
+## 4.2 the score each user holds on a game's board, computed in postgres ##
+
+# mirrors the policies applied by the submit script, best_low is stored negated.
+# user_ids limits it to some users, otherwise it covers the whole board. with day (midnight utc)
+# it is the daily board of that day
+def board_scores_statement(game_id : int, policy : str, user_ids=None, day : datetime | None = None):
+    condition = Score.game_id == game_id
+    if user_ids is not None:
+        condition = condition & Score.user_id.in_(user_ids)
+    if day is not None:
+        condition = condition & (Score.date_added >= day) & (Score.date_added < day + timedelta(days=1))
+
+    if policy in ('best_high', 'best_low', 'cumulative'):
+        aggregate = {'best_high': func.max(Score.score),
+                     'best_low': -func.min(Score.score),
+                     'cumulative': func.sum(Score.score)}[policy]
+        return select(Score.user_id, aggregate.label('score')).where(condition).group_by(Score.user_id)
+
+    # latest
+    position = func.row_number().over(partition_by=Score.user_id, order_by=(Score.date_added.desc(), Score.id.desc()))
+    ranked = select(Score.user_id, Score.score, position.label('position')).where(condition).subquery()
+    return select(ranked.c.user_id, ranked.c.score).where(ranked.c.position == 1)
+
+
+## 4.3 everything, step by step ##
+
+async def timed_step(name : str, step, *args):
+    start = time.perf_counter()
+    rows = await step(*args)
+    elapsed = time.perf_counter() - start
+    logger.info(f'rebuild {name}: {rows} rows in {elapsed:.1f}s ({rows / elapsed if elapsed else 0:.0f} rows/s)')
+    return rows
+
+async def rebuild_boards(session : AsyncSession, chunk_size : int) -> int:
+    games = (await session.exec(select(Game.id, Game.score_policy))).all()
+    rows = 0
+    for game_id, policy in games:
+        statement = board_scores_statement(game_id, policy)
+        if is_sharded(game_id):
+            rows += await load_staged_sharded(session, statement, leaderboard_key(game_id), chunk_size)
+        else:
+            rows += await load_staged(session, statement, leaderboard_key(game_id), write_sorted_set, chunk_size)
+    # top snapshots are rebuilt from the new boards on the next tick
+    if games:
+        await r_leaderboard.sadd(TOP_DIRTY_KEY, *[game_id for game_id, _ in games])
+    return rows
+
+async def rebuild_all(chunk_size : int = REBUILD_CHUNK_SIZE):
+    start = time.perf_counter()
+    rows = 0
+    async with AsyncSession(engine) as session:
+        rows += await timed_step('usernames', load_staged, session, select(User.id, User.username), USER_NAMES_KEY, write_hash, chunk_size)
+        rows += await timed_step('game names', load_staged, session, select(Game.id, Game.name), GAME_NAMES_KEY, write_hash, chunk_size)
+        rows += await timed_step('games registry', rebuild_games_registry, session)
+        rows += await timed_step('boards', rebuild_boards, session, chunk_size)
+        rows += await timed_step('user games', rebuild_user_games, session, chunk_size)
+    await rebuild_global_board()
+    await rebuild_histograms()
+    elapsed = time.perf_counter() - start
+    logger.info(f'rebuild finished: {rows} rows in {elapsed:.1f}s ({rows / elapsed if elapsed else 0:.0f} rows/s)')
+
+
+### 5. DRIFT REPAIR ###
+
+# postgres and redis are written one after the other, so a failed redis write after the commit
+# leaves them disagreeing. each pass looks at the (game, user) pairs with rows added since the
+# last one (high-water mark on Score.id, less RECONCILE_ID_OVERLAP), compares a digest of their board
+# scores on both sides per game, and fixes the members of the games that differ. a member checked
+# that postgres has no score for is removed. the cost follows new rows, not table size, so a row
+# committed below the overlap is missed until a rebuild. members with no row at all can't be found
+# from the rows, so each pass also sweeps a slice of one board for them.
+
+
+## 5.1 helpers ##
+
+# score to RECONCILE_DIGITS significant digits, None for no score
+def rounded(score):
+    return None if score is None else float(f'{score:.{RECONCILE_DIGITS}g}')
+
+# count, sum and a hash over the (member, rounded score) pairs present
+def scores_digest(scores : dict):
+    present = sorted((member, rounded(score)) for member, score in scores.items() if score is not None)
+    text = '\n'.join(f'{member}:{score!r}' for member, score in present)
+    return len(present), sum(score for _, score in present), hashlib.sha1(text.encode()).hexdigest()
+
+def chunks(items, size):
+    for first in range(0, len(items), size):
+        yield items[first:first + size]
+
+# pairs still waiting in the write-behind queue, redis is ahead of postgres for those
+async def queued_pairs() -> set:
+    pairs = set()
+    start = '-'
+    while True:
+        entries = await r_leaderboard.xrange(INGEST_STREAM, min=start, count=REDIS_WRITE_CHUNK)
+        for _, fields in entries:
+            pairs.add((int(fields['game_id']), int(fields['user_id'])))
+        if len(entries) < REDIS_WRITE_CHUNK:
+            return pairs
+        start = f'({entries[-1][0]}'
+
+async def distinct_pairs(session : AsyncSession, condition, chunk_size : int) -> set:
+    statement = select(Score.game_id, Score.user_id).where(condition).distinct().execution_options(yield_per=chunk_size)
+    pairs = set()
+    result = await session.stream(statement)
+    async for rows in result.partitions():
+        pairs.update((game_id, user_id) for game_id, user_id in rows)
+    return pairs
+
+
+## 5.2 one pass ##
+
+async def reconcile(chunk_size : int = REBUILD_CHUNK_SIZE) -> dict:
+    start = time.perf_counter()
+    report = {'games_checked': 0, 'pairs_checked': 0, 'games_drifted': 0, 'members_repaired': 0, 'members_removed': 0}
+    async with AsyncSession(engine) as session:
+        settled = datetime.utcnow() - timedelta(seconds=RECONCILE_SETTLE_SECONDS)
+        top = (await session.exec(select(func.max(Score.id)).where(Score.date_added <= settled))).one()
+        hwm = await r_leaderboard.get(RECONCILE_HWM_KEY)
+        # first run: start from here, older rows are covered by a rebuild
+        if hwm is None:
+            await r_leaderboard.set(RECONCILE_HWM_KEY, top or 0)
+            return report
+        if top is None:
+            return report
+        # the overlap is checked even when nothing is newer than the mark
+        top = max(top, int(hwm))
+
+        pairs = await distinct_pairs(session, (Score.id > int(hwm) - RECONCILE_ID_OVERLAP) & (Score.id <= top), chunk_size)
+        # pairs with newer rows or queued scores are checked once those rows are in, on a later pass
+        pairs -= await distinct_pairs(session, Score.id > top, chunk_size)
+        pairs -= await queued_pairs()
+
+        # sharded boards are not checked, the repair script needs the board next to the global one
+        users_by_game = {}
+        for game_id, user_id in pairs:
+            if not is_sharded(game_id):
+                users_by_game.setdefault(game_id, []).append(user_id)
+        policies = dict((await session.exec(select(Game.id, Game.score_policy).where(Game.id.in_(users_by_game)))).all())
+
+        for game_id, user_ids in users_by_game.items():
+            user_ids.sort()
+            expected = {str(user_id): None for user_id in user_ids}
+            for chunk in chunks(user_ids, chunk_size):
+                rows = (await session.execute(board_scores_statement(game_id, policies.get(game_id), chunk))).all()
+                expected.update((str(user_id), float(score)) for user_id, score in rows)
+            actual = {}
+            for chunk in chunks(user_ids, REDIS_WRITE_CHUNK):
+                actual.update(zip(map(str, chunk), await r_leaderboard.zmscore(leaderboard_key(game_id), chunk)))
+
+            report['games_checked'] += 1
+            report['pairs_checked'] += len(user_ids)
+            if scores_digest(expected) == scores_digest(actual):
+                continue
+
+            # score None removes the member
+            repairs = [(member, actual[member], score) for member, score in expected.items()
+                       if rounded(actual[member]) != rounded(score)]
+            report['games_drifted'] += 1
+            for chunk in chunks(repairs, REDIS_WRITE_CHUNK):
+                report['members_repaired'] += await repair_scores(game_id, chunk)
+            logger.warning(f'game {game_id} had drifted from postgres, repaired {len(repairs)} of {len(user_ids)} users checked')
+
+        report['members_removed'] = await sweep_members(session)
+
+    await r_leaderboard.set(RECONCILE_HWM_KEY, top)
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    logger.info(f'reconciled up to score {top}: {report}')
+    return report
+
+
+## 5.2.1 board members with no score in postgres ##
+
+# e.g. after scores are deleted in postgres. the board is read before the write-behind queue, and a
+# queued score is only acked once its row is in, so a member just submitted is never taken for one.
+# sharded boards are not swept, as in 5.2. returns the members removed
+async def sweep_members(session : AsyncSession) -> int:
+    game_ids = sorted(int(game_id) for game_id in await r_leaderboard.smembers(GAMES_REGISTRY_KEY) if not is_sharded(int(game_id)))
+    if not game_ids:
+        return 0
+    cursor = await r_leaderboard.hgetall(RECONCILE_SWEEP_KEY)
+    game_id, start = int(cursor.get('game', game_ids[0])), int(cursor.get('start', 0))
+
+    entries = await r_leaderboard.zrange(leaderboard_key(game_id), start, start + RECONCILE_SWEEP_SIZE - 1, withscores=True)
+    queued = await queued_pairs()
+    user_ids = [int(member) for member, _ in entries]
+    known = set()
+    if user_ids:
+        statement = select(Score.user_id).where(Score.user_id.in_(user_ids) & (Score.game_id == game_id)).distinct()
+        known = set((await session.exec(statement)).all())
+    removals = [(user_id, score, None) for user_id, (_, score) in zip(user_ids, entries)
+                if user_id not in known and (game_id, user_id) not in queued]
+    removed = 0
+    for chunk in chunks(removals, REDIS_WRITE_CHUNK):
+        removed += await repair_scores(game_id, chunk)
+    if removed:
+        logger.warning(f'removed {removed} members with no score in postgres from game {game_id}')
+
+    # the end of a board moves the sweep on to the next game
+    if len(entries) < RECONCILE_SWEEP_SIZE:
+        game_id, start = next((other for other in game_ids if other > game_id), game_ids[0]), 0
+    else:
+        start += RECONCILE_SWEEP_SIZE - removed
+    await r_leaderboard.hset(RECONCILE_SWEEP_KEY, mapping={'game': game_id, 'start': start})
+    return removed
+
+
+## 5.3 background loop ##
+
+# runs for the life of the app, the lock lets one worker do each pass
+async def run_reconciler():
+    if not RECONCILE_INTERVAL:
+        return
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL)
+        try:
+            if await r_leaderboard.set(RECONCILE_LOCK_KEY, 1, nx=True, px=int(RECONCILE_INTERVAL * 900)):
+                await reconcile()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f'Reconciliation failed: {e}')
+
+
+## 5.4 submits held back while redis was unavailable ##
+
+# the held back scores are already in postgres, and a reconciler pass may have put some of them in
+# the boards before the replay. so instead of running each submit again, which would add a
+# cumulative score twice, the all-time and daily boards of the held back (game, user) pairs are
+# compared with postgres and set by compare-and-set as in 5.2. a second replay changes nothing.
+# pairs still in the write-behind queue are left to the reconciler, which checks them once their
+# rows are in. sharded games can't be repaired (see 5.2), so their submits are run again in order
+# and a reply lost during their replay can count a cumulative score twice
+
+replay_task = None
+
+# returns the members repaired
+async def repair_held_back(held) -> int:
+    # (game_id, None for the all-time board or the day of the daily board) -> user ids
+    boards = {}
+    for user_id, game_id, _, date_added in held:
+        boards.setdefault((game_id, None), set()).add(user_id)
+        boards.setdefault((game_id, date_added.replace(hour=0, minute=0, second=0, microsecond=0)), set()).add(user_id)
+    if not boards:
+        return 0
+    queued = await queued_pairs()
+
+    repaired = 0
+    async with AsyncSession(engine) as session:
+        game_ids = {game_id for game_id, _ in boards}
+        policies = dict((await session.exec(select(Game.id, Game.score_policy).where(Game.id.in_(game_ids)))).all())
+        for (game_id, day), user_ids in boards.items():
+            user_ids = sorted(user_id for user_id in user_ids if (game_id, user_id) not in queued)
+            key = leaderboard_key(game_id) if day is None else board_key(game_id, 'daily', day)
+            for chunk in chunks(user_ids, REDIS_WRITE_CHUNK):
+                rows = (await session.execute(board_scores_statement(game_id, policies.get(game_id), chunk, day))).all()
+                expected = {user_id: float(score) for user_id, score in rows}
+                actual = await r_leaderboard.zmscore(key, chunk)
+                # members with no row in postgres are removed
+                repairs = [(user_id, current, expected.get(user_id)) for user_id, current in zip(chunk, actual)
+                           if rounded(current) != rounded(expected.get(user_id))]
+                if not repairs:
+                    continue
+                if day is None:
+                    repaired += await repair_scores(game_id, repairs)
+                else:
+                    repaired += await repair_daily_scores(game_id, day, repairs)
+    return repaired
+
+# takes replayed submits out of the buffer. submits held back during the replay stay,
+# and those already pushed out of a full buffer are gone anyway
+def forget_held_back(items):
+    done = {id(item) for item in items}
+    remaining = [item for item in replay_buffer if id(item) not in done]
+    replay_buffer.clear()
+    replay_buffer.extend(remaining)
+
+# stops when redis or postgres fails, the rest wait for the next close.
+# a sharded submit redis rejects is dropped rather than holding up the ones behind it
+async def replay_submits():
+    while replay_buffer:
+        held = list(replay_buffer)
+        unsharded = [item for item in held if not is_sharded(item[1])]
+        try:
+            repaired = await repair_held_back(unsharded)
+        except Exception as e:
+            logger.error(f'Replay of held back submits stopped with {len(replay_buffer)} left: {e}')
+            return
+        forget_held_back(unsharded)
+        replay_stats['replayed'] += len(unsharded)
+        if unsharded:
+            logger.info(f'{len(unsharded)} held back submits replayed, {repaired} board members set from postgres')
+
+        for item in held:
+            if not is_sharded(item[1]):
+                continue
+            user_id, game_id, score, date_added = item
+            try:
+                await submit_score_sharded(user_id, game_id, score, date_added)
+            except CONNECTION_ERRORS as e:
+                logger.error(f'Replay of held back submits stopped with {len(replay_buffer)} left: {e}')
+                return
+            except redis.RedisError as e:
+                logger.error(f'Dropped held back submit {item}: {e}')
+                replay_stats['dropped'] += 1
+            else:
+                replay_stats['replayed'] += 1
+            forget_held_back([item])
+    logger.info('Replayed every held back submit')
+
+def start_replay(breaker):
+    global replay_task
+    if replay_buffer and (replay_task is None or replay_task.done()):
+        replay_task = asyncio.get_running_loop().create_task(replay_submits())
+
+close_listeners.append(start_replay)
+
+
+## 5.5 scores the write-behind flusher could not write ##
+
+# a dead-lettered row (e.g. a user deleted since it was queued) went on the boards when it was queued.
+# its pairs are set back to what postgres has, which takes off members postgres has no row for, and
+# games postgres doesn't know leave the registry along with their snapshots
+async def repair_dead_letters(records):
+    await repair_held_back([(record.user_id, record.game_id, record.score, record.date_added)
+                            for record in records if not is_sharded(record.game_id)])
+    game_ids = {record.game_id for record in records}
+    async with AsyncSession(engine) as session:
+        known = set((await session.exec(select(Game.id).where(Game.id.in_(game_ids)))).all())
+    unknown = game_ids - known
+    if unknown:
+        pipeline = r_leaderboard.pipeline()
+        pipeline.srem(GAMES_REGISTRY_KEY, *unknown)
+        pipeline.srem(TOP_DIRTY_KEY, *unknown)
+        pipeline.delete(*[key for game_id in unknown for key in (top_snapshot_key(game_id), top_version_key(game_id))])
+        await pipeline.execute()
+        logger.warning(f'removed games {sorted(unknown)} unknown to postgres from the registry')
+
+dead_letter_listeners.append(repair_dead_letters)
+
+
+### 6. STARTUP ###
+
+# the games registry is written with every game and every submit, so redis without it has
+# been flushed or lost its data. one worker rebuilds while the others serve what is there.
+async def rebuild_if_empty():
+    if not REBUILD_ON_STARTUP:
+        return
+    try:
+        if await r_leaderboard.exists(GAMES_REGISTRY_KEY):
+            return
+        if not await r_leaderboard.set(REBUILD_LOCK_KEY, 1, nx=True, ex=3600):
+            return
+        logger.warning('redis has no games registry, rebuilding it from postgres')
+        try:
+            await rebuild_all()
+        finally:
+            await r_leaderboard.delete(REBUILD_LOCK_KEY)
+    except Exception as e:
+        logger.error(f'Startup rebuild failed: {e}')
+
+
+### 7. COMMAND LINE ###
+
+# python -m data.synchronisation [migrate|score-indexes|indexes|global|histograms|rebuild|reconcile]
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    commands = {'migrate': migrate_legacy_layout, 'score-indexes': create_score_indexes, 'indexes': rebuild_game_indexes, 'global': rebuild_global_board,
+                'histograms': rebuild_histograms, 'rebuild': rebuild_all, 'reconcile': reconcile}
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        sys.exit(f'usage: python -m data.synchronisation [{"|".join(commands)}]')
+    asyncio.run(commands[sys.argv[1]]())
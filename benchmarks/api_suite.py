@@ -0,0 +1,236 @@
+"""Throughput and p50/p95/p99 latency of the API hot paths, with saved baselines.
+
+Seeds synthetic users, games and scores through the API, then drives each scenario
+(score submit, leaderboard page, single rank, all-games rank, login) at a fixed
+concurrency. Run it against a fresh local stack (docker compose up) on the same box
+for each build to compare, with the same flags and seed:
+
+    python benchmarks/api_suite.py --users 200 --games 5 --scores 20000 --save baseline.json
+    python benchmarks/api_suite.py --users 200 --games 5 --scores 20000 --compare baseline.json
+
+With --compare the run exits with status 1 when a scenario's p95 latency rose, or its
+throughput fell, by more than --threshold (a fraction of the baseline).
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+SCENARIOS = ('submit', 'leaderboard', 'rank', 'all_ranks', 'login')
+PASSWORD = 'benchmark-password'
+
+
+### 1. HTTP ###
+
+# returns (status, parsed body or None). error statuses are returned, not raised
+def call(base_url, method, path, payload=None, form=None, token=None):
+    headers = {}
+    data = None
+    if payload is not None:
+        data = json.dumps(payload).encode()
+        headers['Content-Type'] = 'application/json'
+    elif form is not None:
+        data = urllib.parse.urlencode(form).encode()
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    if token is not None:
+        headers['Authorization'] = f'Bearer {token}'
+    request = urllib.request.Request(base_url + path, data=data, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(request) as response:
+            body = response.read()
+            return response.status, json.loads(body) if body else None
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code, None
+
+
+# register and login go through the bcrypt pool, which turns callers away with 503 when busy
+def call_until_accepted(base_url, method, path, retries=20, **kwargs):
+    for _ in range(retries):
+        status, body = call(base_url, method, path, **kwargs)
+        if status != 503:
+            return status, body
+        time.sleep(0.5)
+    return status, body
+
+
+### 2. SEED ###
+
+def register(base_url, email, username, is_admin=False):
+    status, body = call_until_accepted(base_url, 'POST', '/users/register/',
+                                       payload={'username': username, 'email': email, 'country': 'bench',
+                                                'plain_password': PASSWORD, 'is_admin': is_admin})
+    if status != 200:
+        sys.exit(f'failed to register {email}: {status}')
+    return body['id']
+
+
+def login(base_url, email):
+    status, body = call_until_accepted(base_url, 'POST', '/auth/token', form={'username': email, 'password': PASSWORD})
+    if status != 200:
+        sys.exit(f'failed to log in {email}: {status}')
+    return body['access_token']
+
+
+# names carry a run prefix so the suite can be pointed at a stack that already has data.
+# returns {'user_ids', 'game_ids', 'emails', 'tokens': {user id: token}}
+def seed(args, rng):
+    prefix = f'bench{int(time.time())}'
+    started = time.perf_counter()
+
+    admin_email = f'{prefix}-admin@bench.local'
+    register(args.base_url, admin_email, f'{prefix}-admin', is_admin=True)
+    admin_token = login(args.base_url, admin_email)
+
+    game_ids = []
+    for i in range(args.games):
+        status, body = call(args.base_url, 'POST', '/games', payload={'name': f'{prefix}-game-{i}'}, token=admin_token)
+        if status != 200:
+            sys.exit(f'failed to create game {i}: {status}')
+        game_ids.append(body['id'])
+
+    emails = [f'{prefix}-{i}@bench.local' for i in range(args.users)]
+    with ThreadPoolExecutor(max_workers=args.seed_concurrency) as pool:
+        user_ids = list(pool.map(lambda i: register(args.base_url, emails[i], f'{prefix}-{i}'), range(args.users)))
+
+    records = [{'user_id': rng.choice(user_ids), 'game_id': rng.choice(game_ids), 'score': round(rng.uniform(0, 10000), 2)}
+               for _ in range(args.scores)]
+    for i in range(0, len(records), 500):
+        status, body = call(args.base_url, 'POST', '/scores/batch', payload={'scores': records[i:i + 500]})
+        if status != 200 or body['failed']:
+            sys.exit(f'failed to seed scores: {status} {body and body["failed"]}')
+
+    # the rank routes only answer a user about themselves, so a few users are logged in up front
+    token_users = rng.sample(range(args.users), min(args.token_users, args.users))
+    tokens = {user_ids[i]: login(args.base_url, emails[i]) for i in token_users}
+
+    print(f'seeded {args.users} users, {args.games} games, {args.scores} scores in {time.perf_counter() - started:.1f}s')
+    return {'user_ids': user_ids, 'game_ids': game_ids, 'emails': emails, 'tokens': tokens}
+
+
+### 3. SCENARIOS ###
+
+# each returns the call() arguments of one request. the whole sequence is drawn before
+# the clock starts, so runs with the same seed send the same requests
+def make_request(name, data, rng, users):
+    user_id = rng.choice(data['user_ids'])
+    game_id = rng.choice(data['game_ids'])
+    if name == 'submit':
+        return 'POST', f'/users/{user_id}/scores', {'payload': {'game_id': game_id, 'score': round(rng.uniform(0, 10000), 2)}}
+    if name == 'leaderboard':
+        start = rng.randrange(0, max(users - 10, 1), 10)
+        return 'GET', f'/games/leaderboard/{game_id}?start={start}&end={start + 9}', {}
+    user_id = rng.choice(list(data['tokens']))
+    token = data['tokens'][user_id]
+    if name == 'rank':
+        return 'GET', f'/users/{user_id}/ranking/{game_id}', {'token': token}
+    if name == 'all_ranks':
+        return 'GET', f'/users/{user_id}/ranking', {'token': token}
+    email = data['emails'][rng.randrange(users)]
+    return 'POST', '/auth/token', {'form': {'username': email, 'password': PASSWORD}}
+
+
+# nearest-rank percentile of sorted values
+def percentile(values, p):
+    return values[max(0, int(len(values) * p + 0.5) - 1)]
+
+
+def run_scenario(base_url, requests, concurrency):
+    def timed(request):
+        method, path, kwargs = request
+        start = time.perf_counter()
+        status, _ = call(base_url, method, path, **kwargs)
+        return time.perf_counter() - start, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(timed, requests))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for latency, _ in results)
+    return {'requests': len(results),
+            'errors': sum(1 for _, status in results if status >= 400),
+            'rps': round(len(results) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2)}
+
+
+### 4. BASELINES ###
+
+# scenarios whose p95 rose or throughput fell by more than threshold, as printable lines
+def regressions(results, baseline, threshold):
+    found = []
+    for name, result in results.items():
+        before = baseline.get('results', {}).get(name)
+        if before is None:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * (1 + threshold):
+            found.append(f"{name}: p95 {before['p95_ms']:.2f} -> {result['p95_ms']:.2f} ms")
+        if result['rps'] < before['rps'] * (1 - threshold):
+            found.append(f"{name}: throughput {before['rps']:.1f} -> {result['rps']:.1f} req/s")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--base-url', default='http://localhost:8000')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--games', type=int, default=5)
+    parser.add_argument('--scores', type=int, default=20000)
+    parser.add_argument('--token-users', type=int, default=20)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=2000, help='requests per scenario')
+    parser.add_argument('--seed-concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+
+    names = [name for name in args.scenarios.split(',') if name]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f'unknown scenarios: {", ".join(sorted(unknown))}, choose from {", ".join(SCENARIOS)}')
+
+    rng = random.Random(args.seed)
+    data = seed(args, rng)
+
+    results = {}
+    print(f"{'scenario':>12} {'req/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'errors':>8}")
+    for name in names:
+        requests = [make_request(name, data, rng, args.users) for _ in range(args.requests)]
+        # warm up connections and caches
+        run_scenario(args.base_url, requests[:args.concurrency], args.concurrency)
+        result = results[name] = run_scenario(args.base_url, requests, args.concurrency)
+        print(f"{name:>12} {result['rps']:>10.1f} {result['p50_ms']:>10.2f} {result['p95_ms']:>10.2f} "
+              f"{result['p99_ms']:>10.2f} {result['errors']:>8}")
+
+    report = {'settings': {key: getattr(args, key) for key in ('users', 'games', 'scores', 'concurrency', 'requests', 'seed')},
+              'machine': platform.node(), 'python': platform.python_version(), 'finished_at': time.time(),
+              'results': results}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('settings') != report['settings']:
+            print(f"warning: baseline was recorded with other settings {baseline.get('settings')}")
+        found = regressions(results, baseline, args.threshold)
+        for line in found:
+            print(f'regression: {line}')
+        if found:
+            sys.exit(1)
+        print(f'no regression beyond {args.threshold:.0%} of {args.compare}')
+
+
+if __name__ == '__main__':
+    main()
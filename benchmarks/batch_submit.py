@@ -0,0 +1,66 @@
+"""Records/sec of single score submission vs POST /scores/batch.
+
+Runs against a live API. Users 1..--users and games 1..--games must already exist.
+
+    python benchmarks/batch_submit.py --base-url http://localhost:8000 --records 2000
+"""
+import argparse
+import json
+import random
+import time
+import urllib.request
+
+
+def post(url, payload):
+    request = urllib.request.Request(url, data=json.dumps(payload).encode(),
+                                     headers={'Content-Type': 'application/json'}, method='POST')
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def make_records(n, users, games):
+    return [{'user_id': random.randint(1, users),
+             'game_id': random.randint(1, games),
+             'score': round(random.uniform(0, 10000), 2)} for _ in range(n)]
+
+
+# one request per score, as game servers do today
+def run_single(base_url, records):
+    start = time.perf_counter()
+    for record in records:
+        post(f"{base_url}/users/{record['user_id']}/scores",
+             {'game_id': record['game_id'], 'score': record['score']})
+    return time.perf_counter() - start
+
+
+def run_batch(base_url, records, batch_size):
+    start = time.perf_counter()
+    failed = 0
+    for i in range(0, len(records), batch_size):
+        failed += post(f"{base_url}/scores/batch", {'scores': records[i:i + batch_size]})['failed']
+    if failed:
+        print(f'warning: {failed} records failed in batch mode')
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--base-url', default='http://localhost:8000')
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--games', type=int, default=5)
+    args = parser.parse_args()
+
+    records = make_records(args.records, args.users, args.games)
+
+    single = run_single(args.base_url, records)
+    batch = run_batch(args.base_url, records, args.batch_size)
+
+    print(f'single: {args.records / single:10.1f} records/s ({single:.2f}s)')
+    print(f'batch : {args.records / batch:10.1f} records/s ({batch:.2f}s, batch size {args.batch_size})')
+    print(f'speedup: {single / batch:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
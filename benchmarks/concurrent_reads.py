@@ -0,0 +1,54 @@
+"""Leaderboard read throughput at increasing client concurrency.
+
+Runs against a live API, so start it from the commit to compare (e.g. before and
+after the async data layer) and run this once per build with the same flags.
+
+    python benchmarks/concurrent_reads.py --base-url http://localhost:8000 --game-id 1
+"""
+import argparse
+import statistics
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def timed_get(url):
+    start = time.perf_counter()
+    with urllib.request.urlopen(url) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def run_level(url, concurrency, requests_per_client):
+    total = concurrency * requests_per_client
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(timed_get, [url] * total))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {'concurrency': concurrency,
+            'rps': total / elapsed,
+            'p50_ms': statistics.median(latencies) * 1000,
+            'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--base-url', default='http://localhost:8000')
+    parser.add_argument('--game-id', type=int, default=1)
+    parser.add_argument('--levels', default='1,10,50,100,200')
+    parser.add_argument('--requests-per-client', type=int, default=50)
+    args = parser.parse_args()
+
+    url = f'{args.base_url}/games/leaderboard/{args.game_id}?start=0&end=9'
+    # warm up connections and caches
+    run_level(url, 4, 10)
+
+    print(f"{'clients':>8} {'req/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    for level in [int(level) for level in args.levels.split(',')]:
+        result = run_level(url, level, args.requests_per_client)
+        print(f"{result['concurrency']:>8} {result['rps']:>10.1f} {result['p50_ms']:>10.2f} {result['p99_ms']:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
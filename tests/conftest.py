@@ -0,0 +1,41 @@
+import asyncio
+import inspect
+import os
+import sys
+
+import pytest
+
+# the app imports modules from app/ and connects to redis at import time,
+# so the redis clients are swapped for fakeredis before anything from the app is imported
+fakeredis = pytest.importorskip('fakeredis')
+pytest.importorskip('lupa')
+import redis.asyncio
+from fakeredis import aioredis as fake_aioredis
+
+os.environ.setdefault('SECRET_KEY', 'test')
+os.environ.setdefault('LOG_FILE', '')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+server = fakeredis.FakeServer()
+
+def fake_redis(host=None, port=None, db=0, decode_responses=False, **kwargs):
+    return fake_aioredis.FakeRedis(server=server, db=db, decode_responses=decode_responses)
+
+redis.asyncio.StrictRedis = fake_redis
+redis.asyncio.Redis = fake_redis
+
+
+# async def tests run in a fresh event loop each, so they can await the app directly
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    arguments = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+    asyncio.run(pyfuncitem.obj(**arguments))
+    return True
+
+
+@pytest.fixture(autouse=True)
+def empty_redis():
+    yield
+    fakeredis.FakeStrictRedis(server=server).flushall()
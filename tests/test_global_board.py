@@ -0,0 +1,65 @@
+from types import SimpleNamespace
+
+import pytest
+
+from data import leaderboard, synchronisation
+from data.leaderboard import r_leaderboard, set_game_policy, submit_score, GLOBAL_LEADERBOARD_KEY
+
+BEST_HIGH, BEST_LOW, CUMULATIVE = 1, 2, 3
+
+
+async def submit(user_id, game_id, score):
+    await submit_score(SimpleNamespace(game_id=game_id, score=score), user_id)
+
+async def setup_games():
+    for game_id, policy in ((BEST_HIGH, 'best_high'), (BEST_LOW, 'best_low'), (CUMULATIVE, 'cumulative')):
+        await set_game_policy(policy, game_id)
+        await r_leaderboard.sadd(leaderboard.GAMES_REGISTRY_KEY, game_id)
+
+async def global_scores():
+    return dict(await r_leaderboard.zrange(GLOBAL_LEADERBOARD_KEY, 0, -1, withscores=True))
+
+
+@pytest.fixture
+def aggregation(monkeypatch):
+    def use(name):
+        monkeypatch.setattr(leaderboard, 'GLOBAL_AGGREGATION', name)
+        monkeypatch.setattr(synchronisation, 'GLOBAL_AGGREGATION', name)
+    return use
+
+
+# best_low games are left out of the global board, the other policies add their board score
+async def test_sum_of_mixed_policies(aggregation):
+    aggregation('sum')
+    await setup_games()
+    await submit(1, BEST_HIGH, 50)
+    await submit(1, BEST_LOW, 12.5)
+    await submit(1, BEST_LOW, 20)     # slower, not kept
+    await submit(1, CUMULATIVE, 5)
+    await submit(1, CUMULATIVE, 5)
+    await submit(2, BEST_LOW, 1)
+    submitted = await global_scores()
+    assert submitted == {'1': 60.0}
+
+    await synchronisation.rebuild_global_board()
+    assert await global_scores() == submitted
+
+
+async def test_max_of_mixed_policies(aggregation):
+    aggregation('max')
+    await setup_games()
+    await submit(1, BEST_HIGH, 5)
+    await submit(1, BEST_LOW, 12.5)
+    await submit(1, CUMULATIVE, 3)
+    assert await global_scores() == {'1': 5.0}
+
+    # a faster time never lowers the global score
+    await submit(1, BEST_LOW, 4)
+    assert await global_scores() == {'1': 5.0}
+
+    await submit(1, CUMULATIVE, 4)
+    after = await global_scores()
+    assert after == {'1': 7.0}
+
+    await synchronisation.rebuild_global_board()
+    assert await global_scores() == after
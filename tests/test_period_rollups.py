@@ -0,0 +1,40 @@
+from datetime import datetime
+
+from data.leaderboard import (r_leaderboard, set_game_policy, rollup_periods, repair_daily_scores, board_key,
+                              SUBMIT_SCORE_SCRIPT, submit_score_keys, submit_score_args)
+
+MONDAY, TUESDAY = datetime(2026, 10, 12), datetime(2026, 10, 13)
+
+
+async def submit(user_id, game_id, score, when):
+    await SUBMIT_SCORE_SCRIPT(keys=submit_score_keys(user_id, game_id, when), args=submit_score_args(user_id, game_id, score))
+
+async def period_boards(game_id, when):
+    return {period: dict(await r_leaderboard.zrange(board_key(game_id, period, when), 0, -1, withscores=True))
+            for period in ('weekly', 'monthly')}
+
+
+# best_high boards are rolled up from the daily ones, latest boards are written by the submit and
+# keep the score of the last day a member played, not their best one
+async def test_period_boards_per_policy():
+    await set_game_policy('latest', 1)
+    await set_game_policy('best_high', 2)
+    for game_id in (1, 2):
+        await submit('a', game_id, 10, MONDAY)
+        await submit('b', game_id, 5, MONDAY)
+        await submit('a', game_id, 3, TUESDAY)
+
+    assert await rollup_periods([1, 2], TUESDAY) == 2
+    latest, best = await period_boards(1, TUESDAY), await period_boards(2, TUESDAY)
+    assert latest['weekly'] == latest['monthly'] == {'a': 3.0, 'b': 5.0}
+    assert best['weekly'] == best['monthly'] == {'a': 10.0, 'b': 5.0}
+
+
+# a member taken off a latest game's daily board falls back to their previous day in the period
+async def test_daily_repair_resets_latest_periods():
+    await set_game_policy('latest', 1)
+    await submit('a', 1, 10, MONDAY)
+    await submit('a', 1, 3, TUESDAY)
+    await submit('b', 1, 5, TUESDAY)
+    await repair_daily_scores(1, TUESDAY, [('a', 3.0, None), ('b', 5.0, None)])
+    assert await period_boards(1, TUESDAY) == {'weekly': {'a': 10.0}, 'monthly': {'a': 10.0}}
@@ -0,0 +1,34 @@
+import time
+
+import pytest
+import redis
+
+from data.breaker import RedisUnavailable
+from data.leaderboard import retry_cache_operation
+
+
+def failing(error):
+    calls = []
+
+    async def operation():
+        calls.append(1)
+        raise error
+    return operation, calls
+
+
+# an unreachable redis or a breaker that isn't closed fails at once, the breaker decides when to try again
+@pytest.mark.parametrize('error', [redis.ConnectionError('refused'), redis.TimeoutError('timed out'), RedisUnavailable('open')])
+async def test_connection_errors_are_not_retried(error):
+    operation, calls = failing(error)
+    start = time.perf_counter()
+    with pytest.raises(type(error)):
+        await retry_cache_operation(operation)
+    assert len(calls) == 1
+    assert time.perf_counter() - start < 0.1
+
+
+async def test_other_errors_are_retried():
+    operation, calls = failing(redis.ResponseError('BUSY'))
+    with pytest.raises(redis.ResponseError):
+        await retry_cache_operation(operation, delay=0)
+    assert len(calls) == 3
@@ -0,0 +1,19 @@
+from types import SimpleNamespace
+
+from data.leaderboard import r_leaderboard, set_game_policy, submit_scores_batch, leaderboard_key
+
+
+# a transaction sent again with the same batch id, as after a lost EXEC reply, applies nothing twice
+async def test_resent_batch_is_applied_once():
+    records = [SimpleNamespace(user_id=1, game_id=1, score=5), SimpleNamespace(user_id=1, game_id=1, score=7),
+               SimpleNamespace(user_id=2, game_id=1, score=3)]
+    await set_game_policy('cumulative', 1)
+
+    first = await submit_scores_batch(records, 'lost-reply')
+    again = await submit_scores_batch(records, 'lost-reply')
+    assert again == first
+    assert [outcome['leaderboard_score'] for outcome in first] == [5.0, 12.0, 3.0]
+    assert dict(await r_leaderboard.zrange(leaderboard_key(1), 0, -1, withscores=True)) == {'1': 12.0, '2': 3.0}
+
+    other = await submit_scores_batch(records[:1], 'next')
+    assert other[0]['leaderboard_score'] == 17.0
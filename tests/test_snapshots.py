@@ -0,0 +1,15 @@
+from data.leaderboard import r_leaderboard, GAMES_REGISTRY_KEY, TOP_DIRTY_KEY
+from data.snapshots import get_snapshot, build_snapshot
+
+
+# reading or building the snapshot of a game that doesn't exist leaves nothing behind in redis
+async def test_unknown_game_creates_no_keys():
+    assert await get_snapshot(404) is None
+    assert await build_snapshot(404, None) is None
+    assert await r_leaderboard.keys('*') == []
+
+
+async def test_registered_game_is_marked_dirty():
+    await r_leaderboard.sadd(GAMES_REGISTRY_KEY, 1)
+    assert await get_snapshot(1) is None
+    assert await r_leaderboard.smembers(TOP_DIRTY_KEY) == {'1'}